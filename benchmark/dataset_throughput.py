@@ -0,0 +1,105 @@
+'''
+    Throughput of volume.dataset.MapPatchDataset over a folder of synthetic maps, against the naive loader
+    that reads every map completely into memory before cropping its patches.
+
+    usage (from the repository root):
+        python -m benchmark.dataset_throughput --maps 32 --shape 128 --patch 32 --prefetch 1 4 8
+'''
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from volume.dataset import MapPatchDataset, find_entries
+from volume.mrc import HEADER_SIZE, build_header, mode_for_dtype
+from volume.reader import read_header
+
+
+def write_maps(directory, count, shape):
+    '''
+        description:
+            Writes count float32 maps emd_<n>.map of the given (z, y, x) shape filled with noise.
+    '''
+    rng = np.random.default_rng(0)
+    mode, dtype = mode_for_dtype(np.float32)
+    for index in range(count):
+        data = rng.standard_normal(shape, dtype=np.float32)
+        with open(os.path.join(directory, "emd_{}.map".format(10000 + index)), 'wb') as map_file:
+            map_file.write(build_header(shape, mode, ispg=1))
+            map_file.write(data.astype(dtype).tobytes())
+
+
+def full_read(entries, patch_size, patches_per_map, seed=0):
+    # reference: the whole map is read into RAM just to crop a few patches
+    rng = np.random.default_rng(seed)
+    for entry in entries:
+        with open(entry['map'], 'rb') as map_file:
+            map_file.seek(HEADER_SIZE)
+            data = np.fromfile(map_file, dtype='<f4')
+        data = data.reshape(read_header(entry['map'])['shape'])
+        for count in range(patches_per_map):
+            start = [int(rng.integers(0, extent - size + 1)) for size, extent in zip(patch_size, data.shape)]
+            yield data[tuple(slice(begin, begin + size) for begin, size in zip(start, patch_size))].copy()
+
+
+def measure(samples):
+    '''
+        output:
+            - (number of samples, voxels, seconds)
+    '''
+    start_time = time.time()
+    count = voxels = 0
+    for sample in samples:
+        patch = sample['patch'] if isinstance(sample, dict) else sample
+        voxels += patch.size
+        count += 1
+    return count, voxels, time.time() - start_time
+
+
+def run_benchmark(maps=32, shape=128, patch=32, patches_per_map=8, prefetch=(1, 4, 8)):
+    '''
+        description:
+            Iterates one epoch with every loader and prints samples/s and MB/s of patch data.
+
+        output:
+            - results: dict of loader name to samples per second
+    '''
+    patch_size = (patch,) * 3
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        write_maps(directory, maps, (shape,) * 3)
+        entries = find_entries(directory)
+        print("{} maps of {}^3 float32 ({:.1f} MB each), {} patches of {}^3 per map".format(
+            maps, shape, shape ** 3 * 4 / 1e6, patches_per_map, patch))
+
+        loaders = [("full read", full_read(entries, patch_size, patches_per_map))]
+        loaders += [("prefetch {}".format(threads), MapPatchDataset(entries, patch_size, patches_per_map, prefetch=threads))
+                    for threads in prefetch]
+        for name, loader in loaders:
+            count, voxels, seconds = measure(loader)
+            results[name] = count / seconds
+            print("{:>12}: {} samples in {:.2f}s ({:.0f} samples/s, {:.1f} MB/s)".format(
+                name, count, seconds, count / seconds, voxels * 4 / 1e6 / seconds))
+    return results
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='dataset_throughput', description='Samples per second of MapPatchDataset against full-map reads')
+    parser.add_argument('--maps', help="Number of synthetic maps [default: %(default)s]", type=int, default=32)
+    parser.add_argument('--shape', help="Edge of every cubic map in voxels [default: %(default)s]", type=int, default=128)
+    parser.add_argument('--patch', help="Edge of every cubic patch in voxels [default: %(default)s]", type=int, default=32)
+    parser.add_argument('--patches_per_map', help="Patches drawn from every map [default: %(default)s]", type=int, default=8)
+    parser.add_argument('--prefetch', help="Prefetch thread counts to measure [default: %(default)s]", type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    run_benchmark(args.maps, args.shape, args.patch, args.patches_per_map, args.prefetch)
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+'''
+    Offline benchmark suite of the download modes: every mode downloads the same synthetic batch from
+    benchmark.mirror_emulator (the downloaders are routed to it with common.endpoints) and is measured
+    for throughput, request latency (p50/p95/p99, from common.instrumentation) and peak memory.
+
+    Every mode runs in a fresh process, so its peak RSS is its own. With --baseline the results are
+    compared with an earlier --output file and the run fails when a mode got slower or bigger than
+    --tolerance allows, so regressions are caught before they reach production.
+
+    usage (from the repository root):
+        python -m benchmark.download_modes --output modes.json
+        python -m benchmark.download_modes --modes pdb-concurrent emdb-async --baseline modes.json
+        python -m benchmark.download_modes --latency 0.1 --bandwidth 10 --miss_rate 0.3 --map_size 268435456
+'''
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmark.mirror_emulator import add_emulator_arguments, emulator_from_arguments
+
+# mode name -> archive and downloader options; 'workers' is replaced by --workers
+MODES = {
+    'pdb-sequential': {'archive': 'pdb'},
+    'pdb-concurrent': {'archive': 'pdb', 'workers': True},
+    'pdb-hedged': {'archive': 'pdb', 'workers': True, 'hedge': True},
+    'pdb-unzip-parse': {'archive': 'pdb', 'workers': True, 'unzip': True, 'parse': True},
+    'emdb-sync': {'archive': 'emdb'},
+    'emdb-async': {'archive': 'emdb', 'workers': True},
+    'emdb-segments': {'archive': 'emdb', 'segments': 4},
+    'emdb-unzip': {'archive': 'emdb', 'workers': True, 'unzip': True},
+}
+
+# compared with --baseline: a higher value is a regression for these, a lower one for mb_per_s
+LOWER_IS_BETTER = ('p95_latency', 'peak_rss_mb')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_mode(mode, root, accession_list, workers, segment_size):
+    '''
+        description:
+            Runs one mode against the emulator at root, in the calling process (see run_benchmark).
+
+        output:
+            - result: dict of the measurements of the mode
+    '''
+    from common import endpoints, ranged
+    from common.instrumentation import RunRecorder
+    from common.session import make_session
+    from emdb.emdb_downloader import emdb_stub, emdb_stub_async
+    from pdb.pdb_cif_dataloader import pdb_stub
+
+    endpoints.set_mirror_root(root)
+    ranged.SEGMENT_MIN_SIZE = segment_size
+    options = MODES[mode]
+    threads = workers if options.get('workers') else 1
+    recorder = RunRecorder()
+    session = make_session(pool_maxsize=max(10, threads * 4))
+    baseline_rss = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as output_dir, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.time()
+        if options['archive'] == 'pdb':
+            pdb_stub(accession_list, output_dir, workers=threads, session=session, hedge=options.get('hedge', False),
+                     unzip=options.get('unzip', False), keep_gz=False, parse_structures=options.get('parse', False), recorder=recorder)
+        elif threads > 1:
+            emdb_stub_async(accession_list, output_dir, debug=False, session=session, concurrency=threads, segments=options.get('segments', 1),
+                            unzip=options.get('unzip', False), keep_gz=False, recorder=recorder)
+        else:
+            emdb_stub(accession_list, output_dir, debug=False, session=session, segments=options.get('segments', 1),
+                      unzip=options.get('unzip', False), keep_gz=False, recorder=recorder)
+        seconds = time.time() - start_time
+
+    summary = recorder.summary()
+    requests = summary['kinds'].get('request', {'count': 0, 'errors': 0, 'retries': 0, 'seconds': {}})
+    downloads = summary['kinds'].get('download', {'count': 0})
+    not_found = sum(1 for event in recorder.events if event['kind'] == 'request' and event.get('status') == 404)
+    return {
+        'mode': mode,
+        'entries': len(accession_list),
+        'files': downloads['count'],
+        'bytes': summary['bytes'],
+        'seconds': seconds,
+        'mb_per_s': summary['bytes'] / seconds / 1e6,
+        'files_per_s': downloads['count'] / seconds,
+        'requests': requests['count'],
+        'not_found': not_found,
+        # 404s are the emulated misses falling through to the next mirror, not failures
+        'errors': requests['errors'] - not_found,
+        'retries': requests['retries'],
+        'p50_latency': requests['seconds'].get('p50'),
+        'p95_latency': requests['seconds'].get('p95'),
+        'p99_latency': requests['seconds'].get('p99'),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_growth_mb': peak_rss_mb() - baseline_rss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+        output:
+            - list of messages, one per measurement of a mode that regressed by more than tolerance
+    '''
+    previous = {result['mode']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['mode'])
+        if before is None:
+            continue
+        if before['mb_per_s'] and result['mb_per_s'] < before['mb_per_s'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} MB/s, was {:.1f}".format(result['mode'], result['mb_per_s'], before['mb_per_s']))
+        for key in LOWER_IS_BETTER:
+            if before.get(key) and result.get(key) and result[key] > before[key] * (1 + tolerance):
+                regressions.append("{}: {} {:.3f}, was {:.3f}".format(result['mode'], key, result[key], before[key]))
+    return regressions
+
+
+def run_benchmark(args):
+    '''
+        description:
+            Starts the emulator, runs every selected mode in its own process and prints one line per mode.
+
+        output:
+            - results: list of result dicts of run_mode
+    '''
+    pdb_ids = ["{}{:03x}".format(1 + index // 4096 % 9, index % 4096) for index in range(args.pdb_entries)]
+    emdb_ids = [str(10000 + index) for index in range(args.emdb_entries)]
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with emulator_from_arguments(args) as emulator:
+        print("Emulated mirrors at {}: {:.0f} ms latency, {} MB/s per response, {:.0%} misses, {:.0%} errors, {:.1f} MB maps".format(
+            emulator.url, args.latency * 1000, args.bandwidth or "unlimited", args.miss_rate, args.error_rate, len(emulator.map) / 1e6))
+        print("{:>16} {:>9} {:>6} {:>9} {:>8} {:>8} {:>8} {:>8} {:>6} {:>7} {:>8} {:>9}".format(
+            "mode", "seconds", "files", "MB/s", "files/s", "p50 ms", "p95 ms", "p99 ms", "404s", "errors", "retries", "peak MB"))
+        for mode in args.modes:
+            accession_list = pdb_ids if MODES[mode]['archive'] == 'pdb' else emdb_ids
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(run_mode, mode, emulator.url, accession_list, args.workers, args.segment_size).result()
+            results.append(result)
+            print("{:>16} {:>9.2f} {:>6} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6} {:>7} {:>8} {:>9.1f}".format(
+                mode, result['seconds'], result['files'], result['mb_per_s'], result['files_per_s'], (result['p50_latency'] or 0) * 1000,
+                (result['p95_latency'] or 0) * 1000, (result['p99_latency'] or 0) * 1000, result['not_found'], result['errors'],
+                result['retries'], result['peak_rss_mb']))
+    return results
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='download_modes', description='Throughput, latency and peak memory of every download mode against emulated mirrors')
+    parser.add_argument('--modes', help="Modes to run [default: all]", nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--pdb_entries', help="PDB entries downloaded by the pdb modes [default: %(default)s]", type=int, default=100)
+    parser.add_argument('--emdb_entries', help="EMDB entries downloaded by the emdb modes [default: %(default)s]", type=int, default=8)
+    parser.add_argument('--workers', help="Parallel downloads of the concurrent modes [default: %(default)s]", type=int, default=8)
+    parser.add_argument('--segment_size', help="Minimum bytes per segment of the ranged map downloads [default: %(default)s]", type=int, default=4 * 1024 * 1024)
+    add_emulator_arguments(parser)
+    parser.add_argument('--output', help="Write the results as JSON to FILE", metavar='FILE')
+    parser.add_argument('--baseline', help="Earlier --output FILE to compare with; exits with status 1 on a regression", metavar='FILE')
+    parser.add_argument('--tolerance', help="Relative change allowed against the baseline [default: %(default)s]", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')}, 'results': results}, output_file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for message in regressions:
+            print("REGRESSION {}".format(message))
+        if regressions:
+            sys.exit(1)
+        print("No regression against {} (tolerance {:.0%}).".format(args.baseline, args.tolerance))
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
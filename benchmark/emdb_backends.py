@@ -0,0 +1,129 @@
+'''
+    Benchmark of the sync (emdb_stub) and asyncio (emdb_stub_async) EMDB backends against a
+    local stand-in HTTP server, so the numbers do not depend on the public mirrors.
+
+    usage (from the repository root):
+        python -m benchmark.emdb_backends --entries 50 --latency 0.05 --map_size 1048576
+'''
+import argparse
+import http.server
+import tempfile
+import threading
+import time
+
+from common.session import make_session
+from emdb import emdb_downloader
+
+
+def make_handler(latency, map_size):
+    '''
+        description:
+            Builds a request handler serving the PDBJ EMDB layout for any accession id:
+            the entry directory, emd_<id>.map.gz (map_size bytes) and emd_<id>.png.
+            Every response is delayed by latency seconds to emulate a remote mirror.
+    '''
+    payload = b"\0" * map_size
+
+    class EMDBHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency)
+            if self.path.endswith(".map.gz"):
+                body = payload
+            elif self.path.endswith(".png"):
+                body = b"\x89PNG" + b"\0" * 1024
+            elif self.path.endswith("/"):
+                body = b"<html></html>"
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return EMDBHandler
+
+
+def start_server(latency, map_size):
+    '''
+        description:
+            Starts the stand-in mirror on a free local port in a daemon thread.
+
+        output:
+            - server: running http.server.ThreadingHTTPServer
+    '''
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), make_handler(latency, map_size))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def local_sources(base_url):
+    '''
+        description:
+            EMDB_SOURCES table pointing the PDBJ layout at the local server.
+    '''
+    return [("PDBJ", "Downloaading from EM Resource of PDBJ---- \n", {
+        "probe": base_url + "/EMD-{0}/",
+        "map": base_url + "/EMD-{0}/map/emd_{0}.map.gz",
+        "image": base_url + "/EMD-{0}/images/emd_{0}.png",
+        "header": base_url + "/EMD-{0}/header/emd-{0}.xml",
+    })]
+
+
+def run_benchmark(entries=50, latency=0.05, map_size=1024 * 1024, concurrency=8):
+    '''
+        description:
+            Downloads the same synthetic batch (maps and images) with both backends and prints wall time.
+
+        output:
+            - results: dict of backend name to seconds taken
+    '''
+    server = start_server(latency, map_size)
+    original_sources = emdb_downloader.EMDB_SOURCES
+    emdb_downloader.EMDB_SOURCES = local_sources("http://127.0.0.1:{}".format(server.server_port))
+    accession_list = [str(10000 + index) for index in range(entries)]
+
+    results = {}
+    try:
+        for name, stub, kwargs in (
+                ("sync", emdb_downloader.emdb_stub, {}),
+                ("async", emdb_downloader.emdb_stub_async, {"concurrency": concurrency})):
+            with tempfile.TemporaryDirectory() as output_directory:
+                session = make_session(pool_maxsize=max(10, concurrency))
+                start_time = time.time()
+                stub(accession_list, output_directory, header=False, debug=False, session=session, **kwargs)
+                results[name] = time.time() - start_time
+            print("{:>6}: {:.2f}s for {} entries ({:.1f} entries/s)".format(name, results[name], entries, entries / results[name]))
+    finally:
+        emdb_downloader.EMDB_SOURCES = original_sources
+        server.shutdown()
+
+    print("speedup: {:.1f}x".format(results["sync"] / results["async"]))
+    return results
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='emdb_backends', description='Benchmark of the sync and async EMDB download backends')
+    parser.add_argument('--entries', help="Number of synthetic EMDB entries [default: %(default)s]", type=int, default=50)
+    parser.add_argument('--latency', help="Seconds of latency added to every response [default: %(default)s]", type=float, default=0.05)
+    parser.add_argument('--map_size', help="Size of every synthetic map in bytes [default: %(default)s]", type=int, default=1024 * 1024)
+    parser.add_argument('--concurrency', help="Requests in flight for the async backend [default: %(default)s]", type=int, default=8)
+    args = parser.parse_args()
+
+    run_benchmark(args.entries, args.latency, args.map_size, args.concurrency)
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+'''
+    Local HTTP server emulating the archive mirrors the downloaders talk to (RCSB, PDBe, PDBj, wwPDB and the
+    EMDB sources), with configurable latency, bandwidth, 404 and 503 rates and large synthetic maps.
+
+    Requests are served under the public host name as first path component, the layout routed to by
+    common.endpoints.set_mirror_root, so every url of the downloaders reaches it unchanged otherwise:
+        http://127.0.0.1:8000/files.rcsb.org/download/6vxx.pdb.gz
+        http://127.0.0.1:8000/ftp.pdbj.org/pub/emdb/structures/EMD-11082/map/emd_11082.map.gz
+
+    usage (from the repository root):
+        python -m benchmark.mirror_emulator --port 8000 --latency 0.05 --bandwidth 20 --miss_rate 0.1
+        DATALOADER_BASE_URLS=http://127.0.0.1:8000 python dataloader.py -if pdb -i 6vxx -o out
+'''
+import argparse
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from urllib.parse import parse_qs, urlsplit
+
+# bytes written per throttled write, the granularity of the bandwidth limit
+WRITE_SIZE = 64 * 1024
+
+# synthetic files: PDB/mmCIF models and EMDB maps, images, headers, entry pages and RCSB API answers
+PDB_FILE = re.compile(r'/(?:pdb)?(\w{4})\.(?:ent|pdb)(\.gz)?$')
+CIF_FILE = re.compile(r'/(\w{4})(?:_updated)?\.cif(\.gz)?$')
+MAP_FILE = re.compile(r'/emd_(\d+)\.map(\.gz)?$')
+IMAGE_FILE = re.compile(r'/emd_(\d+)\.png$')
+HEADER_FILE = re.compile(r'/(?:emd-(\d+)\.xml|EMD-(\d+)/xml)$')
+BUNDLE_FILE = re.compile(r'/EMD-(\d+)/bundlezip$')
+EMDB_ENTRY = re.compile(r'/EMD-(\d+)/?$')
+PDB_ENTRY = re.compile(r'/(?:structure|entry/pdb|mine/summary)/(\w{4})$')
+PDBJ_DOWNLOAD = "/rest/downloadPDBfile"
+
+
+class HostProfile:
+    '''
+        description:
+            How one emulated mirror behaves.
+
+        input:
+            - latency: seconds before every response (default=0.0)
+            - bandwidth: body bytes per second of every response (default=None, unlimited)
+            - miss_rate: fraction of the entries the mirror answers 404 for; the same entries every time (default=0.0)
+            - error_rate: fraction of the requests answered 503, at random (default=0.0)
+    '''
+
+    def __init__(self, latency=0.0, bandwidth=None, miss_rate=0.0, error_rate=0.0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.miss_rate = miss_rate
+        self.error_rate = error_rate
+
+    def misses(self, host, accession):
+        # hashed rather than random, so a retry or a second run sees the same entries missing
+        digest = hashlib.md5("{}/{}".format(host, accession.lower()).encode()).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.miss_rate
+
+
+def synthetic_pdb(atoms):
+    lines = ["HEADER    SYNTHETIC ENTRY"]
+    for serial in range(1, atoms + 1):
+        lines.append("ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00 20.00           C".format(
+            serial % 100000, (serial // 8 + 1) % 10000, serial % 97 * 1.1, serial % 89 * 1.3, serial % 83 * 1.7))
+    return ("\n".join(lines) + "\nEND\n").encode()
+
+
+def synthetic_cif(atoms):
+    lines = ["data_SYN", "loop_"] + ["_atom_site." + item for item in (
+        "group_PDB", "id", "type_symbol", "label_atom_id", "label_comp_id", "label_asym_id", "Cartn_x", "Cartn_y",
+        "Cartn_z", "occupancy", "B_iso_or_equiv", "auth_seq_id", "auth_asym_id", "pdbx_PDB_model_num")]
+    for serial in range(1, atoms + 1):
+        lines.append("ATOM {} C CA ALA A {:.3f} {:.3f} {:.3f} 1.00 20.00 {} A 1".format(
+            serial, serial % 97 * 1.1, serial % 89 * 1.3, serial % 83 * 1.7, serial // 8 + 1))
+    return ("\n".join(lines) + "\n#\n").encode()
+
+
+def synthetic_map(size):
+    '''
+        output:
+            - gzipped map of size bytes: an MRC header then noise, which barely compresses, so the gzip
+              is about as large as the map and the bandwidth limit applies to realistic byte counts
+    '''
+    rng = random.Random(0)
+    block = rng.randbytes(1024 * 1024)
+    header = bytearray(1024)
+    edge = max(int(round((max(size - 1024, 0) / 4) ** (1 / 3))), 1)
+    for index in range(3):
+        header[index * 4:index * 4 + 4] = edge.to_bytes(4, 'little')
+    header[12:16] = (2).to_bytes(4, 'little')
+    header[208:212] = b'MAP '
+    raw = io.BytesIO()
+    with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=1, mtime=0) as map_file:
+        map_file.write(bytes(header))
+        remaining = max(size - 1024, 0)
+        while remaining > 0:
+            map_file.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+    return raw.getvalue()
+
+
+def synthetic_header(accession, fitted):
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<emdEntry emdbId="EMD-{0}">
+  <deposition>
+    <title>Synthetic entry {0}</title>
+    <depositionDate>2020-01-01</depositionDate>
+    <headerReleaseDate>2020-02-01</headerReleaseDate>
+    <mapReleaseDate>2020-02-01</mapReleaseDate>
+    <fittedPDBEntryIdList><fittedPDBEntryId>{1}</fittedPDBEntryId></fittedPDBEntryIdList>
+    <primaryReference published="true">
+      <articleTitle>Synthetic article {0}</articleTitle>
+      <externalReference type="pubmed">1</externalReference>
+      <externalReference type="doi">doi:10.0/{0}</externalReference>
+      <externalReference type="issn">0000-0000</externalReference>
+    </primaryReference>
+  </deposition>
+</emdEntry>
+""".format(accession, fitted).encode()
+
+
+class MirrorEmulator:
+    '''
+        description:
+            The archive mirrors as one local ThreadingHTTPServer. Models are generated once; maps once per
+            size. Every file answers HEAD, GET with ETag, 'Accept-Ranges: bytes' and single byte ranges,
+            so the ranged, resumable map downloads are exercised too.
+
+        input:
+            - port: TCP port, 0 picks a free one (default=0)
+            - profile: HostProfile of every host without its own (default=HostProfile())
+            - profiles: dict of host name to HostProfile (default=None)
+            - map_size: bytes of every map before gzip (default=16 MB)
+            - atoms: atoms of every model (default=2000)
+    '''
+
+    def __init__(self, port=0, profile=None, profiles=None, map_size=16 * 1024 * 1024, atoms=2000):
+        self.profile = profile or HostProfile()
+        self.profiles = dict(profiles or {})
+        self.pdb = gzip.compress(synthetic_pdb(atoms), mtime=0)
+        self.cif_text = synthetic_cif(atoms)
+        self.cif = gzip.compress(self.cif_text, mtime=0)
+        self.map = synthetic_map(map_size)
+        self.image = b"\x89PNG\r\n\x1a\n" + b"\0" * 4096
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def profile_of(self, host):
+        return self.profiles.get(host, self.profile)
+
+    def resolve(self, host, path, query, body=None):
+        '''
+            output:
+                - (accession or None, content type, body) of a request, or None for unknown paths
+        '''
+        if path.endswith(PDBJ_DOWNLOAD):
+            accession = (query.get('id') or [''])[0]
+            file_format = (query.get('format') or ['pdb'])[0]
+            return accession, 'application/gzip', self.cif if file_format == 'mmcif' else self.pdb
+        if host.startswith("data.") and path.endswith("/graphql"):
+            ids = json.loads(body or b'{}').get('variables', {}).get('ids', [])
+            entries = [{
+                'rcsb_id': accession,
+                'struct': {'title': "Synthetic entry {}".format(accession)},
+                'rcsb_accession_info': {'deposit_date': "2020-01-01T00:00:00Z", 'initial_release_date': "2020-02-01T00:00:00Z"},
+                'rcsb_entry_container_identifiers': {'emdb_ids': ["EMD-{}".format(10000 + int(hashlib.md5(accession.encode()).hexdigest()[:4], 16) % 1000)]},
+                'rcsb_primary_citation': {'title': "Synthetic article", 'pdbx_database_id_DOI': "10.0/{}".format(accession)},
+            } for accession in ids if not self.profile_of(host).misses(host, accession)]
+            return None, 'application/json', json.dumps({'data': {'entries': entries}}).encode()
+        for pattern, content_type in ((MAP_FILE, 'application/gzip'), (IMAGE_FILE, 'image/png'), (HEADER_FILE, 'text/xml'),
+                                      (BUNDLE_FILE, 'application/zip'), (PDB_FILE, 'application/gzip'), (CIF_FILE, 'chemical/x-cif'),
+                                      (PDB_ENTRY, 'text/html'), (EMDB_ENTRY, 'text/html')):
+            match = pattern.search(path)
+            if match is None:
+                continue
+            accession = next(group for group in match.groups() if group)
+            if pattern is MAP_FILE:
+                return accession, content_type, self.map
+            if pattern is IMAGE_FILE:
+                return accession, content_type, self.image
+            if pattern is HEADER_FILE:
+                return accession, content_type, synthetic_header(accession, "1abc")
+            if pattern is BUNDLE_FILE:
+                bundle = io.BytesIO()
+                with zipfile.ZipFile(bundle, 'w') as zip_file:
+                    zip_file.writestr("EMD-{0}/images/emd_{0}.png".format(accession), self.image)
+                return accession, content_type, bundle.getvalue()
+            if pattern is PDB_FILE:
+                return accession, content_type, self.pdb if match.group(2) else gzip.decompress(self.pdb)
+            if pattern is CIF_FILE:
+                return accession, content_type, self.cif if match.group(2) else self.cif_text
+            return accession, content_type, '<html><h1 id="structureTitle">Synthetic entry {}</h1></html>'.format(accession).encode()
+        return None
+
+    def _handler(self):
+        emulator = self
+
+        class MirrorHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _empty(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def _serve(self, send_body, body=None):
+                with emulator._lock:
+                    emulator.requests += 1
+                parts = urlsplit(self.path)
+                host, _, path = parts.path.lstrip("/").partition("/")
+                profile = emulator.profile_of(host)
+                time.sleep(profile.latency)
+                if profile.error_rate and random.random() < profile.error_rate:
+                    return self._empty(503)
+                resolved = emulator.resolve(host, "/" + path, parse_qs(parts.query), body)
+                if resolved is None or (resolved[0] and profile.misses(host, resolved[0])):
+                    return self._empty(404)
+                accession, content_type, content = resolved
+
+                etag = '"{}"'.format(hashlib.md5(content[:65536] + str(len(content)).encode()).hexdigest())
+                start, end, status = 0, len(content) - 1, 200
+                match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get('Range', ''))
+                if match and self.headers.get('If-Range', etag) == etag and len(content):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)) if match.group(2) else len(content) - 1, len(content) - 1)
+                    status = 206
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(end - start + 1))
+                if status == 206:
+                    self.send_header('Content-Range', "bytes {}-{}/{}".format(start, end, len(content)))
+                self.end_headers()
+                if send_body:
+                    self._write(memoryview(content)[start:end + 1], profile.bandwidth)
+
+            def _write(self, data, bandwidth):
+                start_time = time.monotonic()
+                for offset in range(0, len(data), WRITE_SIZE):
+                    self.wfile.write(data[offset:offset + WRITE_SIZE])
+                    if bandwidth:
+                        ahead = (offset + WRITE_SIZE) / bandwidth - (time.monotonic() - start_time)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+            def handle(self):
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client closed a losing hedged request, or a kept-alive connection
+                    pass
+
+            def do_HEAD(self):
+                self._serve(False)
+
+            def do_GET(self):
+                self._serve(True)
+
+            def do_POST(self):
+                self._serve(True, self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def log_message(self, *args):
+                pass
+
+        return MirrorHandler
+
+
+def parse_profile(spec):
+    '''
+        output:
+            - (host, HostProfile) of 'host:latency=0.1,bandwidth=5,miss_rate=0.2,error_rate=0' (bandwidth in MB/s)
+    '''
+    host, _, settings = spec.partition(":")
+    values = {}
+    for setting in filter(None, settings.split(",")):
+        key, _, value = setting.partition("=")
+        values[key.strip()] = float(value)
+    if 'bandwidth' in values:
+        values['bandwidth'] = values['bandwidth'] * 1e6 or None
+    return host, HostProfile(**values)
+
+
+def add_emulator_arguments(parser):
+    parser.add_argument('--latency', help="Seconds before every response [default: %(default)s]", type=float, default=0.02)
+    parser.add_argument('--bandwidth', help="MB/s of every response, 0 for unlimited [default: %(default)s]", type=float, default=50.0)
+    parser.add_argument('--miss_rate', help="Fraction of entries every mirror answers 404 for [default: %(default)s]", type=float, default=0.1)
+    parser.add_argument('--error_rate', help="Fraction of requests answered 503 [default: %(default)s]", type=float, default=0.0)
+    parser.add_argument('--map_size', help="Size of every synthetic map in bytes [default: %(default)s]", type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--atoms', help="Atoms of every synthetic model [default: %(default)s]", type=int, default=2000)
+    parser.add_argument('--profile', help="Behaviour of one host, e.g. files.rcsb.org:latency=0.2,miss_rate=0.5 (repeatable)",
+                        action='append', default=[], metavar='HOST:KEY=VALUE,...')
+
+
+def emulator_from_arguments(args, port=0):
+    profile = HostProfile(args.latency, args.bandwidth * 1e6 or None, args.miss_rate, args.error_rate)
+    return MirrorEmulator(port, profile, dict(parse_profile(spec) for spec in args.profile), args.map_size, args.atoms)
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='mirror_emulator', description='Local emulator of the RCSB/PDBe/PDBj/wwPDB/EMDB mirrors')
+    parser.add_argument('--port', help="Port to listen on [default: %(default)s]", type=int, default=8000)
+    add_emulator_arguments(parser)
+    args = parser.parse_args()
+
+    emulator = emulator_from_arguments(args, args.port).start()
+    print("Serving the archive mirrors at {0}; point the downloaders at it with --base_url {0}".format(emulator.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+'''
+    Exercises the resumable / parallel-segment map download (common.ranged.ranged_download) against a
+    local range-capable HTTP server: the first attempt is cut off part-way, the second resumes from the
+    partial file, and the result is compared with the served bytes.
+
+    usage (from the repository root):
+        python -m benchmark.ranged_downloads --size 67108864 --segments 4
+'''
+import argparse
+import hashlib
+import http.server
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+
+from common.ranged import ranged_download
+from common.session import make_session
+
+
+def make_range_handler(files, drop_after=None):
+    '''
+        description:
+            Builds a request handler serving files (dict of path to bytes) with HEAD, ETag,
+            'Accept-Ranges: bytes', single byte-range GETs (206) and If-Range.
+
+        input:
+            - files: dict mapping request path to file content
+            - drop_after: if set, a dict {'bytes': n}; every response is cut after n body bytes
+              while it is not None, to emulate an interrupted transfer
+    '''
+
+    class RangeHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _headers(self, body):
+            etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+            start, end = 0, len(body) - 1
+            status = 200
+            match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get('Range', ''))
+            if match and self.headers.get('If-Range', etag) == etag:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else len(body) - 1
+                status = 206
+            self.send_response(status)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(end - start + 1))
+            if status == 206:
+                self.send_header('Content-Range', "bytes {}-{}/{}".format(start, end, len(body)))
+            self.end_headers()
+            return start, end
+
+        def _lookup(self):
+            body = files.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            return body
+
+        def do_HEAD(self):
+            body = self._lookup()
+            if body is not None:
+                self._headers(body)
+
+        def do_GET(self):
+            body = self._lookup()
+            if body is None:
+                return
+            start, end = self._headers(body)
+            limit = drop_after['bytes'] if drop_after and drop_after['bytes'] is not None else None
+            data = body[start:end + 1]
+            if limit is not None and len(data) > limit:
+                self.wfile.write(data[:limit])
+                self.wfile.flush()
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return RangeHandler
+
+
+def start_range_server(files, drop_after=None):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), make_range_handler(files, drop_after))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_exercise(size=64 * 1024 * 1024, segments=4):
+    '''
+        description:
+            Interrupted download, then resume, then integrity check; prints timings.
+
+        output:
+            - True if the resumed file matches the served content
+    '''
+    content = os.urandom(size)
+    drop_after = {'bytes': size // (3 * segments)}
+    server = start_range_server({"/emd_1.map.gz": content}, drop_after)
+    url = "http://127.0.0.1:{}/emd_1.map.gz".format(server.server_port)
+    session = make_session(retries=0)
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        output_path = os.path.join(output_directory, "emd_1.map.gz")
+        try:
+            ranged_download(url, output_path, session, segments, min_segment_size=1)
+        except requests.RequestException as error:
+            print("first attempt interrupted: {}".format(type(error).__name__))
+        print("partial bytes kept: {}".format(os.path.exists(output_path + ".part")))
+
+        drop_after['bytes'] = None
+        start_time = time.time()
+        status_code = ranged_download(url, output_path, session, segments, min_segment_size=1)
+        elapsed = time.time() - start_time
+        with open(output_path, 'rb') as output_file:
+            matches = output_file.read() == content
+        print("resumed: HTTP {} in {:.2f}s, content matches: {}, leftovers: {}".format(
+            status_code, elapsed, matches, sorted(name for name in os.listdir(output_directory) if name.endswith(('.part', '.json')))))
+
+    server.shutdown()
+    return matches
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='ranged_downloads', description='Resumable and segmented download exercise against a local range server')
+    parser.add_argument('--size', help="Size of the served file in bytes [default: %(default)s]", type=int, default=64 * 1024 * 1024)
+    parser.add_argument('--segments', help="Parallel byte ranges [default: %(default)s]", type=int, default=4)
+    args = parser.parse_args()
+
+    run_exercise(args.size, args.segments)
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
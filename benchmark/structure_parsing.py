@@ -0,0 +1,136 @@
+'''
+    Atoms per second of pdb.structure.load_structure over a folder of downloaded PDB/mmCIF files, against
+    a per-line Python parser, for the first parse and for loads from the .npy sidecar.
+
+    usage (from the repository root):
+        python -m benchmark.structure_parsing --input downloads/
+        python -m benchmark.structure_parsing --entries 20 --atoms 50000     (synthetic files)
+
+    With --input the sidecars are written next to the files, as load_structure does after a download.
+'''
+import argparse
+import gzip
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+
+from common.gunzip import gunzip_bytes, unzipped_path
+from pdb.structure import ATOM_DTYPE, cache_path, load_structure
+
+STRUCTURE_FILE = re.compile(r'^(?:pdb\w{4}\.ent|\w{4}\.cif)(?:\.gz)?$')
+
+
+def write_structures(directory, entries, atoms):
+    '''
+        description:
+            Writes entries gzipped PDB files and the same structures as mmCIF files, atoms atoms each.
+    '''
+    rng = np.random.default_rng(0)
+    for index in range(entries):
+        coords = rng.uniform(-99, 99, (atoms, 3))
+        pdb_lines, cif_lines = [], ["data_SYN", "loop_"] + ["_atom_site." + item for item in (
+            "group_PDB", "id", "type_symbol", "label_atom_id", "label_comp_id", "label_asym_id", "Cartn_x", "Cartn_y",
+            "Cartn_z", "occupancy", "B_iso_or_equiv", "auth_seq_id", "auth_asym_id", "pdbx_PDB_model_num")]
+        for serial, (x, y, z) in enumerate(coords, 1):
+            residue = serial // 8 + 1
+            pdb_lines.append("ATOM  {:5d}  CA  ALA A{:4d}    {:8.3f}{:8.3f}{:8.3f}  1.00 20.00           C".format(serial % 100000, residue % 10000, x, y, z))
+            cif_lines.append("ATOM {} C CA ALA A {:.3f} {:.3f} {:.3f} 1.00 20.00 {} A 1".format(serial, x, y, z, residue))
+        cif_lines.append("#")
+        name = "{:04d}".format(index)
+        with gzip.open(os.path.join(directory, "pdb{}.ent.gz".format(name)), 'wt') as pdb_file:
+            pdb_file.write("\n".join(pdb_lines) + "\nEND\n")
+        with gzip.open(os.path.join(directory, "{}.cif.gz".format(name)), 'wt') as cif_file:
+            cif_file.write("\n".join(cif_lines) + "\n")
+
+
+def parse_loop(path):
+    # reference: one Python iteration per line, the way the text is usually read, filling the same fields
+    with open(path, 'rb') as structure_file:
+        lines = gunzip_bytes(structure_file.read()).decode().splitlines()
+    atoms = []
+    if unzipped_path(path).endswith(".cif"):
+        items = [line.strip()[len("_atom_site."):] for line in lines if line.startswith("_atom_site.")]
+        for line in lines:
+            if line.startswith(("ATOM", "HETATM")):
+                values = dict(zip(items, line.split()))
+                atoms.append(((float(values['Cartn_x']), float(values['Cartn_y']), float(values['Cartn_z'])), values['type_symbol'],
+                              values['label_atom_id'], values['label_comp_id'], int(values['auth_seq_id']), '', values['auth_asym_id'],
+                              float(values['B_iso_or_equiv']), float(values['occupancy']), values['group_PDB'] == 'HETATM'))
+    else:
+        for line in lines:
+            if line.startswith("ENDMDL"):
+                break
+            if line.startswith(("ATOM  ", "HETATM")):
+                atoms.append(((float(line[30:38]), float(line[38:46]), float(line[46:54])), line[76:78].strip(),
+                              line[12:16].strip(), line[17:20].strip(), int(line[22:26]), line[26:27].strip(), line[21:22],
+                              float(line[60:66]), float(line[54:60]), line.startswith("HETATM")))
+    return np.array(atoms, dtype=ATOM_DTYPE)
+
+
+def measure(paths, load):
+    '''
+        output:
+            - (atoms, seconds)
+    '''
+    start_time = time.time()
+    atoms = 0
+    for path in paths:
+        atoms += len(load(path)['coords'])
+    return atoms, time.time() - start_time
+
+
+def run_benchmark(direc):
+    '''
+        description:
+            Parses every structure file below direc with each loader and prints atoms/s per format.
+
+        output:
+            - results: dict of (format, loader name) to atoms per second
+    '''
+    paths = sorted(os.path.join(folder, file) for folder, subs, files in os.walk(direc) for file in files if STRUCTURE_FILE.match(file))
+    results = {}
+    for file_format in ("pdb", "cif"):
+        selected = [path for path in paths if unzipped_path(path).endswith(".cif") == (file_format == "cif")]
+        if not selected:
+            continue
+        for path in selected:
+            if os.path.exists(cache_path(path)):
+                os.remove(cache_path(path))
+        loaders = (
+            ("per-line loop", parse_loop),
+            ("vectorized", lambda path: load_structure(path, cache=False)),
+            ("first load", load_structure),
+            ("cached load", load_structure),
+        )
+        for name, load in loaders:
+            atoms, seconds = measure(selected, load)
+            results[(file_format, name)] = atoms / seconds
+            print("{:>4} {:>14}: {} atoms in {} files, {:.3f}s ({:.2f} M atoms/s)".format(
+                file_format, name, atoms, len(selected), seconds, atoms / seconds / 1e6))
+    return results
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='structure_parsing', description='Atoms per second of the PDB/mmCIF parser against a per-line loop')
+    parser.add_argument('-i', '--input', help="Folder of downloaded pdb/cif files (synthetic files are generated if omitted)", metavar='DIR')
+    parser.add_argument('--entries', help="Number of synthetic entries of each format [default: %(default)s]", type=int, default=20)
+    parser.add_argument('--atoms', help="Atoms per synthetic entry [default: %(default)s]", type=int, default=50000)
+    args = parser.parse_args()
+
+    if args.input:
+        run_benchmark(args.input)
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        write_structures(directory, args.entries, args.atoms)
+        run_benchmark(directory)
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
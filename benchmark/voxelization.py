@@ -0,0 +1,148 @@
+'''
+    Speed of volume.voxelize (density and label volumes of a model) against the per-atom Python loop that
+    rasterizes one atom at a time, on a synthetic model or on a downloaded structure file.
+
+    usage (from the repository root):
+        python -m benchmark.voxelization --atoms 20000 --shape 160 --resolution 4
+        python -m benchmark.voxelization --model pdb6vxx.ent.gz --map emd_21375.map
+'''
+import argparse
+import itertools
+import time
+
+import numpy as np
+
+from volume.voxelize import CUTOFF_SIGMAS, SIGMA_PER_RESOLUTION, Grid, density_volume, label_volume
+
+
+def synthetic_model(atoms, grid):
+    '''
+        output:
+            - (atoms, 3) x, y, z positions in Angstrom of atoms clustered like chains inside the grid
+    '''
+    rng = np.random.default_rng(0)
+    extent = np.array(grid.shape[::-1]) * grid.voxel_size[::-1]
+    # random walks of 1.5 Angstrom steps, like the C-alpha trace of a chain
+    chains = max(atoms // 1000, 1)
+    starts = rng.uniform(0.2, 0.8, (chains, 1, 3)) * extent
+    steps = rng.normal(0, 1.5 / np.sqrt(3), (chains, -(-atoms // chains), 3))
+    coords = (starts + np.cumsum(steps, axis=1)).reshape(-1, 3)[:atoms]
+    return np.clip(coords, 0, extent - 1e-3) + grid.corner[::-1]
+
+
+def density_loop(coords, grid, sigma, weights):
+    # reference: every atom visits the voxels of its cutoff box one at a time
+    density = np.zeros(grid.shape, dtype=np.float32)
+    cutoff = CUTOFF_SIGMAS * sigma
+    reach = np.ceil(cutoff / grid.voxel_size).astype(int)
+    for point, weight in zip(grid.to_voxels(coords), weights):
+        center = np.floor(point + 0.5).astype(int)
+        for offset in itertools.product(*[range(-value, value + 1) for value in reach]):
+            voxel = center + offset
+            if (voxel < 0).any() or (voxel >= grid.shape).any():
+                continue
+            distance = (((voxel - point) * grid.voxel_size) ** 2).sum()
+            if distance <= cutoff ** 2:
+                density[tuple(voxel)] += weight * np.exp(-distance / (2 * sigma ** 2))
+    return density
+
+
+def label_loop(coords, grid, labels, radius):
+    # reference: every atom labels the voxels of its radius box one at a time, the nearest atom wins
+    volume = np.zeros(grid.shape, dtype=np.int32)
+    nearest = np.full(grid.shape, np.inf, dtype=np.float32)
+    reach = np.ceil(radius / grid.voxel_size).astype(int)
+    for point, label in zip(grid.to_voxels(coords), labels):
+        center = np.floor(point + 0.5).astype(int)
+        for offset in itertools.product(*[range(-value, value + 1) for value in reach]):
+            voxel = center + offset
+            if (voxel < 0).any() or (voxel >= grid.shape).any():
+                continue
+            distance = (((voxel - point) * grid.voxel_size) ** 2).sum()
+            if distance <= radius ** 2 and distance < nearest[tuple(voxel)]:
+                nearest[tuple(voxel)] = distance
+                volume[tuple(voxel)] = label
+    return volume
+
+
+def measure(function, *args):
+    '''
+        output:
+            - (result, seconds)
+    '''
+    start_time = time.time()
+    result = function(*args)
+    return result, time.time() - start_time
+
+
+def run_benchmark(coords, grid, resolution=4.0, radius=2.0, loop_atoms=2000):
+    '''
+        description:
+            Voxelizes the model with volume.voxelize and the per-atom loop, checks that they agree and prints
+            atoms/s of each. The loop runs on the first loop_atoms atoms only, and its speed is compared
+            with the vectorized functions on the same atoms.
+
+        output:
+            - results: dict of (volume, implementation) to atoms per second
+    '''
+    sigma = resolution * SIGMA_PER_RESOLUTION
+    rng = np.random.default_rng(0)
+    weights = rng.choice([6, 7, 8, 16], len(coords)).astype(np.float64)
+    labels = np.arange(1, len(coords) + 1, dtype=np.int32)
+    subset = slice(0, min(loop_atoms, len(coords)))
+    print("{} atoms on a {} grid of {} A voxels, resolution {} A, label radius {} A".format(
+        len(coords), "x".join(str(extent) for extent in grid.shape), grid.voxel_size[0], resolution, radius))
+
+    runs = (
+        ("density", "per-atom loop", density_loop, (coords[subset], grid, sigma, weights[subset])),
+        ("density", "vectorized", lambda *args: density_volume(*args[:2], sigma=args[2], weights=args[3]), (coords[subset], grid, sigma, weights[subset])),
+        ("density", "vectorized, all atoms", lambda *args: density_volume(*args[:2], sigma=args[2], weights=args[3]), (coords, grid, sigma, weights)),
+        ("labels", "per-atom loop", label_loop, (coords[subset], grid, labels[subset], radius)),
+        ("labels", "vectorized", lambda *args: label_volume(*args[:2], labels=args[2], radius=args[3]), (coords[subset], grid, labels[subset], radius)),
+        ("labels", "vectorized, all atoms", lambda *args: label_volume(*args[:2], labels=args[2], radius=args[3]), (coords, grid, labels, radius)),
+    )
+    results, volumes = {}, {}
+    for kind, name, function, args in runs:
+        volume, seconds = measure(function, *args)
+        volumes[(kind, name)] = volume
+        results[(kind, name)] = len(args[0]) / seconds
+        print("{:>7} {:>21}: {} atoms in {:.3f}s ({:.0f} atoms/s)".format(kind, name, len(args[0]), seconds, len(args[0]) / seconds))
+
+    density_error = np.abs(volumes[("density", "vectorized")] - volumes[("density", "per-atom loop")]).max()
+    label_mismatch = (volumes[("labels", "vectorized")] != volumes[("labels", "per-atom loop")]).mean()
+    print("max density difference {:.2e}, label mismatch {:.2e} of voxels".format(density_error, label_mismatch))
+    return results
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='voxelization', description='Atoms per second of the vectorized voxelization against a per-atom loop')
+    parser.add_argument('--model', help="Downloaded pdb/cif file to voxelize (a synthetic model is generated if omitted)", metavar='FILE')
+    parser.add_argument('--map', help="Map whose grid the model is voxelized on (default: a cubic grid of --shape voxels)", metavar='FILE')
+    parser.add_argument('--atoms', help="Atoms of the synthetic model [default: %(default)s]", type=int, default=20000)
+    parser.add_argument('--shape', help="Edge of the cubic grid in voxels [default: %(default)s]", type=int, default=160)
+    parser.add_argument('--voxel_size', help="Voxel size of the cubic grid in Angstrom [default: %(default)s]", type=float, default=1.0)
+    parser.add_argument('--resolution', help="Resolution of the density in Angstrom [default: %(default)s]", type=float, default=4.0)
+    parser.add_argument('--radius', help="Label radius in Angstrom [default: %(default)s]", type=float, default=2.0)
+    parser.add_argument('--loop_atoms', help="Atoms given to the per-atom loop [default: %(default)s]", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.map:
+        from volume.store import open_volume
+        with open_volume(args.map) as volume:
+            grid = Grid.of(volume)
+    else:
+        grid = Grid((args.shape,) * 3, args.voxel_size)
+    if args.model:
+        from pdb.structure import load_structure
+        coords = np.asarray(load_structure(args.model)['coords'])
+    else:
+        coords = synthetic_model(args.atoms, grid)
+    run_benchmark(coords, grid, args.resolution, args.radius, args.loop_atoms)
+
+
+def main():
+    parseArguments()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+from common.checksums import pop_checksum, remember_checksum
+from common.fetch import stream_to_file
+from common.session import get_session
+
+# the manifest is written to disk after this many changes (and always by save())
+SAVE_EVERY = 50
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    '''
+        output:
+            - hex sha256 of the file at path, read in chunks
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _materialize(source, destination):
+    # hard link when cache and output share a filesystem, copy otherwise
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ContentCache:
+    '''
+        description:
+            Content-addressed on-disk cache of downloaded files. Blobs are stored once per sha256 under
+            <root>/objects/, and <root>/manifest.json maps every cache key (the output file name, e.g.
+            'pdb101d.ent.gz' or 'emd_1234.map.gz') to its blob, source URL, ETag/Last-Modified, size and
+            last use. When the blobs exceed max_bytes the least recently used ones are evicted.
+
+            A hit is served without any network I/O; with revalidate=True it costs one conditional
+            request (If-None-Match / If-Modified-Since) and a 304 reuses the cached blob.
+
+        input:
+            - root: cache directory
+            - max_bytes: size cap of the stored blobs, None for unlimited (default=None)
+            - revalidate: revalidate hits with a conditional request (default=False)
+    '''
+
+    def __init__(self, root, max_bytes=None, revalidate=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._changes = 0
+        self._manifest_path = os.path.join(root, "manifest.json")
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        try:
+            with open(self._manifest_path) as manifest_file:
+                self._entries = json.load(manifest_file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _blob_path(self, checksum):
+        return os.path.join(self.root, "objects", checksum[:2], checksum)
+
+    def lookup(self, key):
+        '''
+            output:
+                - manifest entry (dict) of key if its blob is present, else None
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not os.path.exists(self._blob_path(entry['sha256'])):
+                return None
+            return dict(entry)
+
+    def restore(self, key, output_path, session=None):
+        '''
+            description:
+                Serves key from the cache into output_path. An output file that already is the cached
+                blob (hard linked) is left untouched, any other file there is replaced by the blob. A blob
+                evicted by a concurrent store() while it is restored is a miss.
+
+            input:
+                - key: cache key
+                - output_path: where the file is expected
+                - session: requests.Session for the conditional request when revalidating
+
+            output:
+                - True on a hit, False on a miss (the caller downloads and calls store()); a revalidation
+                  request that fails for any reason is a miss
+        '''
+        entry = self.lookup(key)
+        if entry is not None and self.revalidate and (entry.get('etag') or entry.get('last_modified')):
+            try:
+                status_code = self._revalidate(key, entry, output_path, session)
+            except Exception:
+                # unreachable, timed out or cut off mid-body: a miss, the caller's own download takes over
+                status_code = None
+            if status_code == 200:
+                # changed upstream; the conditional request already brought the new content
+                with self._lock:
+                    self.misses += 1
+                return True
+            if status_code != 304:
+                entry = None
+
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return False
+
+        blob_path = self._blob_path(entry['sha256'])
+        try:
+            if not (os.path.exists(output_path) and os.path.samefile(blob_path, output_path)):
+                _materialize(blob_path, output_path)
+        except FileNotFoundError:
+            # evicted since the lookup
+            with self._lock:
+                self.misses += 1
+            return False
+        remember_checksum(output_path, entry['sha256'])
+        with self._lock:
+            self.hits += 1
+            # the entry may have been evicted or replaced meanwhile; the restored file is complete either way
+            if key in self._entries:
+                self._entries[key]['last_used'] = time.time()
+                self._changed()
+        return True
+
+    def _revalidate(self, key, entry, output_path, session):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = get_session(session).get(entry['url'], headers=headers, stream=True, allow_redirects=True)
+        try:
+            if response.status_code == 200:
+                stream_to_file(response, output_path)
+                self.store(key, output_path, entry['url'], response.headers)
+        finally:
+            response.close()
+        return response.status_code
+
+    def store(self, key, path, url, headers=None):
+        '''
+            description:
+                Adds the freshly downloaded file at path to the cache under key.
+
+            input:
+                - key: cache key
+                - path: downloaded file
+                - url: URL the file came from
+                - headers: response headers, for ETag and Last-Modified (default=None)
+        '''
+        headers = headers or {}
+        # hashed by the download while streaming, read back only when it was not
+        checksum = pop_checksum(path) or file_checksum(path)
+        blob_path = self._blob_path(checksum)
+        with self._lock:
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                _materialize(path, blob_path)
+            self._entries[key] = {
+                'url': url,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'size': os.path.getsize(path),
+                'sha256': checksum,
+                'last_used': time.time(),
+            }
+            self._evict(keep=checksum)
+            self._changed()
+        # still there for the next reader (e.g. common.journal)
+        remember_checksum(path, checksum)
+
+    def _evict(self, keep=None):
+        if self.max_bytes is None:
+            return
+        blobs = {}
+        for key, entry in self._entries.items():
+            last_used, size, keys = blobs.get(entry['sha256'], (0, entry['size'], []))
+            blobs[entry['sha256']] = (max(last_used, entry['last_used']), size, keys + [key])
+        total = sum(size for last_used, size, keys in blobs.values())
+        for checksum, (last_used, size, keys) in sorted(blobs.items(), key=lambda item: item[1][0]):
+            if total <= self.max_bytes:
+                break
+            if checksum == keep:
+                continue
+            if os.path.exists(self._blob_path(checksum)):
+                os.remove(self._blob_path(checksum))
+            for key in keys:
+                del self._entries[key]
+            total -= size
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= SAVE_EVERY:
+            self.save()
+
+    def save(self):
+        '''
+            description:
+                Writes the manifest to disk (atomically).
+        '''
+        with self._lock:
+            with open(self._manifest_path + ".tmp", 'w') as manifest_file:
+                json.dump(self._entries, manifest_file)
+            os.replace(self._manifest_path + ".tmp", self._manifest_path)
+            self._changes = 0
+
+    def report(self):
+        '''
+            description:
+                Saves the manifest and prints the hit/miss counts of the run.
+        '''
+        self.save()
+        print("Cache: {} hits, {} misses.".format(self.hits, self.misses))
@@ -0,0 +1,41 @@
+import os
+import threading
+from collections import OrderedDict
+
+# files whose checksum is remembered at a time; they are taken right after the download that wrote them
+MAX_REMEMBERED = 1024
+
+_lock = threading.Lock()
+_checksums = OrderedDict()
+
+
+def remember_checksum(path, checksum):
+    '''
+        description:
+            Records the sha256 of a file a download just wrote, hashed from the bytes on their way to
+            disk, so whoever needs the checksum of the file (e.g. common.journal) does not have to read
+            it back. Only the last MAX_REMEMBERED files are kept.
+    '''
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    with _lock:
+        _checksums[key] = (checksum, stat.st_size, stat.st_mtime_ns)
+        _checksums.move_to_end(key)
+        while len(_checksums) > MAX_REMEMBERED:
+            _checksums.popitem(last=False)
+
+
+def pop_checksum(path):
+    '''
+        output:
+            - sha256 remembered for path if the file has not changed since (same size and mtime), else None
+    '''
+    with _lock:
+        remembered = _checksums.pop(os.path.abspath(path), None)
+    if remembered is None or not os.path.exists(path):
+        return None
+    checksum, size, mtime = remembered
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+        return None
+    return checksum
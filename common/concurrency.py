@@ -0,0 +1,72 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+
+class HostLimiter:
+    '''
+        description:
+            Caps the number of in-flight requests per host, so a wide worker pool
+            does not hammer a single mirror (RCSB, PDBe, PDBj, wwPDB, ...).
+
+        input:
+            - per_host: maximum concurrent requests to one host (default=4, None for unlimited)
+    '''
+
+    def __init__(self, per_host=4):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+    @contextmanager
+    def acquire(self, url):
+        '''
+            description:
+                Context manager holding one of the host's slots for the duration of a request.
+
+            input:
+                - url: URL of the request about to be made
+        '''
+        if not self.per_host:
+            yield
+            return
+        semaphore = self._semaphore(urlsplit(url).netloc)
+        with semaphore:
+            yield
+
+
+def ordered_map(func, items, workers=4):
+    '''
+        description:
+            Runs func over items on a bounded thread pool and yields the results in
+            input order, so printed reports stay deterministic regardless of which
+            request finishes first. At most 2 * workers items are in flight (or
+            buffered) at any time, which keeps memory flat on very long batches.
+
+        input:
+            - func: callable applied to each item
+            - items: iterable of work items
+            - workers: number of worker threads (default=4)
+
+        output:
+            - generator of func(item) results, in the order of items
+    '''
+    workers = max(1, workers)
+    pending = deque()
+    iterator = iter(items)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in iterator:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,85 @@
+import os
+import threading
+from urllib.parse import urlsplit
+
+# environment variable read at import: comma-separated 'public=local' base URL pairs, and/or one bare
+# URL every other archive host is routed under (see set_mirror_root)
+BASE_URLS_VARIABLE = "DATALOADER_BASE_URLS"
+
+_lock = threading.Lock()
+_base_urls = {}
+_mirror_root = None
+
+
+def set_base_url(public, local):
+    '''
+        description:
+            Sends every request for a URL under the public base URL to the local one instead,
+            e.g. set_base_url("https://files.rcsb.org", "http://127.0.0.1:8000/rcsb").
+    '''
+    with _lock:
+        _base_urls[public.rstrip("/")] = local.rstrip("/")
+
+
+def set_mirror_root(root):
+    '''
+        description:
+            Routes every archive URL without its own base URL under root, keeping the host as the first
+            path component: 'https://files.rcsb.org/download/6vxx.pdb.gz' is requested from
+            root + '/files.rcsb.org/download/6vxx.pdb.gz' (the layout served by benchmark.mirror_emulator).
+            None routes them to the public archives again.
+    '''
+    global _mirror_root
+    with _lock:
+        _mirror_root = root.rstrip("/") if root else None
+
+
+def reset():
+    '''
+        description:
+            Forgets every base URL and the mirror root.
+    '''
+    global _mirror_root
+    with _lock:
+        _base_urls.clear()
+        _mirror_root = None
+
+
+def configure(specs):
+    '''
+        description:
+            Applies a list of 'public=local' pairs (set_base_url) and bare URLs (set_mirror_root), as given
+            on the command line or in BASE_URLS_VARIABLE.
+    '''
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            continue
+        if "=" in spec:
+            public, local = spec.split("=", 1)
+            set_base_url(public.strip(), local.strip())
+        else:
+            set_mirror_root(spec)
+
+
+def rebase(url):
+    '''
+        description:
+            Function applied to every archive URL (or URL template) before it is requested.
+
+        output:
+            - url under its overridden base URL or the mirror root, else url unchanged
+    '''
+    with _lock:
+        # the longest matching base wins, so a path-specific override beats one for the whole host
+        for public in sorted(_base_urls, key=len, reverse=True):
+            if url.startswith(public) and url[len(public):len(public) + 1] in ("", "/", "?"):
+                return _base_urls[public] + url[len(public):]
+        if _mirror_root is not None and not url.startswith(_mirror_root):
+            parts = urlsplit(url)
+            if parts.scheme and parts.netloc:
+                return _mirror_root + "/" + parts.netloc + url[len(parts.scheme) + 3 + len(parts.netloc):]
+        return url
+
+
+configure(os.environ.get(BASE_URLS_VARIABLE, "").split(","))
@@ -0,0 +1,100 @@
+import hashlib
+import os
+
+from common.checksums import remember_checksum
+from common.gunzip import GunzipWriter
+from common.instrumentation import mirror_of, recorder_of, timed
+from common.session import get_session
+
+# bytes read from the socket and written to disk per iteration; peak memory of a
+# download is bounded by this, not by the size of the file
+CHUNK_SIZE = 1024 * 1024
+
+
+def stream_to_file(response, output_path, chunk_size=CHUNK_SIZE, unzip_path=None, keep_compressed=True):
+    '''
+        description:
+            Streams the body of a (stream=True) response to disk in fixed-size chunks.
+            The bytes go to output_path + '.part' first and are renamed into place
+            only once the body is complete, so an interrupted download never leaves
+            a truncated file under the final name. With unzip_path the body is also
+            gunzipped on the fly (common.gunzip.GunzipWriter) while it arrives.
+            Responses of a session with a common.instrumentation.RunRecorder attached
+            are recorded as a 'download' event (bytes and seconds of the body). The
+            sha256 of the file is computed on the way and left with
+            common.checksums.remember_checksum.
+
+        input:
+            - response: requests.Response opened with stream=True
+            - output_path: final path of the downloaded file
+            - chunk_size: bytes per read (default=CHUNK_SIZE)
+            - unzip_path: path the decompressed body is written to (default=None, not decompressed)
+            - keep_compressed: with unzip_path, also writes output_path (default=True)
+
+        output:
+            - number of bytes received
+    '''
+    part_path = output_path + ".part"
+    written = 0
+    with timed(recorder_of(response), 'download', name=os.path.basename(output_path), url=response.url, mirror=mirror_of(response.url)) as event:
+        output_file = open(part_path, 'wb') if (unzip_path is None or keep_compressed) else None
+        digest = hashlib.sha256()
+        unzip_file = GunzipWriter(unzip_path) if unzip_path is not None else None
+        try:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                if chunk:
+                    if output_file is not None:
+                        output_file.write(chunk)
+                        digest.update(chunk)
+                    if unzip_file is not None:
+                        unzip_file.write(chunk)
+                    written += len(chunk)
+            if unzip_file is not None:
+                unzip_file.close()
+                unzip_file = None
+            if output_file is not None:
+                output_file.close()
+                os.replace(part_path, output_path)
+                remember_checksum(output_path, digest.hexdigest())
+        except BaseException:
+            if unzip_file is not None:
+                unzip_file.abort()
+            if output_file is not None:
+                output_file.close()
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            event['bytes'] = written
+    return written
+
+
+def download_to_file(url, output_path, chunk_size=CHUNK_SIZE, session=None, response_headers=None, unzip_path=None, keep_compressed=True, **request_kwargs):
+    '''
+        description:
+            Requests url and, on a 200 response, streams the body to output_path.
+            Nothing is written for any other status code.
+
+        input:
+            - url: URL of the file
+            - output_path: final path of the downloaded file
+            - chunk_size: bytes per read (default=CHUNK_SIZE)
+            - session: requests.Session to use (default=common.session.get_session())
+            - response_headers: dict updated with the response headers, e.g. for ETag (default=None)
+            - unzip_path: path the body is gunzipped to while downloading (default=None)
+            - keep_compressed: with unzip_path, also keeps output_path (default=True)
+            - request_kwargs: extra keyword arguments forwarded to session.get
+
+        output:
+            - HTTP status code of the response
+    '''
+    request_kwargs.setdefault('allow_redirects', True)
+    response = get_session(session).get(url, stream=True, **request_kwargs)
+    if response_headers is not None:
+        response_headers.update(response.headers)
+    try:
+        if response.status_code == 200:
+            stream_to_file(response, output_path, chunk_size, unzip_path, keep_compressed)
+    finally:
+        response.close()
+    return response.status_code
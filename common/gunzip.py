@@ -0,0 +1,181 @@
+import hashlib
+import os
+import queue
+import threading
+
+try:
+    # Intel ISA-L inflate (pip install isal), several times faster than zlib and a drop-in replacement
+    from isal import isal_zlib as zlib_backend
+except ImportError:
+    import zlib as zlib_backend
+
+from common.checksums import remember_checksum
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# wbits accepting a gzip header and trailer
+GZIP_WBITS = 16 + 15
+
+# compressed chunks waiting for the inflate thread; bounds memory to QUEUE_SIZE * chunk size
+QUEUE_SIZE = 8
+
+
+def unzipped_path(path):
+    '''
+        output:
+            - path without its '.gz' extension ('emd_1234.map.gz' -> 'emd_1234.map')
+    '''
+    return path[:-3] if path.endswith(".gz") else path
+
+
+class GunzipWriter:
+    '''
+        description:
+            File-like sink that decompresses gzip data while it is being written, e.g. chunk by chunk
+            from a download, so the uncompressed file is ready when the last byte arrives instead of
+            needing a second pass over the .gz. Inflating runs on a separate thread (zlib and ISA-L release
+            the GIL), so it overlaps with reading the socket. Concatenated gzip members are handled; data
+            that does not start with the gzip magic (mirrors serving the plain file, or a server that
+            already removed the Content-Encoding) is copied unchanged.
+
+            The output goes to output_path + '.part' and is renamed into place by close(); abort() removes it.
+            The sha256 of the output is computed while it is written and left with common.checksums.remember_checksum.
+
+        input:
+            - output_path: path of the decompressed file
+    '''
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self._part_path = output_path + ".part"
+        self._file = open(self._part_path, 'wb')
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._error = None
+        self._head = b''
+        self._plain = None
+        self._decompressor = None
+        self._digest = hashlib.sha256()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, chunk):
+        if self._error is not None:
+            raise self._error
+        if chunk:
+            self._queue.put(chunk)
+
+    def _run(self):
+        try:
+            for chunk in iter(self._queue.get, None):
+                self._inflate(chunk)
+        except Exception as error:
+            self._error = error
+            # keep consuming so the writer never blocks on a full queue
+            for chunk in iter(self._queue.get, None):
+                pass
+
+    def _output(self, data):
+        self._file.write(data)
+        self._digest.update(data)
+
+    def _inflate(self, data):
+        if self._plain is None:
+            self._head += data
+            if len(self._head) < len(GZIP_MAGIC):
+                return
+            data, self._head = self._head, b''
+            self._plain = not data.startswith(GZIP_MAGIC)
+        if self._plain:
+            self._output(data)
+            return
+        while data:
+            if self._decompressor is None:
+                # gzip writers may pad the end of the file with zeros
+                if not data.strip(b'\0'):
+                    return
+                self._decompressor = zlib_backend.decompressobj(GZIP_WBITS)
+            self._output(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                return
+            data = self._decompressor.unused_data
+            self._decompressor = None
+
+    def _stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+
+    def close(self):
+        '''
+            description:
+                Waits for the remaining data to be inflated and renames the file into place.
+
+            output:
+                - path of the decompressed file
+        '''
+        self._stop()
+        if self._error is None and self._decompressor is not None:
+            self._error = EOFError("{}: compressed stream ended before the end of the gzip member".format(self.output_path))
+        if self._error is None and self._plain is None:
+            # shorter than the gzip magic: nothing to decompress
+            with open(self._part_path, 'wb') as part_file:
+                part_file.write(self._head)
+            self._digest.update(self._head)
+        if self._error is not None:
+            os.remove(self._part_path)
+            raise self._error
+        os.replace(self._part_path, self.output_path)
+        remember_checksum(self.output_path, self._digest.hexdigest())
+        return self.output_path
+
+    def abort(self):
+        self._stop()
+        if os.path.exists(self._part_path):
+            os.remove(self._part_path)
+
+
+def gunzip_bytes(data):
+    '''
+        description:
+            Decompresses gzip data held in memory (concatenated members and zero padding included);
+            data that does not start with the gzip magic is returned unchanged.
+    '''
+    if not data.startswith(GZIP_MAGIC):
+        return data
+    parts = []
+    while data.strip(b'\0'):
+        decompressor = zlib_backend.decompressobj(GZIP_WBITS)
+        parts.append(decompressor.decompress(data))
+        if not decompressor.eof:
+            raise EOFError("compressed data ended before the end of the gzip member")
+        data = decompressor.unused_data
+    return b''.join(parts)
+
+
+def gunzip_file(gz_path, output_path=None, keep_compressed=True, chunk_size=1024 * 1024):
+    '''
+        description:
+            Decompresses a file already on disk, for files that could not be decompressed while
+            downloading (served from the cache, or fetched as parallel byte ranges).
+
+        input:
+            - gz_path: gzip file
+            - output_path: decompressed file (default=gz_path without '.gz')
+            - keep_compressed: keeps gz_path after decompressing (default=True)
+            - chunk_size: bytes per read (default=1 MiB)
+
+        output:
+            - path of the decompressed file
+    '''
+    writer = GunzipWriter(output_path or unzipped_path(gz_path))
+    try:
+        with open(gz_path, 'rb') as gz_file:
+            for chunk in iter(lambda: gz_file.read(chunk_size), b''):
+                writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    output_path = writer.close()
+    if not keep_compressed:
+        os.remove(gz_path)
+    return output_path
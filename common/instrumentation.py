@@ -0,0 +1,220 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# percentiles of the durations written to the run report
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, q):
+    '''
+        output:
+            - q-th percentile of values, linearly interpolated between the closest ranks (None if empty)
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def mirror_of(url):
+    '''
+        output:
+            - host serving url, the name requests are grouped by in the report ('files.rcsb.org')
+    '''
+    return urlsplit(url).netloc or url
+
+
+def distribution(values):
+    summary = {'p{}'.format(q): percentile(values, q) for q in PERCENTILES}
+    summary['mean'] = sum(values) / len(values) if values else None
+    summary['max'] = max(values) if values else None
+    return summary
+
+
+class RunRecorder:
+    '''
+        description:
+            Collects what a run did as a list of events, one dict per HTTP request, body transfer, parse,
+            conversion or rsync transfer, and summarises them into a JSON run report: count, errors,
+            bytes and p50/p95/p99 of the durations per kind and per mirror, and aggregate MB/s.
+
+            Attached to a requests.Session (attach), every response of the session is recorded as a
+            'request' event (time to the response headers, status code, retries spent by the session's
+            Retry), and common.fetch/common.ranged add a 'download' event for every body they stream.
+            Other stages record their own events with record() or timed().
+
+            Every event is also passed to the hooks, e.g. to feed a metrics exporter while the run is
+            going; hooks are called from the worker threads and should return quickly.
+
+        input:
+            - hooks: callables receiving every event dict (default=None)
+    '''
+
+    def __init__(self, hooks=None):
+        self.hooks = list(hooks or [])
+        self.events = []
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def record(self, kind, **fields):
+        '''
+            description:
+                Records one event. Common fields are name (accession or file), mirror, bytes, seconds,
+                status and error.
+
+            output:
+                - the event dict
+        '''
+        event = dict(fields, kind=kind, time=time.time() - self._start)
+        with self._lock:
+            self.events.append(event)
+        for hook in self.hooks:
+            hook(event)
+        return event
+
+    @contextmanager
+    def timed(self, kind, **fields):
+        '''
+            description:
+                Context manager recording an event of kind with the seconds spent in the block. The block
+                can add fields (e.g. bytes) to the yielded dict; an exception is recorded as its error.
+        '''
+        start_time = time.time()
+        fields = dict(fields)
+        try:
+            yield fields
+        except Exception as error:
+            fields.setdefault('error', "{}: {}".format(type(error).__name__, error))
+            raise
+        finally:
+            self.record(kind, seconds=time.time() - start_time, **fields)
+
+    def attach(self, session):
+        '''
+            description:
+                Records every response of session from now on; replaces a recorder attached earlier.
+
+            output:
+                - session
+        '''
+        previous = getattr(session, 'run_recorder', None)
+        if previous is self:
+            return session
+        if previous is not None and previous._on_response in session.hooks['response']:
+            session.hooks['response'].remove(previous._on_response)
+        session.hooks['response'].append(self._on_response)
+        session.run_recorder = self
+        return session
+
+    def _on_response(self, response, *args, **kwargs):
+        # called by requests once the headers are in, before any streamed body is read
+        retries = getattr(response.raw, 'retries', None)
+        self.record('request',
+                    method=response.request.method,
+                    url=response.url,
+                    mirror=mirror_of(response.url),
+                    status=response.status_code,
+                    seconds=response.elapsed.total_seconds(),
+                    retries=len(retries.history) if retries is not None else 0,
+                    error=None if response.status_code < 400 else "HTTP {}".format(response.status_code))
+        response.run_recorder = self
+        return response
+
+    def summary(self):
+        '''
+            output:
+                - report dict: run totals, then count, errors, bytes, MB/s and duration percentiles per
+                  kind of event, and the same per mirror for requests and downloads
+        '''
+        with self._lock:
+            events = list(self.events)
+        elapsed = max(time.time() - self._start, 1e-9)
+        downloaded = sum(event.get('bytes') or 0 for event in events if event['kind'] in ('download', 'transfer'))
+
+        def group(selected):
+            seconds = [event['seconds'] for event in selected if event.get('seconds') is not None]
+            transferred = sum(event.get('bytes') or 0 for event in selected)
+            busy = sum(seconds)
+            return {
+                'count': len(selected),
+                'errors': sum(1 for event in selected if event.get('error')),
+                'retries': sum(event.get('retries') or 0 for event in selected),
+                'bytes': transferred,
+                # per transfer: bytes over the seconds spent moving them, not over the whole run
+                'mb_per_s': transferred / busy / 1e6 if transferred and busy else None,
+                'seconds': distribution(seconds),
+            }
+
+        kinds = {}
+        for event in events:
+            kinds.setdefault(event['kind'], []).append(event)
+        mirrors = {}
+        for event in events:
+            if event['kind'] in ('request', 'download') and event.get('mirror'):
+                mirrors.setdefault(event['mirror'], {}).setdefault(event['kind'], []).append(event)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self._start)),
+            'seconds': elapsed,
+            'bytes': downloaded,
+            'mb_per_s': downloaded / elapsed / 1e6,
+            'kinds': {kind: group(selected) for kind, selected in sorted(kinds.items())},
+            'mirrors': {mirror: {kind: group(selected) for kind, selected in sorted(by_kind.items())}
+                        for mirror, by_kind in sorted(mirrors.items())},
+        }
+
+    def write_report(self, path, events=True):
+        '''
+            description:
+                Writes the summary (and, with events, every event) as JSON to path.
+
+            output:
+                - the summary dict
+        '''
+        report = self.summary()
+        if events:
+            with self._lock:
+                report['events'] = list(self.events)
+        with open(path + ".tmp", 'w') as report_file:
+            json.dump(report, report_file, indent=1)
+        os.replace(path + ".tmp", path)
+        return report
+
+    def print_summary(self):
+        report = self.summary()
+        print("Run: {:.1f}s, {:.1f} MB downloaded, {:.2f} MB/s".format(report['seconds'], report['bytes'] / 1e6, report['mb_per_s']))
+        for kind, stats in report['kinds'].items():
+            seconds = stats['seconds']
+            print("\t{}: {} ({} errors), p50 {:.3f}s, p95 {:.3f}s, p99 {:.3f}s{}".format(
+                kind, stats['count'], stats['errors'], seconds['p50'] or 0, seconds['p95'] or 0, seconds['p99'] or 0,
+                ", {:.2f} MB/s per transfer".format(stats['mb_per_s']) if stats['mb_per_s'] else ""))
+
+
+def recorder_of(holder):
+    '''
+        output:
+            - RunRecorder attached to a session (or to a response of that session), else None
+    '''
+    return getattr(holder, 'run_recorder', None)
+
+
+@contextmanager
+def timed(recorder, kind, **fields):
+    '''
+        description:
+            RunRecorder.timed for an optional recorder: without one the block just runs.
+    '''
+    if recorder is None:
+        yield dict(fields)
+        return
+    with recorder.timed(kind, **fields) as event:
+        yield event
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import time
+
+from common.cache import file_checksum
+from common.checksums import pop_checksum
+
+# file name of the journal the batch downloaders keep in their output directory
+JOURNAL_NAME = ".dataloader-journal.sqlite"
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    accession TEXT NOT NULL,
+    artifact TEXT NOT NULL,
+    state TEXT NOT NULL,
+    path TEXT, size INTEGER, mtime INTEGER, checksum TEXT, reason TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL,
+    PRIMARY KEY (accession, artifact)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class JobJournal:
+    '''
+        description:
+            Durable SQLite journal of a batch download. Every file of the batch is a job, keyed by accession
+            and artifact (e.g. ('101d', 'cif') or ('1234', 'map')), that is pending, in-flight, done (with
+            the path, size, mtime and sha256 of the file it produced) or failed (with the reason). Each
+            change is committed before the download goes on, so after a crash, Ctrl-C or dropped
+            connection the journal knows exactly which files are complete. The sha256 is the one the
+            download computed while streaming (common.checksums); a file is only read back to hash it
+            when the download could not: maps fetched as parallel byte ranges, and the header text files.
+
+            With resume=True, plan() keeps the work of earlier runs: done jobs whose file still has its
+            size and mtime are kept as they are, a file touched since is kept only if its checksum still
+            matches, and the rest (pending, interrupted, failed, or done but missing or changed on disk)
+            is scheduled again. Without it every job of the batch starts over.
+            A failed job does not stop the batch; it waits in the retry queue for the retry passes at the
+            end of the batch (retry_queue()) and for the next resumed run.
+
+        input:
+            - path: SQLite database file, JOURNAL_NAME in the output directory for the downloaders
+            - resume: keeps the jobs finished by earlier runs (default=False)
+            - retries: retry passes over the failed jobs at the end of a batch (default=1)
+    '''
+
+    def __init__(self, path, resume=False, retries=1):
+        self.path = path
+        self.resume = resume
+        self.retries = retries
+        self._lock = threading.Lock()
+        # downloads run on worker threads; every access goes through the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # every state change is committed, WAL keeps those commits cheap
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+        try:
+            # journals written before the mtime was recorded
+            self._connection.execute("ALTER TABLE jobs ADD COLUMN mtime INTEGER")
+        except sqlite3.OperationalError:
+            pass
+
+    def _set(self, accession, artifact, state, **fields):
+        # callers hold the lock and commit
+        fields.update(state=state, updated_at=time.time())
+        self._connection.execute("INSERT OR IGNORE INTO jobs (accession, artifact, state) VALUES (?, ?, ?)", (accession, artifact, state))
+        self._connection.execute("UPDATE jobs SET {} WHERE accession = ? AND artifact = ?".format(", ".join("{} = ?".format(field) for field in fields)),
+                                 list(fields.values()) + [accession, artifact])
+
+    def _verified(self, row):
+        path = row['path']
+        if path is None or not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != row['size']:
+            return False
+        # untouched since it was finished; only a file modified since is hashed again
+        return stat.st_mtime_ns == row['mtime'] or file_checksum(path) == row['checksum']
+
+    def plan(self, jobs):
+        '''
+            description:
+                Registers the (accession, artifact) jobs of a batch as pending, except - when resuming - the
+                done jobs whose file is still intact.
+
+            output:
+                - jobs that have to run, in the given order
+        '''
+        todo = []
+        kept = 0
+        with self._lock:
+            for accession, artifact in jobs:
+                row = self._connection.execute("SELECT * FROM jobs WHERE accession = ? AND artifact = ?", (accession, artifact)).fetchone()
+                if self.resume and row is not None and row['state'] == DONE and self._verified(row):
+                    kept += 1
+                    continue
+                self._set(accession, artifact, PENDING, path=None, size=None, mtime=None, checksum=None, reason=None)
+                todo.append((accession, artifact))
+            self._connection.commit()
+        if self.resume:
+            print("Resuming from {}: {} files already downloaded and verified, {} to go.".format(self.path, kept, len(todo)))
+        return todo
+
+    def remaining(self, accession, artifacts):
+        '''
+            output:
+                - the artifacts of accession that are not done
+        '''
+        with self._lock:
+            done = {artifact for artifact, in self._connection.execute("SELECT artifact FROM jobs WHERE accession = ? AND state = ?", (accession, DONE))}
+        return [artifact for artifact in artifacts if artifact not in done]
+
+    def start(self, accession, artifact):
+        with self._lock:
+            self._set(accession, artifact, IN_FLIGHT)
+            self._connection.execute("UPDATE jobs SET attempts = attempts + 1 WHERE accession = ? AND artifact = ?", (accession, artifact))
+            self._connection.commit()
+
+    def done(self, accession, artifact, path, checksum=None):
+        '''
+            input:
+                - checksum: sha256 of the file if already known; otherwise the file is read to compute it (default=None)
+        '''
+        stat = os.stat(path)
+        if checksum is None:
+            checksum = file_checksum(path)
+        with self._lock:
+            self._set(accession, artifact, DONE, path=path, size=stat.st_size, mtime=stat.st_mtime_ns, checksum=checksum, reason=None)
+            self._connection.commit()
+
+    def fail(self, accession, artifact, reason):
+        with self._lock:
+            self._set(accession, artifact, FAILED, reason=reason)
+            self._connection.commit()
+
+    def failed(self, jobs=None):
+        '''
+            output:
+                - list of (accession, artifact, reason, attempts) of the failed jobs, only those of jobs if given
+        '''
+        with self._lock:
+            rows = [tuple(row) for row in self._connection.execute(
+                "SELECT accession, artifact, reason, attempts FROM jobs WHERE state = ? ORDER BY rowid", (FAILED,))]
+        if jobs is None:
+            return rows
+        order = {job: index for index, job in enumerate(jobs)}
+        return sorted((row for row in rows if row[:2] in order), key=lambda row: order[row[:2]])
+
+    def retry_queue(self, jobs):
+        '''
+            description:
+                Yields the failed ones of jobs as a list of (accession, artifact) once per retry pass, until
+                none is left or the retries are used up.
+        '''
+        for attempt in range(self.retries):
+            queue = [row[:2] for row in self.failed(jobs)]
+            if not queue:
+                return
+            print("Retrying {} failed downloads (pass {} of {}).".format(len(queue), attempt + 1, self.retries))
+            yield queue
+
+    def counts(self):
+        '''
+            output:
+                - dict of the number of jobs per state
+        '''
+        with self._lock:
+            return dict(tuple(row) for row in self._connection.execute("SELECT state, count(*) FROM jobs GROUP BY state"))
+
+    def report(self, jobs=None):
+        counts = self.counts()
+        print("Journal {}: {} done, {} failed, {} pending, {} in flight.".format(
+            self.path, counts.get(DONE, 0), counts.get(FAILED, 0), counts.get(PENDING, 0), counts.get(IN_FLIGHT, 0)))
+        for accession, artifact, reason, attempts in self.failed(jobs):
+            print("\tfailed: {} {} after {} attempts: {}".format(accession, artifact, attempts, reason))
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+def run_job(journal, accession, artifact, paths, download):
+    '''
+        description:
+            Runs download() as the job (accession, artifact) of journal. download returns True once its file
+            is written, else False or the reason of the failure. The job is done with the first of paths
+            that exists (e.g. the .gz file, or the unzipped one when the .gz is not kept), preferring one
+            the download hashed while streaming, and failed when download fails or raises - the
+            exception is recorded instead of ending the batch.
+            Without a journal download() is just called.
+
+        output:
+            - True if the file was downloaded
+    '''
+    if journal is None:
+        return download() is True
+    journal.start(accession, artifact)
+    try:
+        result = download()
+    except Exception as error:
+        result = "{}: {}".format(type(error).__name__, error)
+    written = [path for path in paths if os.path.exists(path)]
+    if result is True and written:
+        checksums = [(path, pop_checksum(path)) for path in written]
+        path, checksum = next(((path, checksum) for path, checksum in checksums if checksum is not None), (written[0], None))
+        journal.done(accession, artifact, path, checksum)
+        return True
+    journal.fail(accession, artifact, result if isinstance(result, str) else "no file was written")
+    return False
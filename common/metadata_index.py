@@ -0,0 +1,188 @@
+import re
+import sqlite3
+import threading
+import time
+
+# rows are committed after this many changes (and always by save())
+COMMIT_EVERY = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emdb_entries (
+    emdb_id TEXT PRIMARY KEY,
+    structure_title TEXT, deposition_date TEXT, header_release_date TEXT, map_release_date TEXT,
+    article_title TEXT, pubmed TEXT, doi TEXT, issn TEXT,
+    etag TEXT, last_modified TEXT, indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS pdb_entries (
+    pdb_id TEXT PRIMARY KEY,
+    structure_title TEXT, deposited_date TEXT, released_date TEXT, em_data_id TEXT, em_data_link TEXT,
+    paper_name TEXT, paper_link TEXT, abstract_text TEXT, indexed_at REAL
+);
+CREATE TABLE IF NOT EXISTS cross_references (
+    emdb_id TEXT NOT NULL,
+    pdb_id TEXT NOT NULL,
+    source TEXT NOT NULL,
+    PRIMARY KEY (emdb_id, pdb_id, source)
+);
+CREATE INDEX IF NOT EXISTS cross_references_pdb ON cross_references (pdb_id);
+CREATE INDEX IF NOT EXISTS emdb_entries_map_release ON emdb_entries (map_release_date);
+CREATE INDEX IF NOT EXISTS pdb_entries_released ON pdb_entries (released_date);
+"""
+
+EMDB_FIELDS = ('structure_title', 'deposition_date', 'header_release_date', 'map_release_date', 'article_title', 'pubmed', 'doi', 'issn')
+PDB_FIELDS = ('structure_title', 'deposited_date', 'released_date', 'em_data_id', 'em_data_link', 'paper_name', 'paper_link', 'abstract_text')
+
+
+def emdb_id(accession):
+    '''
+        output:
+            - accession in the 'EMD-1234' form, whether given as '1234', 'emd-1234' or 'EMD-1234'
+    '''
+    return "EMD-" + re.sub(r'^emd[-_]?', '', str(accession).strip(), flags=re.IGNORECASE)
+
+
+def pdb_id(accession):
+    return accession.strip().upper()
+
+
+class MetadataIndex:
+    '''
+        description:
+            Local SQLite index of parsed EMDB headers, RCSB metadata and the EMDB <-> PDB cross-references
+            between them (fitted PDBs of an EMDB map, EMDB maps of a PDB entry). Entries are updated in
+            place as batch runs fetch them, so later runs skip what is already indexed and queries need
+            no network at all.
+
+            EMDB headers are stored with their ETag/Last-Modified, so a run only has to send a conditional
+            request for an indexed entry; RCSB metadata has no validators and is reused for max_age seconds.
+
+        input:
+            - path: SQLite database file
+            - max_age: seconds indexed RCSB metadata is reused before being fetched again, None for
+              forever (default=30 days)
+    '''
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._changes = 0
+        # downloads run on worker threads; every access goes through the lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(SCHEMA)
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes >= COMMIT_EVERY:
+            self._connection.commit()
+            self._changes = 0
+
+    def get_emdb(self, accession):
+        '''
+            output:
+                - dict of the indexed header fields plus 'fitted_pdbs', 'etag' and 'last_modified', or None
+        '''
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM emdb_entries WHERE emdb_id = ?", (emdb_id(accession),)).fetchone()
+            if row is None:
+                return None
+            entry = dict(row)
+            entry['fitted_pdbs'] = [pdb for pdb, in self._connection.execute(
+                "SELECT pdb_id FROM cross_references WHERE emdb_id = ? AND source = 'emdb' ORDER BY rowid", (entry['emdb_id'],))]
+        return entry
+
+    def put_emdb(self, accession, header, etag=None, last_modified=None):
+        '''
+            description:
+                Indexes a parsed header (emdb.emdb_header.EMDBHeader) and its fitted PDBs.
+        '''
+        key = emdb_id(accession)
+        values = [getattr(header, field) for field in EMDB_FIELDS]
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO emdb_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     [key] + values + [etag, last_modified, time.time()])
+            self._connection.execute("DELETE FROM cross_references WHERE emdb_id = ? AND source = 'emdb'", (key,))
+            self._connection.executemany("INSERT OR IGNORE INTO cross_references VALUES (?, ?, 'emdb')",
+                                         [(key, pdb_id(pdb)) for pdb in header.fitted_pdbs if pdb])
+            self._changed()
+
+    def get_pdb(self, accession):
+        '''
+            output:
+                - get_metadata() tuple of the entry if it is indexed and younger than max_age, else None
+        '''
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM pdb_entries WHERE pdb_id = ?", (pdb_id(accession),)).fetchone()
+        if row is None or (self.max_age is not None and time.time() - row['indexed_at'] > self.max_age):
+            return None
+        return tuple(row[field] for field in PDB_FIELDS)
+
+    def put_pdb(self, accession, metadata):
+        '''
+            description:
+                Indexes a get_metadata() tuple and the EMDB map it references (if any).
+        '''
+        key = pdb_id(accession)
+        em_data_id = metadata[PDB_FIELDS.index('em_data_id')]
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO pdb_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     [key] + list(metadata) + [time.time()])
+            self._connection.execute("DELETE FROM cross_references WHERE pdb_id = ? AND source = 'pdb'", (key,))
+            if em_data_id and em_data_id != 'NA':
+                self._connection.execute("INSERT OR IGNORE INTO cross_references VALUES (?, ?, 'pdb')", (emdb_id(em_data_id), key))
+            self._changed()
+
+    def fitted_pdbs(self, accession):
+        '''
+            output:
+                - PDB ids linked to the EMDB entry by either archive
+        '''
+        with self._lock:
+            return [pdb for pdb, in self._connection.execute(
+                "SELECT DISTINCT pdb_id FROM cross_references WHERE emdb_id = ? ORDER BY pdb_id", (emdb_id(accession),))]
+
+    def emdb_maps(self, accession):
+        '''
+            output:
+                - EMDB ids linked to the PDB entry by either archive
+        '''
+        with self._lock:
+            return [emdb for emdb, in self._connection.execute(
+                "SELECT DISTINCT emdb_id FROM cross_references WHERE pdb_id = ? ORDER BY emdb_id", (pdb_id(accession),))]
+
+    def maps_with_fitted_pdbs(self, released_after=None):
+        '''
+            description:
+                EMDB maps that have at least one fitted PDB, optionally only those whose map was released
+                after the given ISO date ('YYYY-MM-DD').
+
+            output:
+                - list of (emdb_id, map_release_date, structure_title, comma separated PDB ids)
+        '''
+        query = ("SELECT e.emdb_id, e.map_release_date, e.structure_title, group_concat(DISTINCT x.pdb_id) "
+                 "FROM emdb_entries e JOIN cross_references x ON x.emdb_id = e.emdb_id ")
+        parameters = []
+        if released_after:
+            query += "WHERE e.map_release_date > ? "
+            parameters.append(released_after)
+        query += "GROUP BY e.emdb_id ORDER BY e.map_release_date, e.emdb_id"
+        with self._lock:
+            return [tuple(row) for row in self._connection.execute(query, parameters)]
+
+    def query(self, sql, parameters=()):
+        '''
+            description:
+                Runs an SQL query against the index (tables emdb_entries, pdb_entries, cross_references).
+        '''
+        with self._lock:
+            return [tuple(row) for row in self._connection.execute(sql, parameters)]
+
+    def save(self):
+        with self._lock:
+            self._connection.commit()
+            self._changes = 0
+
+    def close(self):
+        self.save()
+        self._connection.close()
@@ -0,0 +1,167 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import ExitStack
+
+import requests
+
+
+class MirrorScheduler:
+    '''
+        description:
+            Keeps running statistics per mirror during a batch (time to first byte, hit rate and
+            error rate, as exponentially weighted moving averages) and orders the mirrors of each
+            request so the one expected to deliver the file soonest is tried first.
+
+            The expected cost of trying a mirror first is its latency divided by its hit rate, so a
+            fast mirror that rarely has the entry does not win over a slightly slower one that does.
+            Mirrors whose recent error rate is above max_error_rate go to the back of the list.
+            Mirrors never tried yet sort first, so each one gets measured once.
+
+        input:
+            - alpha: weight of the newest observation in the moving averages (default=0.3)
+            - max_error_rate: error rate above which a mirror counts as unhealthy (default=0.5)
+    '''
+
+    def __init__(self, alpha=0.3, max_error_rate=0.5):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, mirror, latency, hit=False, error=False):
+        '''
+            description:
+                Records the outcome of one request to mirror.
+
+            input:
+                - mirror: mirror name
+                - latency: seconds until the response headers arrived (or the request failed)
+                - hit: True if the mirror had the file (HTTP 200)
+                - error: True for connection errors, 429 and 5xx responses
+        '''
+        with self._lock:
+            stats = self._stats.get(mirror)
+            if stats is None:
+                self._stats[mirror] = {'latency': latency, 'hit_rate': float(hit), 'error_rate': float(error), 'requests': 1}
+                return
+            stats['latency'] += self.alpha * (latency - stats['latency'])
+            stats['hit_rate'] += self.alpha * (float(hit) - stats['hit_rate'])
+            stats['error_rate'] += self.alpha * (float(error) - stats['error_rate'])
+            stats['requests'] += 1
+
+    def order(self, candidates):
+        '''
+            description:
+                Sorts (mirror, url) candidates best first; ties keep the given order.
+
+            output:
+                - list of (mirror, url)
+        '''
+        with self._lock:
+            def key(indexed):
+                index, (mirror, url) = indexed
+                stats = self._stats.get(mirror)
+                if stats is None:
+                    return (False, 0.0, index)
+                unhealthy = stats['error_rate'] > self.max_error_rate
+                return (unhealthy, stats['latency'] / max(stats['hit_rate'], 0.05), index)
+            return [candidate for index, candidate in sorted(enumerate(candidates), key=key)]
+
+    def summary(self):
+        '''
+            output:
+                - dict of mirror name to a copy of its statistics
+        '''
+        with self._lock:
+            return {mirror: dict(stats) for mirror, stats in self._stats.items()}
+
+
+def _open(session, mirror, url, scheduler, limiter):
+    # the host slot is kept in the returned ExitStack, so it is held until the body has been streamed
+    stack = ExitStack()
+    if limiter is not None:
+        stack.enter_context(limiter.acquire(url))
+    start_time = time.monotonic()
+    try:
+        response = session.get(url, allow_redirects=True, stream=True)
+    except requests.RequestException:
+        stack.close()
+        if scheduler is not None:
+            scheduler.record(mirror, time.monotonic() - start_time, error=True)
+        raise
+    if scheduler is not None:
+        scheduler.record(mirror, time.monotonic() - start_time,
+                         hit=response.status_code == 200,
+                         error=response.status_code == 429 or response.status_code >= 500)
+    stack.callback(response.close)
+    return response, stack
+
+
+def open_first(session, candidates, scheduler=None, limiter=None):
+    '''
+        description:
+            Sends the request to every (mirror, url) candidate at once and keeps the first one
+            answering 200; the others are closed as soon as their headers arrive, so their bodies
+            are never downloaded. With a single candidate this is a plain streaming GET.
+
+        input:
+            - session: requests.Session
+            - candidates: list of (mirror, url)
+            - scheduler: MirrorScheduler updated with every outcome (default=None)
+            - limiter: common.concurrency.HostLimiter (default=None)
+
+        output:
+            - mirror: name of the mirror that answered 200, or None
+            - status_code: 200 on a hit, 404 if every candidate answered 404, otherwise the first
+              other status code (None if the candidates could not be reached)
+            - response: open streaming response on a hit, else None
+            - release: ExitStack closing the response and freeing the host slot on a hit, else None
+    '''
+    if len(candidates) == 1:
+        mirror, url = candidates[0]
+        try:
+            response, release = _open(session, mirror, url, scheduler, limiter)
+        except requests.RequestException:
+            return None, None, None, None
+        if response.status_code == 200:
+            return mirror, 200, response, release
+        release.close()
+        return None, response.status_code, None, None
+
+    status_codes = []
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    futures = {executor.submit(_open, session, mirror, url, scheduler, limiter): mirror for mirror, url in candidates}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response, release = future.result()
+                except requests.RequestException:
+                    status_codes.append(None)
+                    continue
+                if response.status_code == 200:
+                    # winner: the requests still in flight are closed as soon as their headers arrive,
+                    # without downloading their bodies or waiting for them here
+                    for loser in pending | (done - {future}):
+                        loser.add_done_callback(_close_loser)
+                    return futures[future], 200, response, release
+                status_codes.append(response.status_code)
+                release.close()
+    finally:
+        executor.shutdown(wait=False)
+
+    other = [status_code for status_code in status_codes if status_code not in (404, None)]
+    if other:
+        return None, other[0], None, None
+    if all(status_code == 404 for status_code in status_codes):
+        return None, 404, None, None
+    return None, None, None, None
+
+
+def _close_loser(future):
+    if future.exception() is None:
+        response, release = future.result()
+        release.close()
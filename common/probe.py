@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+from common.session import get_session
+
+# servers answering these to HEAD don't implement it; the probe retries with a one-byte ranged GET
+HEAD_UNSUPPORTED = (403, 405, 501)
+
+# definitive answers of a probe; anything else (5xx, 429, transport errors) says nothing about the entry
+FOUND = (200, 206)
+NOT_FOUND = (404, 410)
+
+
+def probe_url(url, session=None):
+    '''
+        description:
+            Checks whether url exists without downloading it: a HEAD request, or a GET for the
+            first byte only (Range: bytes=0-0) when the server does not answer HEAD.
+
+        input:
+            - url: URL to check
+            - session: requests.Session to use (default=common.session.get_session())
+
+        output:
+            - True if the resource exists (HTTP 200/206), False if it does not (HTTP 404/410), None if
+              the probe could not tell (transport error, 5xx, 429 or any other status)
+    '''
+    session = get_session(session)
+    try:
+        response = session.head(url, allow_redirects=True)
+        response.close()
+        if response.status_code in HEAD_UNSUPPORTED:
+            response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, allow_redirects=True)
+            response.close()
+    except requests.RequestException:
+        return None
+    if response.status_code in FOUND:
+        return True
+    if response.status_code in NOT_FOUND:
+        return False
+    return None
+
+
+class ProbeCache:
+    '''
+        description:
+            Persistent memo of existence probes keyed by (site, accession), stored as JSON at path.
+            Results older than ttl seconds are probed again.
+
+        input:
+            - path: JSON file holding the results
+            - ttl: seconds a result stays valid (default=7 days)
+    '''
+
+    def __init__(self, path, ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            with open(path) as cache_file:
+                self._results = json.load(cache_file)
+        except (OSError, ValueError):
+            self._results = {}
+
+    def get(self, site, accession):
+        '''
+            output:
+                - cached True/False, or None if unknown or expired
+        '''
+        with self._lock:
+            result = self._results.get("{}:{}".format(site, accession))
+        if result is None or time.time() - result[1] > self.ttl:
+            return None
+        return result[0]
+
+    def put(self, site, accession, exists):
+        with self._lock:
+            self._results["{}:{}".format(site, accession)] = [exists, time.time()]
+
+    def save(self):
+        '''
+            description:
+                Writes the results to disk (atomically).
+        '''
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            with open(self.path + ".tmp", 'w') as cache_file:
+                json.dump(self._results, cache_file)
+            os.replace(self.path + ".tmp", self.path)
+
+
+def probe_site(site, accession, urls, session=None, cache=None):
+    '''
+        description:
+            Memoized existence check of an entry on one site; the entry exists if any of urls does.
+            Only definitive answers are memoized, so a flaky connection or an overloaded mirror is
+            probed again next time instead of hiding the entry for the whole ttl.
+
+        input:
+            - site: site name, part of the cache key
+            - accession: entry accession ID
+            - urls: candidate URLs for the entry on that site
+            - session: requests.Session to use (default=common.session.get_session())
+            - cache: ProbeCache (default=None)
+
+        output:
+            - True if the entry exists on the site, False if every url is missing, None if unknown
+              (some url could not be probed); callers should treat None as worth trying
+    '''
+    exists = cache.get(site, accession) if cache is not None else None
+    if exists is not None:
+        return exists
+    exists = False
+    for url in urls:
+        found = probe_url(url, session)
+        if found:
+            exists = True
+            break
+        if found is None:
+            exists = None
+    if cache is not None and exists is not None:
+        cache.put(site, accession, exists)
+    return exists
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import os
+import threading
+
+from common.checksums import remember_checksum
+from common.fetch import CHUNK_SIZE, download_to_file
+from common.gunzip import GunzipWriter, gunzip_file
+from common.instrumentation import mirror_of, recorder_of, timed
+from common.session import get_session
+
+# files smaller than segments * SEGMENT_MIN_SIZE are fetched as fewer (or one) segments
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+
+# the progress sidecar is rewritten after this many chunks of every segment
+STATE_EVERY = 16
+
+
+class RangeMismatch(Exception):
+    '''
+        Raised when the server stops honouring the ranges of a partial download, or the file
+        changed (ETag or size) while it was being fetched.
+    '''
+
+
+def _load_state(state_path, etag, length):
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    if state.get('etag') != etag or state.get('length') != length:
+        return None
+    return state
+
+
+def _save_state(state_path, state):
+    with open(state_path + ".tmp", 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(state_path + ".tmp", state_path)
+
+
+def _split(length, segments, min_segment_size):
+    segments = max(1, min(segments, length // max(min_segment_size, 1)))
+    bounds = [length * index // segments for index in range(segments + 1)]
+    return [[bounds[index], bounds[index + 1] - 1, 0] for index in range(segments)]
+
+
+class _DigestSink:
+    # hashes what a single segment writes, passing it on to sink (if any)
+
+    def __init__(self, sink=None):
+        self.digest = hashlib.sha256()
+        self.sink = sink
+
+    def write(self, chunk):
+        self.digest.update(chunk)
+        if self.sink is not None:
+            self.sink.write(chunk)
+
+
+def _replay(part_path, length, sink, chunk_size):
+    # feeds the bytes a resumed segment already has on disk to sink
+    with open(part_path, 'rb') as part_file:
+        while length > 0:
+            chunk = part_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            sink.write(chunk)
+            length -= len(chunk)
+
+
+def _fetch_segment(session, url, part_path, segment, etag, chunk_size, checkpoint, sink=None):
+    start, end, done = segment
+    if start + done > end:
+        return
+    headers = {'Range': "bytes={}-{}".format(start + done, end)}
+    if etag:
+        headers['If-Range'] = etag
+    response = session.get(url, headers=headers, stream=True, allow_redirects=True)
+    try:
+        if response.status_code != 206:
+            raise RangeMismatch("{} answered HTTP {} to a range request".format(url, response.status_code))
+        if etag and response.headers.get('ETag', etag) != etag:
+            raise RangeMismatch("{} changed while downloading (ETag {} != {})".format(url, response.headers.get('ETag'), etag))
+        with timed(recorder_of(response), 'download', name=os.path.splitext(os.path.basename(part_path))[0], url=response.url, mirror=mirror_of(response.url)) as event:
+            with open(part_path, 'r+b') as part_file:
+                part_file.seek(start + done)
+                for count, chunk in enumerate(response.iter_content(chunk_size=chunk_size)):
+                    part_file.write(chunk)
+                    if sink is not None:
+                        sink.write(chunk)
+                    segment[2] += len(chunk)
+                    if count % STATE_EVERY == STATE_EVERY - 1:
+                        part_file.flush()
+                        checkpoint()
+            event['bytes'] = segment[2] - done
+    finally:
+        response.close()
+
+
+def ranged_download(url, output_path, session=None, segments=1, chunk_size=CHUNK_SIZE, min_segment_size=None, response_headers=None,
+                    unzip_path=None, keep_compressed=True):
+    '''
+        description:
+            Resumable download using HTTP range requests. Bytes go to output_path + '.part' and the
+            progress of every segment to output_path + '.part.json'; both survive an interruption, and
+            the next call continues each segment from where it stopped instead of starting over.
+            With segments > 1 a large file is fetched as that many byte ranges in parallel and stitched
+            in place in the preallocated part file.
+
+            The ETag is sent as If-Range, so a file that changed on the server is never spliced onto an
+            old partial download, and the finished file must match the advertised Content-Length before
+            it is renamed into place. Servers without range support (no Content-Length, no
+            'Accept-Ranges: bytes', or a Content-Encoding) get a plain streaming download.
+
+            With unzip_path the file is also gunzipped. A single segment is decompressed while it
+            arrives (after replaying the bytes a resumed download already has); parallel segments arrive
+            out of order and are decompressed once the file is complete. A single segment is hashed the
+            same way (common.checksums.remember_checksum); parallel segments are not.
+
+        input:
+            - url: URL of the file
+            - output_path: final path of the downloaded file
+            - session: requests.Session to use (default=common.session.get_session())
+            - segments: number of parallel byte ranges (default=1)
+            - chunk_size: bytes per read (default=CHUNK_SIZE)
+            - min_segment_size: lower bound on the size of one segment (default=None, SEGMENT_MIN_SIZE)
+            - response_headers: dict updated with the headers of the file, e.g. for ETag (default=None)
+            - unzip_path: path the file is gunzipped to (default=None, not decompressed)
+            - keep_compressed: with unzip_path, also keeps output_path; the compressed part file is
+              needed to resume either way (default=True)
+
+        output:
+            - HTTP status code: 200 once the file is complete, otherwise the status of the failed request
+    '''
+    session = get_session(session)
+    head = session.head(url, allow_redirects=True)
+    head.close()
+    if response_headers is not None:
+        response_headers.update(head.headers)
+    if head.status_code == 404:
+        return 404
+    length = int(head.headers.get('Content-Length', -1))
+    etag = head.headers.get('ETag')
+    if (head.status_code != 200 or length < 0 or head.headers.get('Accept-Ranges', '').lower() != 'bytes'
+            or head.headers.get('Content-Encoding')):
+        return download_to_file(url, output_path, chunk_size, session, response_headers, unzip_path, keep_compressed)
+
+    part_path = output_path + ".part"
+    state_path = part_path + ".json"
+    state = _load_state(state_path, etag, length) if os.path.exists(part_path) else None
+    if state is None:
+        segment_size = SEGMENT_MIN_SIZE if min_segment_size is None else min_segment_size
+        state = {'url': url, 'etag': etag, 'length': length, 'segments': _split(length, segments, segment_size)}
+        with open(part_path, 'wb') as part_file:
+            part_file.truncate(length)
+        _save_state(state_path, state)
+
+    lock = threading.Lock()
+
+    def checkpoint():
+        with lock:
+            _save_state(state_path, state)
+
+    unzip_file = None
+    digest_sink = None
+    try:
+        if len(state['segments']) == 1:
+            if unzip_path is not None:
+                unzip_file = GunzipWriter(unzip_path)
+            digest_sink = _DigestSink(unzip_file)
+            _replay(part_path, state['segments'][0][2], digest_sink, chunk_size)
+            _fetch_segment(session, url, part_path, state['segments'][0], etag, chunk_size, checkpoint, digest_sink)
+        else:
+            errors = []
+
+            def run(segment):
+                try:
+                    _fetch_segment(session, url, part_path, segment, etag, chunk_size, checkpoint)
+                except Exception as error:
+                    errors.append(error)
+
+            threads = [threading.Thread(target=run, args=(segment,)) for segment in state['segments']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+    except BaseException as error:
+        if unzip_file is not None:
+            unzip_file.abort()
+        if not isinstance(error, RangeMismatch):
+            raise
+        # the partial file can't be trusted any more: start over with a plain download
+        os.remove(part_path)
+        os.remove(state_path)
+        return download_to_file(url, output_path, chunk_size, session, response_headers, unzip_path, keep_compressed)
+    finally:
+        if os.path.exists(state_path):
+            checkpoint()
+
+    received = sum(segment[2] for segment in state['segments'])
+    if received != length or os.path.getsize(part_path) != length:
+        if unzip_file is not None:
+            unzip_file.abort()
+        raise RangeMismatch("{}: got {} of {} bytes".format(url, received, length))
+    if unzip_file is not None:
+        unzip_file.close()
+    elif unzip_path is not None:
+        gunzip_file(part_path, unzip_path)
+    if unzip_path is None or keep_compressed:
+        os.replace(part_path, output_path)
+        if digest_sink is not None:
+            remember_checksum(output_path, digest_sink.digest.hexdigest())
+    else:
+        os.remove(part_path)
+    os.remove(state_path)
+    return 200
@@ -0,0 +1,82 @@
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# transient answers from the mirrors worth retrying; 404 is a real miss and falls through to the next mirror
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    '''
+        description:
+            urllib3 Retry whose exponential backoff gets up to `jitter` extra seconds of random delay,
+            so many workers that failed together do not retry against the mirror in lockstep.
+    '''
+
+    def __init__(self, *args, jitter=0.0, **kwargs):
+        self.jitter = jitter
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        if backoff <= 0:
+            return backoff
+        return backoff + random.uniform(0, self.jitter)
+
+
+def make_session(retries=3, backoff_factor=0.5, jitter=0.5, pool_maxsize=10):
+    '''
+        description:
+            Function for building the HTTP session shared by every downloader. Connections are
+            pooled and kept alive per host, and 429/5xx answers and connection errors are retried
+            with exponential backoff (backoff_factor * 2 ** (retry - 1) seconds, plus jitter).
+            Retry-After headers sent with 429/503 are honoured.
+
+        input:
+            - retries: retries per request before the last response is returned (default=3)
+            - backoff_factor: base of the exponential backoff in seconds (default=0.5)
+            - jitter: maximum random seconds added to each backoff (default=0.5)
+            - pool_maxsize: connections kept alive per host, should be >= the number of workers (default=10)
+
+        output:
+            - session: requests.Session
+    '''
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False,
+        jitter=jitter)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool_maxsize, max_retries=retry)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def get_session(session=None):
+    '''
+        description:
+            Returns session if given, otherwise the process-wide session built with the
+            default make_session() settings.
+    '''
+    global _default_session
+    if session is not None:
+        return session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = make_session()
+        return _default_session
@@ -0,0 +1,230 @@
+import csv
+import os
+import re
+
+from common.concurrency import HostLimiter, ordered_map
+from common.mirrors import MirrorScheduler
+from common.session import get_session
+from emdb.emdb_downloader import resolve_emdb_source, get_header_data, download_emdb_map, download_emdb_image, write_emdb_header
+from pdb.pdb_cif_dataloader import download_pdb_file, get_emdb_links_bulk
+
+EMDB_ID = re.compile(r'^(?:emd[-_]?)?(\d{4,})$', re.IGNORECASE)
+PDB_ID = re.compile(r'^\d[0-9a-z]{3}$', re.IGNORECASE)
+
+
+def split_accessions(accession_list):
+    '''
+        description:
+            Function for sorting a mixed list of accession IDs into EMDB entries ('1234', 'EMD-1234')
+            and PDB entries ('6vxx'). IDs that are neither are reported and dropped.
+
+        output:
+            - (emdb_ids, pdb_ids): bare EMDB numbers and lower-case PDB IDs, deduplicated in input order
+    '''
+    emdb_ids, pdb_ids = {}, {}
+    for accession in accession_list:
+        accession = accession.strip()
+        if EMDB_ID.match(accession):
+            emdb_ids[EMDB_ID.match(accession).group(1)] = True
+        elif PDB_ID.match(accession):
+            pdb_ids[accession.lower()] = True
+        elif accession:
+            print("Skipping {}: neither an EMDB nor a PDB ID".format(accession))
+    return list(emdb_ids), list(pdb_ids)
+
+
+def resolve_emdb_entry(accession, session=None, metadata_index=None):
+    '''
+        description:
+            Function for finding the source of an EMDB entry and parsing its header, which lists the fitted PDBs.
+
+        output:
+            - (urls, header): the source's url templates and the EMDBHeader, or (None, None) if no source has the entry
+    '''
+    source = resolve_emdb_source(accession, session)
+    if source is None:
+        return None, None
+    name, message, urls = source
+    return urls, get_header_data(accession, urls["header"].format(accession), False, session, metadata_index)
+
+
+def resolve_links(emdb_ids, pdb_ids, session=None, workers=8, metadata_index=None):
+    '''
+        description:
+            Function for resolving the entries linked to the given ones across archives: the fitted PDBs of
+            every EMDB entry (from its header) and the EMDB maps of every PDB entry (from the RCSB Data API).
+            Links are followed one hop, so the plan holds the inputs plus their direct partners.
+
+        input:
+            - emdb_ids: bare EMDB numbers
+            - pdb_ids: PDB IDs
+            - session: requests.Session shared by all requests (default=common.session.get_session())
+            - workers: EMDB entries resolved concurrently (default=8)
+            - metadata_index: common.metadata_index.MetadataIndex the headers are looked up in (default=None)
+
+        output:
+            - emdb_entries: dict mapping every EMDB number in the plan to its (urls, header)
+            - pdb_ids: every PDB ID in the plan
+            - pairs: (EMDB number, PDB ID) links between entries of the plan
+    '''
+    session = get_session(session)
+
+    def resolve(accession):
+        return resolve_emdb_entry(accession, session, metadata_index)
+
+    emdb_entries = dict(zip(emdb_ids, ordered_map(resolve, emdb_ids, workers)))
+    plan_pdb_ids = dict.fromkeys(pdb_ids, True)
+    links = set()
+
+    for accession, (urls, header) in emdb_entries.items():
+        for fitted_pdb in header.fitted_pdbs if header is not None else []:
+            if PDB_ID.match(fitted_pdb):
+                plan_pdb_ids[fitted_pdb.lower()] = True
+                links.add((accession, fitted_pdb.lower()))
+
+    linked_emdb_ids = {}
+    for pdb_id, emdb_maps in get_emdb_links_bulk(pdb_ids, session).items():
+        for emdb_map in emdb_maps:
+            if EMDB_ID.match(emdb_map):
+                linked_emdb_ids[EMDB_ID.match(emdb_map).group(1)] = True
+                links.add((EMDB_ID.match(emdb_map).group(1), pdb_id.lower()))
+
+    new_emdb_ids = [accession for accession in linked_emdb_ids if accession not in emdb_entries]
+    for accession, entry in zip(new_emdb_ids, ordered_map(resolve, new_emdb_ids, workers)):
+        emdb_entries[accession] = entry
+        urls, header = entry
+        # headers of linked maps only add pairs within the plan, they don't pull in more entries
+        for fitted_pdb in header.fitted_pdbs if header is not None else []:
+            if fitted_pdb.lower() in plan_pdb_ids:
+                links.add((accession, fitted_pdb.lower()))
+
+    pairs = sorted(link for link in links if link[0] in emdb_entries and link[1] in plan_pdb_ids)
+    return emdb_entries, list(plan_pdb_ids), pairs
+
+
+def attempt(download, *args):
+    '''
+        description:
+            Calls download(*args), turning an exception into a failure message so one broken file does not
+            abort the whole batch.
+
+        output:
+            - (result of download, None), or (None, "<exception>: <message>") if it raised
+    '''
+    try:
+        return download(*args), None
+    except Exception as error:
+        return None, "{}: {}".format(type(error).__name__, error)
+
+
+def cross_archive_stub(accession_list, output_dir='.', map_=True, header=True, image=True, download_pdb=True, download_cif=True,
+                       debug_on=False, session=None, workers=8, host_limit=4, segments=1, cache=None, metadata_index=None,
+                       fastest_mirror=False, hedge=False, unzip_emdb=False, unzip_pdb=False, keep_gz=True):
+    '''
+        description:
+            Function for downloading EMDB maps together with their fitted PDB models (and PDB models with
+            their maps) in one pass. The given IDs may mix both archives; the linked entries are resolved,
+            deduplicated and every map, image, header, pdb and cif file is then downloaded exactly once
+            by a single worker pool sharing the session, the per-host limits and the cache. Headers parsed
+            while resolving are written out directly instead of being fetched again. The EMDB <-> PDB pairs
+            are written to pairs.csv, with the files of either side that failed to download; a failed or
+            raising download is reported and the batch goes on.
+
+        input:
+            - accession_list: EMDB and/or PDB accession IDs
+            - output_dir: directory all files are written to (default='.')
+            - map_, header, image: EMDB files to download (default=True)
+            - download_pdb, download_cif: PDB file types to download (default=True)
+            - debug_on: prints debugging message if True (default=False)
+            - session: requests.Session shared by all requests (default=common.session.get_session())
+            - workers: number of files downloaded concurrently (default=8)
+            - host_limit: maximum concurrent requests to a single PDB mirror host (default=4)
+            - segments: byte ranges each map is fetched in (default=1)
+            - cache: common.cache.ContentCache shared by both archives (default=None)
+            - metadata_index: common.metadata_index.MetadataIndex for the EMDB headers (default=None)
+            - fastest_mirror, hedge: PDB mirror selection, see pdb_stub (default=False)
+            - unzip_emdb, unzip_pdb: gunzips the maps / pdb and cif files while they download (default=False)
+            - keep_gz: with unzip_emdb or unzip_pdb, keeps the .gz files as well (default=True)
+
+        output:
+            - pairs: (EMDB number, PDB ID) links between the downloaded entries
+    '''
+    session = get_session(session)
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+
+    emdb_ids, pdb_ids = split_accessions(accession_list)
+    emdb_entries, pdb_ids, pairs = resolve_links(emdb_ids, pdb_ids, session, workers, metadata_index)
+    print("Plan: {} EMDB entries, {} PDB entries, {} EMDB-PDB pairs.".format(len(emdb_entries), len(pdb_ids), len(pairs)))
+
+    limiter = HostLimiter(host_limit)
+    scheduler = MirrorScheduler() if (fastest_mirror or hedge) else None
+    file_types = [file_type for file_type, wanted in (('pdb', download_pdb), ('cif', download_cif)) if wanted]
+
+    def run_task(task):
+        # returns the messages of the task and the files that failed
+        archive, accession, file_type = task
+        messages = []
+        if archive == 'pdb':
+            done, error = attempt(download_pdb_file, accession, file_type, output_dir, debug_on, limiter, messages.append, session, scheduler, hedge, cache, unzip_pdb, keep_gz)
+            if done is True:
+                return messages, []
+            messages.append("{}: {} file failed{}".format(accession, file_type, " ({})".format(error) if error else ""))
+            return messages, ["{} {}".format(accession, file_type)]
+        urls, emdb_header = emdb_entries[accession]
+        if urls is None:
+            messages.append("EMD-{}: not found in EM Data Resource or EM Resource of PDBJ or PDBE".format(accession))
+            return messages, ["EMD-{}".format(accession)]
+        failed = []
+        if map_:
+            status_code, error = attempt(download_emdb_map, accession, urls, output_dir, debug_on, session, segments, cache, unzip_emdb, keep_gz)
+            if status_code != 200:
+                failed.append("map")
+                messages.append("EMD-{}: map {}".format(accession, error or "responded with HTTP {}".format(status_code)))
+        if image:
+            status_code, error = attempt(download_emdb_image, accession, urls, output_dir, debug_on, session, cache)
+            if status_code != 200:
+                failed.append("image")
+                messages.append("EMD-{}: image {}".format(accession, error or "responded with HTTP {}".format(status_code)))
+        if header:
+            # an empty header means its download failed while resolving; no empty file is written for it
+            if not any(emdb_header):
+                failed.append("header")
+                messages.append("EMD-{}: header could not be downloaded".format(accession))
+            else:
+                error = attempt(write_emdb_header, accession, emdb_header, output_dir)[1]
+                if error:
+                    failed.append("header")
+                    messages.append("EMD-{}: header could not be written ({})".format(accession, error))
+        if failed:
+            messages.append("EMD-{}: failed ({})".format(accession, ", ".join(failed)))
+        else:
+            messages.append("EMD-{}: done".format(accession))
+        return messages, ["EMD-{} {}".format(accession, artifact) for artifact in failed]
+
+    tasks = [('emdb', accession, None) for accession in emdb_entries]
+    tasks += [('pdb', accession, file_type) for accession in pdb_ids for file_type in file_types]
+    failures = {}
+    for (archive, accession, file_type), (messages, failed) in zip(tasks, ordered_map(run_task, tasks, workers)):
+        for message in messages:
+            print(message)
+        if failed:
+            failures.setdefault((archive, accession), []).extend(failed)
+
+    failed_files = [name for names in failures.values() for name in names]
+    if failed_files:
+        print("{} files failed: {}".format(len(failed_files), ", ".join(failed_files)))
+    else:
+        print("All files downloaded.")
+
+    with open(os.path.join(output_dir, "pairs.csv"), 'w', newline='') as pairs_file:
+        writer = csv.writer(pairs_file)
+        writer.writerow(['EMDB ID', 'PDB ID', 'Failed files'])
+        writer.writerows(("EMD-{}".format(emdb_id), pdb_id, "; ".join(failures.get(('emdb', emdb_id), []) + failures.get(('pdb', pdb_id), [])))
+                         for emdb_id, pdb_id in pairs)
+
+    if cache is not None:
+        cache.report()
+    if metadata_index is not None:
+        metadata_index.save()
+    return pairs
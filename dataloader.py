@@ -2,7 +2,15 @@ import subprocess
 import argparse
 from pdb.pdb_cif_dataloader import pdb_stub
 from empiar.empiar_downloader import empiar_stub
-from emdb.emdb_downloader import emdb_stub
+from emdb.emdb_downloader import emdb_stub, emdb_stub_async
+from common.session import make_session
+from common.cache import ContentCache
+from common.metadata_index import MetadataIndex
+from common.instrumentation import RunRecorder
+from common.journal import JOURNAL_NAME, JobJournal
+from common.endpoints import BASE_URLS_VARIABLE, configure
+from cross_archive import cross_archive_stub
+from volume.store import build_stores
 import shutil,os,sys
 
 def validate_arguments(parser,args):
@@ -11,7 +19,11 @@ def validate_arguments(parser,args):
 		parser.error("Cannot have both single accession and batch list together")
 	if not args.singleId and not args.batchFileName:
 		parser.error("Please input atleast one entry/accession or the batch entry/accession file")
+	if args.resume and args.no_journal:
+		parser.error("--resume needs the job journal, it cannot be combined with --no_journal")
 	args.input_format = args.input_format.lower()
+	if args.resume and args.input_format not in ("pdb", "emdb"):
+		parser.error("--resume is only supported for pdb and emdb downloads, not for {}".format(args.input_format))
 	return args
 
 def get_accession_list(args):
@@ -26,28 +38,75 @@ def get_accession_list(args):
 	
 	return accession_list
 
-def handle_pdb_download(args,accession_list):
+def get_session(args):
+	return make_session(retries=args.retries, backoff_factor=args.backoff, pool_maxsize=max(10, args.workers))
+
+def get_cache(args):
+	if not args.cache_dir:
+		return None
+	max_bytes = int(args.cache_size * 1024 ** 3) if args.cache_size else None
+	return ContentCache(args.cache_dir, max_bytes, args.revalidate)
+
+def get_index(args):
+	if not args.index:
+		return None
+	return MetadataIndex(args.index, args.index_max_age * 24 * 3600 if args.index_max_age is not None else None)
+
+def get_recorder(args):
+	if not args.report:
+		return None
+	return RunRecorder()
+
+def get_journal(args):
+	if args.no_journal:
+		return None
+	return JobJournal(os.path.join(args.output, JOURNAL_NAME), args.resume, args.journal_retries)
+
+def handle_pdb_download(args,accession_list,recorder=None):
+	session = get_session(args)
+	cache = get_cache(args)
+	journal = get_journal(args)
 	if(args.links or args.metadata_pdb or args.ciff or args.pdb):
-		pdb_stub(accession_list,args.output,args.pdb,args.ciff,False,args.links,args.metadata_pdb)
+		pdb_stub(accession_list,args.output,args.pdb,args.ciff,False,args.links,args.metadata_pdb,workers=args.workers,host_limit=args.host_limit,session=session,fastest_mirror=args.fastest_mirror,hedge=args.hedge,cache=cache,bulk_metadata=not args.scrape_metadata,metadata_index=get_index(args),unzip=args.unzip_pdb,keep_gz=args.keep_gz,parse_structures=args.parse_structures,recorder=recorder,journal=journal)
 	else:
-		pdb_stub(accession_list,args.output)
+		pdb_stub(accession_list,args.output,workers=args.workers,host_limit=args.host_limit,session=session,fastest_mirror=args.fastest_mirror,hedge=args.hedge,cache=cache,unzip=args.unzip_pdb,keep_gz=args.keep_gz,parse_structures=args.parse_structures,recorder=recorder,journal=journal)
 
 
-def handle_empiar_download(args,accession_list):
+def handle_empiar_download(args,accession_list,recorder=None):
 	
-	empiar_stub(accession_list,args.output)
+	empiar_stub(accession_list,args.output,args.tif2mrc,args.convert_workers,args.tif2mrc_engine,args.rsync_workers,args.bwlimit,args.empiar_source,args.shard_depth,args.stream_convert,args.delete_tif,recorder)
 
-def handle_emdb_download(args,accession_list):
-	if(args.header or args.image or args.map):
-		emdb_stub(accession_list, args.output, args.map, args.header, args.image)
+def handle_emdb_download(args,accession_list,recorder=None):
+	session = get_session(args)
+	cache = get_cache(args)
+	metadata_index = get_index(args)
+	journal = get_journal(args)
+	if(args.async_emdb):
+		if(args.header or args.image or args.map):
+			emdb_stub_async(accession_list, args.output, args.map, args.header, args.image, session=session, concurrency=args.workers, segments=args.segments, cache=cache, metadata_index=metadata_index, unzip=args.unzip_emdb, keep_gz=args.keep_gz, recorder=recorder, journal=journal)
+		else:
+			emdb_stub_async(accession_list,args.output,session=session,concurrency=args.workers,segments=args.segments,cache=cache,metadata_index=metadata_index,unzip=args.unzip_emdb,keep_gz=args.keep_gz,recorder=recorder,journal=journal)
+	elif(args.header or args.image or args.map):
+		emdb_stub(accession_list, args.output, args.map, args.header, args.image, session=session, segments=args.segments, cache=cache, metadata_index=metadata_index, unzip=args.unzip_emdb, keep_gz=args.keep_gz, recorder=recorder, journal=journal)
 	else:
-		emdb_stub(accession_list,args.output)
+		emdb_stub(accession_list,args.output,session=session,segments=args.segments,cache=cache,metadata_index=metadata_index,unzip=args.unzip_emdb,keep_gz=args.keep_gz,recorder=recorder,journal=journal)
+
+def handle_paired_download(args,accession_list,recorder=None):
+	session = get_session(args)
+	if recorder is not None:
+		recorder.attach(session)
+	emdb_files = (args.map, args.header, args.image) if (args.map or args.header or args.image) else (True, True, True)
+	pdb_files = (args.pdb, args.ciff) if (args.pdb or args.ciff) else (True, True)
+	cross_archive_stub(accession_list, args.output, *emdb_files, *pdb_files, workers=args.workers, host_limit=args.host_limit, session=session, segments=args.segments, cache=get_cache(args), metadata_index=get_index(args), fastest_mirror=args.fastest_mirror, hedge=args.hedge, unzip_emdb=args.unzip_emdb, unzip_pdb=args.unzip_pdb, keep_gz=args.keep_gz)
+
+def handle_volume_store(args):
+	build_stores(args.output,args.store_workers,args.store_chunk,args.store_levels,args.store_compression)
 
 def parseArguments():
     parser = argparse.ArgumentParser(prog='dataloader', description='Data Downloader for cryo-EM/ cryo-ET and PDB files')
     required = parser.add_argument_group('Required Arguments')
     required.add_argument('-if','--input_format',
-    	help="File format to be downloaded (EMDB/EMPIAR/PDB)",
+    	help="File format to be downloaded (EMDB/EMPIAR/PDB), or PAIRED for EMDB and PDB IDs downloaded together with their linked maps/models",
     	required=True,
     	metavar='file_type')
     required.add_argument('-i',
@@ -79,15 +138,31 @@ def parseArguments():
     optional_for_pdb.add_argument('--metadata_pdb',
     	help="Download metadata for the pdb entries",
     	action='store_true')
+    optional_for_pdb.add_argument('--scrape_metadata',
+    	help="Scrape every RCSB structure page for --metadata_pdb instead of querying the RCSB Data API in bulk",
+    	action='store_true')
+    optional_for_pdb.add_argument('--fastest_mirror',
+    	help="Try the mirror with the best measured latency and hit rate first instead of RCSB, PDBe, PDBj, wwPDB in order",
+    	action='store_true')
+    optional_for_pdb.add_argument('--hedge',
+    	help="Race the two best mirrors for every file and keep the first to answer (implies --fastest_mirror)",
+    	action='store_true')
+    optional_for_pdb.add_argument('--parse_structures',
+    	help="Parse every downloaded pdb/cif file into a .atoms.npy sidecar of NumPy arrays (coordinates, elements, residues, chains, B-factors) that later loads memory-map",
+    	action='store_true')
     optional_for_pdb.add_argument('--unzip_pdb',
-    	help="Unzip the downloaded files",
+    	help="Unzip the pdb/cif files while they download (no second pass over the .gz)",
     	action='store_true')
 
 
     optional_for_emdb = parser.add_argument_group('Optional Arguments for EMDB File Format')
     optional_for_emdb.add_argument('--unzip_emdb',
-    	help="Unzip the downloaded files",
+    	help="Unzip the maps while they download (no second pass over the .gz)",
     	action='store_true')
+    optional_for_emdb.add_argument('--keep_gz',
+    	help="Keep the .gz files next to the files unzipped by --unzip_pdb/--unzip_emdb [default: %(default)s]",
+    	action=argparse.BooleanOptionalAction,
+    	default=True)
     optional_for_emdb.add_argument('--header',
     	help="Download headers",
     	action='store_true')
@@ -97,6 +172,38 @@ def parseArguments():
     optional_for_emdb.add_argument('--map',
     	help="Download map",
     	action='store_true')
+    optional_for_emdb.add_argument('--segments',
+    	help="Fetch each map as N parallel byte ranges; interrupted map downloads resume from the partial file [default: %(default)s]",
+    	type=int,
+    	default=1,
+    	metavar='N')
+    optional_for_emdb.add_argument('--async_emdb',
+    	help="Overlap the probes and map/image/header downloads of all entries (asyncio), with --workers requests in flight",
+    	action='store_true')
+
+
+    optional_for_cache = parser.add_argument_group('Optional Arguments for the Download Cache')
+    optional_for_cache.add_argument('--cache_dir',
+    	help="Keep every downloaded PDB/CIF/map/image in a content-addressed cache here and reuse it on later runs",
+    	metavar='DIR')
+    optional_for_cache.add_argument('--cache_size',
+    	help="Size cap of the cache in GB; least recently used files are evicted (unlimited if omitted)",
+    	type=float,
+    	metavar='GB')
+    optional_for_cache.add_argument('--revalidate',
+    	help="Check cached files with a conditional request (ETag/Last-Modified) instead of trusting them",
+    	action='store_true')
+
+
+    optional_for_index = parser.add_argument_group('Optional Arguments for the Metadata Index')
+    optional_for_index.add_argument('--index',
+    	help="SQLite file indexing EMDB headers, RCSB metadata and their cross-references; indexed entries are not fetched again (query it with query_index.py)",
+    	metavar='FILE')
+    optional_for_index.add_argument('--index_max_age',
+    	help="Days indexed RCSB metadata is reused before being fetched again (EMDB headers are revalidated with a conditional request instead) [default: %(default)s]",
+    	type=float,
+    	default=30,
+    	metavar='DAYS')
 
 
     optional_for_empiar = parser.add_argument_group('Optional Arguments for EMPIAR File Format')
@@ -104,8 +211,108 @@ def parseArguments():
     	help="Download metadata",
     	action='store_true')
     optional_for_empiar.add_argument('--tif2mrc',
-    	help="Download metadata",
+    	help="Convert the downloaded tif files to mrc",
+    	action='store_true')
+    optional_for_empiar.add_argument('--tif2mrc_engine',
+    	help="Conversion engine: IMOD's tif2mrc or the in-process NumPy converter [default: %(default)s]",
+    	choices=['imod', 'native'],
+    	default='imod')
+    optional_for_empiar.add_argument('--rsync_workers',
+    	help="Parallel rsync processes per entry; the entry is split into sub-directory shards (1 runs a single rsync) [default: %(default)s]",
+    	type=int,
+    	default=1,
+    	metavar='N')
+    optional_for_empiar.add_argument('--shard_depth',
+    	help="Directory levels an entry is split into shards for --rsync_workers [default: %(default)s]",
+    	type=int,
+    	default=2,
+    	metavar='N')
+    optional_for_empiar.add_argument('--bwlimit',
+    	help="Total bandwidth cap of the EMPIAR transfer in KiB/s, divided between the rsync workers",
+    	type=int,
+    	metavar='KBPS')
+    optional_for_empiar.add_argument('--empiar_source',
+    	help="rsync source of the EMPIAR entries, e.g. a local mirror directory or rsync daemon [default: %(default)s]",
+    	default="empiar.pdbj.org::empiar/archive/",
+    	metavar='SOURCE')
+    optional_for_empiar.add_argument('--stream_convert',
+    	help="With --tif2mrc, convert every tif file as soon as rsync has received it, overlapping download and conversion",
+    	action='store_true')
+    optional_for_empiar.add_argument('--delete_tif',
+    	help="With --stream_convert, remove each tif file once its mrc is written (bounds the disk used by raw files)",
+    	action='store_true')
+    optional_for_empiar.add_argument('--convert_workers',
+    	help="Number of tif files converted in parallel [default: number of cores]",
+    	type=int,
+    	metavar='N')
+
+    optional_for_store = parser.add_argument_group('Optional Arguments for the Volume Store')
+    optional_for_store.add_argument('--store',
+    	help="After downloading, convert every map (and mrc converted by --tif2mrc) to a chunked, compressed store with a resolution pyramid, so training reads only the chunks it samples",
     	action='store_true')
+    optional_for_store.add_argument('--store_chunk',
+    	help="Edge of the cubic chunks of the store in voxels [default: %(default)s]",
+    	type=int,
+    	default=64,
+    	metavar='N')
+    optional_for_store.add_argument('--store_levels',
+    	help="Pyramid levels of the store, including full resolution [default: %(default)s]",
+    	type=int,
+    	default=3,
+    	metavar='N')
+    optional_for_store.add_argument('--store_compression',
+    	help="zlib level of the chunks (ISA-L, if installed, accepts 0-3) [default: %(default)s]",
+    	type=int,
+    	default=1,
+    	metavar='LEVEL')
+    optional_for_store.add_argument('--store_workers',
+    	help="Number of maps converted in parallel [default: number of cores]",
+    	type=int,
+    	metavar='N')
+
+    optional_for_concurrency = parser.add_argument_group('Optional Arguments for Concurrent Downloads')
+    optional_for_concurrency.add_argument('--workers',
+    	help="Number of files downloaded in parallel (1 downloads sequentially) [default: %(default)s]",
+    	type=int,
+    	default=1,
+    	metavar='N')
+    optional_for_concurrency.add_argument('--host_limit',
+    	help="Maximum parallel requests sent to a single mirror host [default: %(default)s]",
+    	type=int,
+    	default=4,
+    	metavar='N')
+    optional_for_concurrency.add_argument('--retries',
+    	help="Retries for connection errors and 429/5xx responses, with exponential backoff [default: %(default)s]",
+    	type=int,
+    	default=3,
+    	metavar='N')
+    optional_for_concurrency.add_argument('--backoff',
+    	help="Base backoff in seconds between retries (doubled on every retry, plus jitter) [default: %(default)s]",
+    	type=float,
+    	default=0.5,
+    	metavar='SECONDS')
+    optional_for_concurrency.add_argument('--base_url',
+    	help="Send the PDB/EMDB requests for a public base URL to another one, as PUBLIC=LOCAL (e.g. https://files.rcsb.org=http://proxy:8080/rcsb), or every archive host under one URL, as a bare URL (see benchmark.mirror_emulator); repeatable, also read from $" + BASE_URLS_VARIABLE,
+    	action='append',
+    	metavar='URL')
+
+    optional_for_journal = parser.add_argument_group('Optional Arguments for the Job Journal')
+    optional_for_journal.add_argument('--resume',
+    	help="Resume an interrupted PDB/EMDB batch (-if pdb or emdb) from the journal in the output directory: files an earlier run finished are verified and skipped, everything else is downloaded",
+    	action='store_true')
+    optional_for_journal.add_argument('--journal_retries',
+    	help="Retry passes over the files that failed, at the end of the batch; failures never stop the batch [default: %(default)s]",
+    	type=int,
+    	default=1,
+    	metavar='N')
+    optional_for_journal.add_argument('--no_journal',
+    	help="Do not keep the job journal ({} in the output directory); a failed download then stops the batch".format(JOURNAL_NAME),
+    	action='store_true')
+
+    optional_for_report = parser.add_argument_group('Optional Arguments for the Run Report')
+    optional_for_report.add_argument('--report',
+    	help="Write a JSON run report to FILE: every request, download, parse, rsync transfer and tif conversion with its latency, bytes, mirror and retries, plus p50/p95/p99 and MB/s per kind and per mirror",
+    	metavar='FILE')
 
     
     args = parser.parse_args()
@@ -117,12 +324,24 @@ def parseArguments():
     if not os.path.exists(args.output):
     	os.mkdir(args.output)
 
+    configure(args.base_url or [])
+    recorder = get_recorder(args)
     if(args.input_format == "pdb"):
-    	handle_pdb_download(args,accession_list)
+    	handle_pdb_download(args,accession_list,recorder)
     elif(args.input_format == "empiar"):
-    	handle_empiar_download(args,accession_list)
+    	handle_empiar_download(args,accession_list,recorder)
     elif(args.input_format == "emdb"):
-    	handle_emdb_download(args,accession_list)
+    	handle_emdb_download(args,accession_list,recorder)
+    elif(args.input_format == "paired"):
+    	handle_paired_download(args,accession_list,recorder)
+
+    if(args.store and args.input_format != "pdb"):
+    	handle_volume_store(args)
+
+    if recorder is not None:
+    	recorder.print_summary()
+    	recorder.write_report(args.report)
+    	print("Run report written to {}".format(args.report))
 	
 	
 
@@ -6,95 +6,52 @@ Written by Arpita Saha
 
 import requests, os, subprocess, shutil
 import zipfile
-from bs4 import BeautifulSoup as bs
-
-def get_header_data(accession_id, headerURL, debug):
-  header_response = requests.get(headerURL)
-  if header_response.status_code == 200 and debug == True:
-        print("Downloading header file----")
-  temp_file="/content/drive/MyDrive/EMDB_Data/New_Maps/temp.xml"
-  with open(temp_file, "wb+") as file:
-    file.write(header_response.content)
-  with open(temp_file, "r") as file:
-    # Read each line in the file, readlines() returns a list of lines
-    content = file.readlines()
-    # Combine the lines in the list into a string
-    content = "".join(content)
-    bs_content = bs(content, "lxml")
-  
-  structure_title = bs_content.find("title") 
-  if structure_title is not None:
-    structure_title = structure_title.contents[0]
-  else:
-    structure_title = ""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
-  depositiondate = bs_content.find("depositiondate")
-  if depositiondate is not None:
-    depositiondate = depositiondate.contents[0]
-  else:
-    depositiondate = ""
+from common.endpoints import rebase
+from common.fetch import download_to_file
+from common.gunzip import gunzip_file, unzipped_path
+from common.journal import run_job
+from common.ranged import ranged_download
+from common.session import get_session
+from emdb.emdb_header import EMDBHeader, parse_emdb_header
 
-  headerreleasedate =  bs_content.find("headerreleasedate")
-  if headerreleasedate is not None:
-    headerreleasedate = headerreleasedate.contents[0]
-  else:
-    headerreleasedate = ""
-
-  mapreleasedate =  bs_content.find("mapreleasedate")
-  if mapreleasedate is not None:
-    mapreleasedate = mapreleasedate.contents[0]
-  else:
-    mapreleasedate = ""
-
-  fittedpdb = bs_content.find("fittedpdbentryidlist")
-  fittedpdblist = bs_content.find_all("fittedpdbentryid")
-  fitted_pdbs=""
-  if fittedpdblist is not None:
-    for i,fp in enumerate(fittedpdblist):
-      fitted_pdbs+=fittedpdblist[i].contents[0]
-      if (i<len(fittedpdblist)-1):
-        fitted_pdbs+ ", "
-  else:
-    fitted_pdbs = ""
-
-
-  articletitle = ""
-  pubmed = ""
-  doi = ""
-  issn = ""
-  published = bs_content.find("primaryreference", attrs={'published' : 'true'})
-  
-  if published is not None:
-    articletitle= published.find("articletitle")
-    if articletitle is not None:
-      articletitle = articletitle.contents[0]
-    else:
-      articletitle = ""
-    
-    pubmed=published.find("externalreference", attrs={'type' : 'pubmed'})
-    if pubmed is not None:
-      pubmed = pubmed.contents[0]
-    else:
-      pubmed = ""
+# header XML files are small and the fields sit near the top, so they are read in small pieces
+HEADER_CHUNK_SIZE = 16 * 1024
 
-    doi = published.find("externalreference", attrs={'type' : 'doi'})
-    if doi is not None:
-      doi = doi.contents[0]
-    else:
-      doi = ""
+# files of an entry, in download order; each is one job of a common.journal.JobJournal
+EMDB_ARTIFACTS = ("map", "image", "header")
 
-    issn = published.find("externalreference", attrs={'type' : 'issn'})
-    if issn is not None:
-      issn = issn.contents[0]   
-    else:
-      issn = ""
-
-  os.remove(temp_file)
-  return structure_title, fitted_pdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn 
+def get_header_data(accession_id, headerURL, debug, session=None, metadata_index=None):
+  """Streams the header XML and parses it on the fly, stopping once every field is found; returns an EMDBHeader.
+  With a common.metadata_index.MetadataIndex, an indexed entry costs one conditional request and is reused when unchanged."""
+  indexed = metadata_index.get_emdb(accession_id) if metadata_index is not None else None
+  request_headers = {}
+  if indexed is not None and indexed["etag"]:
+    request_headers["If-None-Match"] = indexed["etag"]
+  if indexed is not None and indexed["last_modified"]:
+    request_headers["If-Modified-Since"] = indexed["last_modified"]
+  with get_session(session).get(headerURL, headers=request_headers, stream=True) as header_response:
+    if header_response.status_code == 304:
+      if debug == True:
+        print("Header of EMD-{} unchanged, taken from the metadata index".format(accession_id))
+      return EMDBHeader(**{field: indexed[field] for field in EMDBHeader._fields})
+    if header_response.status_code != 200:
+      if debug == True:
+        print("Could not download header file of EMD-{} (HTTP {})".format(accession_id, header_response.status_code))
+      return parse_emdb_header([])
+    if debug == True:
+      print("Downloading header file----")
+    header = parse_emdb_header(header_response.iter_content(HEADER_CHUNK_SIZE))
+    if metadata_index is not None and any(header):
+      metadata_index.put_emdb(accession_id, header, header_response.headers.get("ETag"), header_response.headers.get("Last-Modified"))
+    return header
 
 def get_header_data_String_format(structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn):
   header_content = "Structure Title: {}\n".format(structure_title)
-  header_content += "Fitted PDBs: {}\n".format(fittedpdbs)
+  header_content += "Fitted PDBs: {}\n".format(", ".join(fittedpdbs))
   header_content += "Deposition Date: {}\n".format(depositiondate)
   header_content += "Header Release Date: {}\n".format(headerreleasedate)
   header_content += "Map Release Date: {}\n".format(mapreleasedate)
@@ -104,100 +61,281 @@ def get_header_data_String_format(structure_title, fittedpdbs, depositiondate, h
   header_content += "ISSN: {}\n".format(issn)
   return header_content
 
-def download_emdb(accession_id, output_directory, map=True, header=True, image=True, debug=True ):
-  URL_pdbj="https://ftp.pdbj.org/pub/emdb/structures/EMD-{}/".format(accession_id)
-  response = requests.get(URL_pdbj)
-  #
+# EMDB sources in fallback order: PDBJ, then EM Data Resource (files served from wwPDB), then PDBe.
+# the next source is only probed when the previous one answers 404; urls are formatted with the accession id.
+# urls go through common.endpoints.rebase when a source is resolved, so they can point at a local mirror.
+EMDB_SOURCES = [
+  ("PDBJ", "Downloaading from EM Resource of PDBJ---- \n", {
+    "probe": "https://ftp.pdbj.org/pub/emdb/structures/EMD-{0}/",
+    "map": "https://ftp.pdbj.org/pub/emdb/structures/EMD-{0}/map/emd_{0}.map.gz",
+    "image": "https://ftp.pdbj.org/pub/emdb/structures/EMD-{0}/images/emd_{0}.png",
+    "header": "https://ftp.pdbj.org/pub/emdb/structures/EMD-{0}/header/emd-{0}.xml",
+  }),
+  ("EMDataResource", "Downloaading from EM Data Resource ---- \n", {
+    "probe": "https://www.emdataresource.org/EMD-{0}",
+    "map": "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{0}/map/emd_{0}.map.gz",
+    "image": "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{0}/images/emd_{0}.png",
+    "header": "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{0}/header/emd-{0}.xml",
+  }),
+  ("PDBE", "Downloaading from EM Resource of PDBE---- \n", {
+    "probe": "https://www.ebi.ac.uk/pdbe/entry/emdb/EMD-{0}",
+    "map": "https://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{0}/map/emd_{0}.map.gz",
+    # PDBe serves the image only inside the entry bundle
+    "bundle": "https://www.ebi.ac.uk//pdbe/entry/download/EMD-{0}/bundlezip",
+    "header": "https://www.ebi.ac.uk/pdbe/entry/download/EMD-{0}/xml",
+  }),
+]
+
+def download_file(url, output_path, label, debug, session=None, segments=None, cache=None, unzip=False, keep_gz=True):
+  key = os.path.basename(output_path)
+  # with unzip the file is gunzipped while it downloads; the cache stores the .gz, so that is kept until stored
+  unzip_path = unzipped_path(output_path) if unzip == True else None
+  keep_compressed = keep_gz or cache is not None
+  if cache is not None and cache.restore(key, output_path, session):
+    if debug == True:
+      print("Using cached {} file----".format(label))
+    if unzip_path is not None:
+      gunzip_file(output_path, unzip_path, keep_gz)
+    return 200
+  # with segments, the file is fetched with resumable range requests (segments > 1 fetches byte ranges in parallel)
+  headers = {}
+  if segments is None:
+    status_code = download_to_file(url, output_path, session=session, response_headers=headers, unzip_path=unzip_path, keep_compressed=keep_compressed)
+  else:
+    status_code = ranged_download(url, output_path, session, segments, response_headers=headers, unzip_path=unzip_path, keep_compressed=keep_compressed)
+  if status_code == 200 and cache is not None:
+    cache.store(key, output_path, url, headers)
+    if unzip_path is not None and keep_gz == False:
+      os.remove(output_path)
+  if status_code == 200 and debug == True:
+    print("Downloading {} file----".format(label))
+  return status_code
+
+def restore_emdb_from_cache(accession_id, output_directory, map, header, image, debug, session=None, cache=None, unzip=False, keep_gz=True):
+  """Serves the map and image of an entry straight from the cache, without probing any source, when both are cached."""
+  if cache is None or header == True:
+    return False
+  names = []
+  if map == True:
+    names.append("emd_{}.map.gz".format(accession_id))
+  if image == True:
+    names.append("emd_{}.png".format(accession_id))
+  if not names or not all(cache.lookup(name) for name in names):
+    return False
+  for name in names:
+    if cache.restore(name, output_directory+"/"+name, session) == False:
+      # evicted meanwhile, the entry is downloaded instead
+      return False
+    if unzip == True and name.endswith(".gz"):
+      gunzip_file(output_directory+"/"+name, keep_compressed=keep_gz)
+  if debug == True:
+    print("Using cached files for EMD-{}----".format(accession_id))
+  return True
+
+def resolve_emdb_source(accession_id, session=None):
+  """Probes EMDB_SOURCES in order, returns the (name, message, urls) of the first one holding the entry, else None."""
+  session = get_session(session)
+  for name, message, urls in EMDB_SOURCES:
+    urls = {key: rebase(url) for key, url in urls.items()}
+    response = session.get(urls["probe"].format(accession_id))
+    if response.status_code == 200:
+      return name, message, urls
+    if response.status_code != 404:
+      break
+  return None
+
+def download_emdb_map(accession_id, urls, output_directory, debug, session=None, segments=1, cache=None, unzip=False, keep_gz=True):
+  return download_file(urls["map"].format(accession_id), output_directory+"/emd_{}.map.gz".format(accession_id), ".map", debug, session, segments, cache, unzip, keep_gz)
+
+def download_emdb_image(accession_id, urls, output_directory, debug, session=None, cache=None):
+  if "image" in urls:
+    return download_file(urls["image"].format(accession_id), output_directory+"/emd_{}.png".format(accession_id), "image", debug, session, cache=cache)
+  if cache is not None and cache.restore("emd_{}.png".format(accession_id), output_directory+"/emd_{}.png".format(accession_id), session):
+    return 200
+  # bundle and extraction folder are named per entry so concurrent downloads don't clash
+  output_ = output_directory+"/bundle_EMD-{}.zip".format(accession_id)
+  extracted_folder = output_directory+"/extracted_EMD-{}".format(accession_id)
+  status_code = download_file(urls["bundle"].format(accession_id), output_, "image", debug, session)
+  if status_code != 200:
+    return status_code
+  if not os.path.exists(extracted_folder):
+    os.mkdir(extracted_folder)
+  with zipfile.ZipFile(output_, 'r') as zip_ref:
+    zip_ref.extractall(extracted_folder)
+  image_file_path = extracted_folder+"/EMD-{}/images/emd_{}.png".format(accession_id,accession_id)
+  shutil.copy(image_file_path, output_directory)
+  if cache is not None:
+    cache.store("emd_{}.png".format(accession_id), output_directory+"/emd_{}.png".format(accession_id), urls["bundle"].format(accession_id))
+  shutil.rmtree(extracted_folder)
+  os.remove(output_)
+  return 200
+
+def write_emdb_header(accession_id, header, output_directory):
+  """Writes an EMDBHeader as header_emd_<id>.txt."""
+  with open(output_directory+"/header_emd_{}.txt".format(accession_id), 'w+') as output_file:
+    output_file.write(get_header_data_String_format(*header))
+
+def download_emdb_header(accession_id, urls, output_directory, debug, session=None, metadata_index=None):
+  header = get_header_data(accession_id, urls["header"].format(accession_id), debug, session, metadata_index)
+  write_emdb_header(accession_id, header, output_directory)
+  return header
+
+def emdb_artifact_paths(accession_id, artifact, output_directory):
+  """Files one of EMDB_ARTIFACTS of an entry is written to; a map may end up gunzipped only."""
+  if artifact == "map":
+    map_path = output_directory+"/emd_{}.map.gz".format(accession_id)
+    return [map_path, unzipped_path(map_path)]
+  if artifact == "image":
+    return [output_directory+"/emd_{}.png".format(accession_id)]
+  return [output_directory+"/header_emd_{}.txt".format(accession_id)]
+
+def emdb_jobs(accession_list, map, header, image):
+  """(accession, artifact) jobs of a batch, for common.journal.JobJournal.plan."""
+  return [(entry, artifact) for entry in accession_list for artifact, wanted in zip(EMDB_ARTIFACTS, (map, image, header)) if wanted == True]
+
+def unique_accessions(jobs):
+  """Accessions of the jobs, once each and in order."""
+  return list(dict.fromkeys(entry for entry, artifact in jobs))
+
+def emdb_artifacts(accession_id, map, header, image, journal=None):
+  """Artifacts of the entry still to download: the wanted ones, minus those the journal has done."""
+  artifacts = [artifact for entry, artifact in emdb_jobs([accession_id], map, header, image)]
+  if journal is not None:
+    artifacts = journal.remaining(accession_id, artifacts)
+  return artifacts
+
+def fetch_emdb_artifact(accession_id, artifact, urls, output_directory, debug, session=None, segments=1, cache=None, metadata_index=None, unzip=False, keep_gz=True, journal=None):
+  """Downloads the map, image or header of an entry, as a job of the common.journal.JobJournal if one is given."""
+  def download():
+    if artifact == "header":
+      return any(download_emdb_header(accession_id, urls, output_directory, debug, session, metadata_index)) or "header could not be downloaded"
+    if artifact == "map":
+      status_code = download_emdb_map(accession_id, urls, output_directory, debug, session, segments, cache, unzip, keep_gz)
+    else:
+      status_code = download_emdb_image(accession_id, urls, output_directory, debug, session, cache)
+    return status_code == 200 or "HTTP {}".format(status_code)
+  return run_job(journal, accession_id, artifact, emdb_artifact_paths(accession_id, artifact, output_directory), download)
+
+def record_emdb_artifacts(accession_id, artifacts, output_directory, result, journal=None):
+  """Records the artifacts settled without a download (restored from the cache, or the entry was not found)."""
+  for artifact in artifacts:
+    run_job(journal, accession_id, artifact, emdb_artifact_paths(accession_id, artifact, output_directory), lambda: result)
+
+def download_emdb(accession_id, output_directory, map=True, header=True, image=True, debug=True, session=None, segments=1, cache=None, metadata_index=None, unzip=False, keep_gz=True, journal=None):
+  session = get_session(session)
   if not os.path.exists(output_directory):
     os.mkdir(output_directory)
-  if (response.status_code == 200): #found at PDBJ
-    if debug == True:
-      print("Downloaading from EM Resource of PDBJ---- \n")
-    if (map==True):
-      map_url = URL_pdbj+"map/emd_{}.map.gz".format(accession_id)
-      map_response = requests.get(map_url)
-      if map_response.status_code == 200 and debug == True:
-        print("Downloading .map file----")
-      with open(output_directory+"/emd_{}.map.gz".format(accession_id), 'wb') as output_file:
-        output_file.write(map_response.content)
-    if (image == True):
-      image_url = URL_pdbj + "images/emd_{}.png".format(accession_id)
-      image_response = requests.get(image_url)
-      if image_response.status_code == 200 and debug == True:
-        print("Downloading image file----")
-      with open(output_directory+"/emd_{}.png".format(accession_id), 'wb') as output_file:
-        output_file.write(image_response.content)
-    if header == True:
-      header_url = "https://ftp.pdbj.org/pub/emdb/structures/EMD-{}/header/emd-{}.xml".format(accession_id, accession_id)
-      structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn = get_header_data(accession_id, header_url, debug)
-      header_content = get_header_data_String_format(structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn)
-      with open(output_directory+"/header_emd_{}.txt".format(accession_id), 'w+') as output_file:
-        output_file.write(header_content)
-  elif response.status_code == 404: #Not found in PDBJ
-      URL_EMDataResource = "https://www.emdataresource.org/EMD-{}".format(accession_id)
-      response = requests.get(URL_EMDataResource)
-      if response.status_code == 200: #downloading from EM Data Resource 
-        if debug == True:
-          print("Downloaading from EM Data Resource ---- \n")
-        if (map==True):
-          map_url = "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{}/map/emd_{}.map.gz".format(accession_id, accession_id)
-          map_response = requests.get(map_url)
-          if map_response.status_code == 200 and debug == True:
-            print("Downloading .map file----")
-          with open(output_directory+"/emd_{}.map.gz".format(accession_id), 'wb') as output_file:
-            output_file.write(map_response.content)
-        if (image == True):
-          image_url = "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{}/images/emd_{}.png".format(accession_id, accession_id)
-          image_response = requests.get(image_url)
-          if image_response.status_code == 200 and debug == True:
-            print("Downloading image file----")
-          with open(output_directory+"/emd_{}.png".format(accession_id), 'wb') as output_file:
-            output_file.write(image_response.content)
-        if (header == True):
-          header_url = "https://ftp.wwpdb.org/pub/emdb/structures/EMD-{}/header/emd-{}.xml".format(accession_id, accession_id)
-          structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn = get_header_data(accession_id, header_url, debug)
-          header_content = get_header_data_String_format(structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn)
-          with open(output_directory+"/header_emd_{}.txt".format(accession_id), 'w+') as output_file:
-            output_file.write(header_content)
-      elif ressponse.status_code == 404: # Not found in EM Data Resource
-        URL_pdbE = "https://www.ebi.ac.uk/pdbe/entry/emdb/EMD-{}".format()
-        response = requests.get(URL_pdbE) # searching in pdb E
-        if response.status_code == 200:
-          if debug == True:
-            print("Downloaading from EM Resource of PDBE---- \n")
-          if map == True:
-            map_url="ftp://ftp.ebi.ac.uk/pub/databases/emdb/structures/EMD-{}/map/emd_{}.map.gz".format(accession_id, accession_id)
-            map_response = requests.get(map_url)
-            if map_response.status_code == 200 and debug == True:
-              print("Downloading .map file----")
-            with open(output_directory+"/emd_{}.map.gz".format(accession_id), 'wb') as output_file:
-              output_file.write(map_response.content)
-          if header == True:
-            header_url = "https://www.ebi.ac.uk/pdbe/entry/download/EMD-{}/xml".format(accession_id)
-            structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn = get_header_data(accession_id, header_url, debug)
-            header_content = get_header_data_String_format(structure_title, fittedpdbs, depositiondate, headerreleasedate, mapreleasedate, articletitle, pubmed, doi, issn)
-            with open(output_directory+"/header_emd_{}.txt".format(accession_id), 'w+') as output_file:
-              output_file.write(header_content)
-          if image == True:
-            bundle_url = "https://www.ebi.ac.uk//pdbe/entry/download/EMD-{}/bundlezip".format(accession_id)
-            output_ = output_directory+"/bundle.zip"
-            for path in execute(["wget", "-O", output_, bundle_url]):
-              print(path, end="")
-            if debug == True:
-              print("Downloading image file----")
-            if not os.path.exists(output_directory+"/extracted_folder"):
-              os.mkdir(output_directory+"/extracted_folder")
-            with zipfile.ZipFile(output_, 'r') as zip_ref:
-              zip_ref.extractall(output_directory+"/extracted_folder")
-            image_file_path = output_directory+"/extracted_folder/EMD-{}/images/emd_{}.png".format(accession_id,accession_id)
-            shutil.copy(image_file_path, output_directory)
-            os.remove(output_directory+"/extracted_folder")
-          else:
-            print("Not found in EM Data Resource or EM Resource of PDBJ or PDBE")
-
-def emdb_stub(accession_list, output_directory, map_=True, header=True, image=True, debug=True):
+  artifacts = emdb_artifacts(accession_id, map, header, image, journal)
+  if not artifacts:
+    return
+  map, image, header = [artifact in artifacts for artifact in EMDB_ARTIFACTS]
+  if restore_emdb_from_cache(accession_id, output_directory, map, header, image, debug, session, cache, unzip, keep_gz):
+    record_emdb_artifacts(accession_id, artifacts, output_directory, True, journal)
+    return
+  try:
+    source = resolve_emdb_source(accession_id, session)
+  except requests.RequestException as error:
+    # with a journal an unreachable source fails the entry's jobs instead of the batch
+    if journal is None:
+      raise
+    record_emdb_artifacts(accession_id, artifacts, output_directory, "{}: {}".format(type(error).__name__, error), journal)
+    return
+  if source is None:
+    print("Not found in EM Data Resource or EM Resource of PDBJ or PDBE")
+    record_emdb_artifacts(accession_id, artifacts, output_directory, "not found in EM Data Resource or EM Resource of PDBJ or PDBE", journal)
+    return
+  name, message, urls = source
+  if debug == True:
+    print(message)
+  for artifact in artifacts:
+    fetch_emdb_artifact(accession_id, artifact, urls, output_directory, debug, session, segments, cache, metadata_index, unzip, keep_gz, journal)
+
+def emdb_stub(accession_list, output_directory, map_=True, header=True, image=True, debug=True, session=None, segments=1, cache=None, metadata_index=None, unzip=False, keep_gz=True, recorder=None, journal=None):
+  """Downloads the entries one after the other; with a common.instrumentation.RunRecorder, every request and download is recorded.
+  With a common.journal.JobJournal, every file is a job: failed ones are retried at the end instead of stopping the batch,
+  and when resuming the files an earlier run finished are skipped."""
+  session = get_session(session)
+  if recorder is not None:
+    recorder.attach(session)
+  if journal is not None:
+    jobs = emdb_jobs(accession_list, map_, header, image)
+    accession_list = unique_accessions(journal.plan(jobs))
   for entry in accession_list:
-    download_emdb(entry,output_directory,map_,header,image,debug)
+    download_emdb(entry,output_directory,map_,header,image,debug,session,segments,cache,metadata_index,unzip,keep_gz,journal)
+  if journal is not None:
+    for queue in journal.retry_queue(jobs):
+      for entry in unique_accessions(queue):
+        download_emdb(entry,output_directory,map_,header,image,debug,session,segments,cache,metadata_index,unzip,keep_gz,journal)
+    journal.report(jobs)
+  if cache is not None:
+    cache.report()
+  if metadata_index is not None:
+    metadata_index.save()
+
+async def download_emdb_async(accession_id, output_directory, map, header, image, debug, segments, cache, metadata_index, unzip, keep_gz, run, journal=None):
+  """Async counterpart of download_emdb: same source fallback, then map, image and header fetched concurrently."""
+  artifacts = emdb_artifacts(accession_id, map, header, image, journal)
+  if not artifacts:
+    return
+  map, image, header = [artifact in artifacts for artifact in EMDB_ARTIFACTS]
+  if await run(restore_emdb_from_cache, accession_id, output_directory, map, header, image, debug, cache=cache, unzip=unzip, keep_gz=keep_gz):
+    record_emdb_artifacts(accession_id, artifacts, output_directory, True, journal)
+    return
+  try:
+    source = await run(resolve_emdb_source, accession_id)
+  except requests.RequestException as error:
+    if journal is None:
+      raise
+    record_emdb_artifacts(accession_id, artifacts, output_directory, "{}: {}".format(type(error).__name__, error), journal)
+    return
+  if source is None:
+    print("Not found in EM Data Resource or EM Resource of PDBJ or PDBE")
+    record_emdb_artifacts(accession_id, artifacts, output_directory, "not found in EM Data Resource or EM Resource of PDBJ or PDBE", journal)
+    return
+  name, message, urls = source
+  if debug == True:
+    print(message)
+  await asyncio.gather(*[run(fetch_emdb_artifact, accession_id, artifact, urls, output_directory, debug, segments=segments, cache=cache, metadata_index=metadata_index,
+                             unzip=unzip, keep_gz=keep_gz, journal=journal) for artifact in artifacts])
+
+async def _emdb_batch_async(accession_list, output_directory, map_, header, image, debug, session, concurrency, segments, cache, metadata_index, unzip, keep_gz, journal=None):
+  loop = asyncio.get_running_loop()
+  semaphore = asyncio.Semaphore(concurrency)
+  executor = ThreadPoolExecutor(max_workers=concurrency)
+
+  async def run(func, *args, **kwargs):
+    # every blocking request (probe or file) holds one slot of the global semaphore
+    async with semaphore:
+      return await loop.run_in_executor(executor, functools.partial(func, *args, session=session, **kwargs))
+
+  try:
+    await asyncio.gather(*[download_emdb_async(entry, output_directory, map_, header, image, debug, segments, cache, metadata_index, unzip, keep_gz, run, journal) for entry in accession_list])
+  finally:
+    executor.shutdown(wait=True)
+
+def emdb_stub_async(accession_list, output_directory, map_=True, header=True, image=True, debug=True, session=None, concurrency=8, segments=1, cache=None, metadata_index=None, unzip=False, keep_gz=True, recorder=None, journal=None):
+  """
+  Downloads all entries with the probes and map/image/header fetches of every accession overlapped,
+  at most `concurrency` requests in flight at once. Requests go through the shared pooled session,
+  so retries, keep-alive, chunked streaming, the recorder and the journal behave exactly like in emdb_stub.
+  """
+  if not os.path.exists(output_directory):
+    os.mkdir(output_directory)
+  session = get_session(session)
+  if recorder is not None:
+    recorder.attach(session)
+  if journal is not None:
+    jobs = emdb_jobs(accession_list, map_, header, image)
+    accession_list = unique_accessions(journal.plan(jobs))
+  asyncio.run(_emdb_batch_async(accession_list, output_directory, map_, header, image, debug, session, concurrency, segments, cache, metadata_index, unzip, keep_gz, journal))
+  if journal is not None:
+    for queue in journal.retry_queue(jobs):
+      asyncio.run(_emdb_batch_async(unique_accessions(queue), output_directory, map_, header, image, debug, session, concurrency, segments, cache, metadata_index, unzip, keep_gz, journal))
+    journal.report(jobs)
+  if cache is not None:
+    cache.report()
+  if metadata_index is not None:
+    metadata_index.save()
 
 #example
 # def main(accession_id):
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""EMDB header parser
+Extracts the fields written to header_emd_<id>.txt from an EMDB header XML while it streams in.
+"""
+
+from collections import namedtuple
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+EMDBHeader = namedtuple("EMDBHeader", ["structure_title", "fitted_pdbs", "deposition_date", "header_release_date",
+                                       "map_release_date", "article_title", "pubmed", "doi", "issn"])
+
+# first occurrence of these elements (lower-cased, namespace stripped) anywhere in the document
+FIRST_TEXT_FIELDS = {
+  "title": "structure_title",
+  "depositiondate": "deposition_date",
+  "headerreleasedate": "header_release_date",
+  "mapreleasedate": "map_release_date",
+}
+
+# fields read from inside the first <primaryReference published="true">
+REFERENCE_FIELDS = {
+  ("articletitle", None): "article_title",
+  ("externalreference", "pubmed"): "pubmed",
+  ("externalreference", "doi"): "doi",
+  ("externalreference", "issn"): "issn",
+}
+
+# all of the fields above live in the top-level deposition section of a v1.9 header, nothing after it needs to be read;
+# v3 headers have no such section, their <deposition> elements (admin/sites, admin/key_dates) sit deeper
+HEADER_SECTION = "deposition"
+HEADER_SECTION_DEPTH = 2
+
+def _local_name(tag):
+  return tag.rsplit("}", 1)[-1].lower()
+
+def _attribute(element, name):
+  for key, value in element.attrib.items():
+    if _local_name(key) == name:
+      return value
+  return None
+
+def parse_emdb_header(chunks):
+  """Parses an EMDB header from an iterable of byte chunks, stopping once every field is found; returns an EMDBHeader."""
+  record = dict.fromkeys(EMDBHeader._fields, "")
+  found = set()
+  fitted_pdbs = []
+  fitted_done = False
+  reference_state = None # None before the published reference, "open" inside it, "done" after it
+  depth = 0 # of the current element, the root is 1
+
+  parser = XMLPullParser(events=("start", "end"))
+  try:
+    for chunk in chunks:
+      parser.feed(chunk)
+      for event, element in parser.read_events():
+        name = _local_name(element.tag)
+        if event == "start":
+          depth += 1
+          if name == "primaryreference" and reference_state is None and _attribute(element, "published") == "true":
+            reference_state = "open"
+          continue
+        depth -= 1
+
+        if name in FIRST_TEXT_FIELDS and FIRST_TEXT_FIELDS[name] not in found:
+          record[FIRST_TEXT_FIELDS[name]] = (element.text or "").strip()
+          found.add(FIRST_TEXT_FIELDS[name])
+        elif name == "fittedpdbentryid" and not fitted_done:
+          fitted_pdbs.append((element.text or "").strip())
+        elif name == "fittedpdbentryidlist":
+          fitted_done = True
+        elif reference_state == "open":
+          key = (name, _attribute(element, "type") if name == "externalreference" else None)
+          if key in REFERENCE_FIELDS and REFERENCE_FIELDS[key] not in found:
+            record[REFERENCE_FIELDS[key]] = (element.text or "").strip()
+            found.add(REFERENCE_FIELDS[key])
+          elif name == "primaryreference":
+            reference_state = "done"
+        # children were handled when they ended, so the subtree is not kept around
+        element.clear()
+
+        if (name == HEADER_SECTION and depth + 1 == HEADER_SECTION_DEPTH) or (fitted_done and reference_state == "done" and found.issuperset(FIRST_TEXT_FIELDS.values())):
+          record["fitted_pdbs"] = fitted_pdbs
+          return EMDBHeader(**record)
+  except ParseError:
+    # a truncated or non-XML body keeps whatever was read before the error
+    pass
+  record["fitted_pdbs"] = fitted_pdbs
+  return EMDBHeader(**record)
@@ -0,0 +1,244 @@
+import functools
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from empiar.native_tif2mrc import convert_file_native
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+def find_tiffs(direc):
+    '''
+        description:
+            Function for listing the tif files below a directory.
+
+        input:
+            - direc: directory containing the tif files
+
+        output:
+            - list of (tif file, mrc file) path pairs, the mrc next to its tif
+    '''
+    pairs = []
+    for folder, subs, files in os.walk(direc):
+        for file in sorted(files):
+            name, extension = os.path.splitext(file)
+            if extension.lower() in TIFF_EXTENSIONS:
+                pairs.append((os.path.join(folder, file), os.path.join(folder, name + ".mrc")))
+    return pairs
+
+
+def converted_tiffs(direc):
+    '''
+        description:
+            Function for listing the tif files below a directory that were converted and then removed
+            (ConversionPipeline with delete_tif): those of every mrc that is not empty and has no tif
+            next to it. A transfer excludes them, so a re-run does not download them again.
+
+        input:
+            - direc: directory the tif files were converted in
+
+        output:
+            - list of tif paths relative to direc, one per tif extension of each such mrc
+    '''
+    converted = []
+    for folder, subs, files in os.walk(direc):
+        names = {os.path.splitext(file)[0] for file in files if os.path.splitext(file)[1].lower() in TIFF_EXTENSIONS}
+        for file in sorted(files):
+            name, extension = os.path.splitext(file)
+            if extension == ".mrc" and name not in names and os.path.getsize(os.path.join(folder, file)) > 0:
+                relative = os.path.relpath(os.path.join(folder, name), direc)
+                converted += [relative + tiff_extension for tiff_extension in TIFF_EXTENSIONS]
+    return converted
+
+
+def is_up_to_date(in_file, out_file):
+    '''
+        output:
+            - True if out_file exists, is not empty and is not older than in_file
+    '''
+    try:
+        out_stat = os.stat(out_file)
+    except OSError:
+        return False
+    return out_stat.st_size > 0 and out_stat.st_mtime >= os.stat(in_file).st_mtime
+
+
+def convert_file(in_file, out_file):
+    '''
+        description:
+            Function for converting one tif file to an mrc file with IMOD's tif2mrc.
+
+        input:
+            - in_file: tif file
+            - out_file: mrc file to write
+
+        output:
+            - (in_file, error message or None, seconds taken)
+    '''
+    start_time = time.time()
+    try:
+        result = subprocess.run(['tif2mrc', in_file, out_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    except OSError as error:
+        return in_file, str(error), time.time() - start_time
+    if result.returncode != 0:
+        return in_file, "tif2mrc exited with {}: {}".format(result.returncode, result.stdout.strip()[-500:]), time.time() - start_time
+    return in_file, None, time.time() - start_time
+
+
+# conversion engines: IMOD's tif2mrc binary, or the in-process NumPy converter
+ENGINES = {
+    'imod': convert_file,
+    'native': convert_file_native,
+}
+
+
+def convert_directory(direc, workers=None, force=False, engine='imod', recorder=None):
+    '''
+        description:
+            Function for converting every tif file below a directory to mrc, several at a time.
+            Files whose mrc is already up to date are skipped unless force is set, and a failed
+            file is reported without stopping the others.
+
+        input:
+            - direc: directory containing the tif files
+            - workers: conversions run in parallel (default=None, the number of cores)
+            - force: converts files even if their mrc is up to date (default=False)
+            - engine: 'imod' or 'native', see ENGINES (default='imod')
+            - recorder: common.instrumentation.RunRecorder every conversion is recorded to (default=None)
+
+        output:
+            - results: list of (tif file, error message or None, seconds taken) for the converted files
+    '''
+    pairs = find_tiffs(direc)
+    todo = [(in_file, out_file) for in_file, out_file in pairs if force or not is_up_to_date(in_file, out_file)]
+    print("Converting {} tif files to mrc ({} up to date)".format(len(todo), len(pairs) - len(todo)))
+
+    results = []
+    start_time = time.time()
+    sizes = {in_file: os.path.getsize(in_file) for in_file, out_file in todo}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(ENGINES[engine], in_file, out_file) for in_file, out_file in todo]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print_result(*results[-1])
+            record_conversion(recorder, engine, sizes, *results[-1])
+
+    print_summary(results, start_time)
+    return results
+
+
+def print_result(in_file, error, seconds):
+    if error is None:
+        print("\tConverted {} in {:.2f}s".format(in_file, seconds))
+    else:
+        print("\tFailed {} after {:.2f}s: {}".format(in_file, seconds, error))
+
+
+def record_conversion(recorder, engine, sizes, in_file, error, seconds):
+    # bytes are those of the tif, so the MB/s of the report is the rate tif data is converted at
+    if recorder is not None:
+        recorder.record('conversion', name=in_file, engine=engine, bytes=sizes.get(in_file), seconds=seconds, error=error)
+
+
+def print_summary(results, start_time):
+    failures = [result for result in results if result[1] is not None]
+    print("Converted {} files in {:.2f}s, {} failed.".format(len(results) - len(failures), time.time() - start_time, len(failures)))
+    for in_file, error, seconds in failures:
+        print("\t{}: {}".format(in_file, error))
+
+
+class ConversionPipeline:
+    '''
+        description:
+            Converts tif files while the rest of the entry is still downloading. The transfer hands every
+            file to submit() as soon as it is complete; tif files go to a process pool through a bounded
+            queue of max_pending files. When the pool falls behind, submit() blocks, which stalls the
+            reader of the rsync output and so rsync itself: download and conversion overlap, and with
+            delete_tif the raw tifs on disk never exceed the queue. The removed tifs are found again by
+            converted_tiffs(), which the transfers exclude so that a re-run does not download them again.
+
+        input:
+            - workers: conversions run in parallel (default=None, the number of cores)
+            - engine: 'imod' or 'native', see ENGINES (default='imod')
+            - force: converts files even if their mrc is up to date (default=False)
+            - delete_tif: removes every tif once its mrc has been written (default=False)
+            - max_pending: tif files queued or converting at once (default=2 * workers)
+            - recorder: common.instrumentation.RunRecorder every conversion is recorded to (default=None)
+    '''
+
+    def __init__(self, workers=None, engine='imod', force=False, delete_tif=False, max_pending=None, recorder=None):
+        workers = workers or os.cpu_count()
+        self.engine = engine
+        self.force = force
+        self.delete_tif = delete_tif
+        self.recorder = recorder
+        self.results = []
+        self._sizes = {}
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._lock = threading.Lock()
+        self._submitted = set()
+        self._start_time = time.time()
+
+    def submit(self, path):
+        '''
+            description:
+                Queues path for conversion if it is a tif file not seen before, blocking while the queue is full.
+        '''
+        name, extension = os.path.splitext(path)
+        if extension.lower() not in TIFF_EXTENSIONS:
+            return
+        # shards of an entry are transferred by several threads, each calling submit()
+        with self._lock:
+            if path in self._submitted:
+                return
+            self._submitted.add(path)
+        out_file = name + ".mrc"
+        if not self.force and is_up_to_date(path, out_file):
+            self._converted(path)
+            return
+        self._slots.acquire()
+        self._sizes[path] = os.path.getsize(path)
+        future = self._executor.submit(ENGINES[self.engine], path, out_file)
+        future.add_done_callback(functools.partial(self._done, path))
+
+    def _done(self, path, future):
+        try:
+            try:
+                in_file, error, seconds = future.result()
+            except Exception as exception:
+                # e.g. a worker process killed by the OS
+                in_file, error, seconds = path, "{}: {}".format(type(exception).__name__, exception), 0.0
+            with self._lock:
+                self.results.append((in_file, error, seconds))
+                print_result(in_file, error, seconds)
+            # popped, so the sizes of a long entry are not kept until the end
+            size = self._sizes.pop(path, None)
+            record_conversion(self.recorder, self.engine, {in_file: size}, in_file, error, seconds)
+            if error is None:
+                self._converted(in_file)
+        finally:
+            self._slots.release()
+
+    def _converted(self, in_file):
+        if self.delete_tif and os.path.exists(in_file):
+            os.remove(in_file)
+
+    def finish(self, direc=None):
+        '''
+            description:
+                Converts the tif files below direc the transfer did not report (e.g. already downloaded by
+                an earlier run), waits for all conversions and prints the summary.
+
+            output:
+                - results: list of (tif file, error message or None, seconds taken) for the converted files
+        '''
+        if direc is not None:
+            for in_file, out_file in find_tiffs(direc):
+                self.submit(in_file)
+        self._executor.shutdown(wait=True)
+        print_summary(self.results, self._start_time)
+        return self.results
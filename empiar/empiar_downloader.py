@@ -1,7 +1,27 @@
 import subprocess
+import contextlib
 import glob
+import tempfile
 from pprint import pprint
 import os,sys
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from common.instrumentation import timed
+from empiar.conversion import TIFF_EXTENSIONS, ConversionPipeline, convert_directory, converted_tiffs
+
+# rsync source the EMPIAR entries live under; a local directory (ending in '/') or another rsync daemon works too
+EMPIAR_SOURCE = "empiar.pdbj.org::empiar/archive/"
+
+# per-file line requested from rsync; since the format has %b, rsync logs it only once the file is complete
+FILE_DONE_PREFIX = "<<done>> "
+FILE_DONE_FORMAT = "--out-format=" + FILE_DONE_PREFIX + "%b %n"
+
+# "Total bytes received: 1,234,567" as printed by --stats, the bytes that came over the wire
+BYTES_RECEIVED_LINE = re.compile(r'^Total bytes received: ([\d,]+)')
 
 def execute(cmd):
     '''
@@ -17,13 +37,88 @@ def execute(cmd):
 
 
 
-def download(entry,output_direc):
+def parse_file_done(line):
+    '''
+        output:
+            - path (relative to the transfer root) of the file a FILE_DONE_FORMAT line reports, else None
+    '''
+    # the line may follow an unterminated progress update on the same line
+    start = line.find(FILE_DONE_PREFIX)
+    if start == -1:
+        return None
+    name = line[start:].rstrip("\n").split(" ", 2)[2]
+    return None if name.endswith("/") else name
+
+
+def parse_bytes_received(line):
+    '''
+        output:
+            - bytes received if line is the BYTES_RECEIVED_LINE of --stats, else None
+    '''
+    match = BYTES_RECEIVED_LINE.match(line)
+    return int(match.group(1).replace(",", "")) if match else None
+
+
+def source_host(source):
+    '''
+        output:
+            - host of an rsync daemon source ('empiar.pdbj.org::empiar/archive/', 'rsync://host/module/'),
+              'local' for a directory
+    '''
+    if source.startswith("rsync://"):
+        return urlsplit(source).netloc
+    return source.split("::")[0] if "::" in source else "local"
+
+
+def entry_directory(entry, output_direc):
+    '''
+        output:
+            - directory the files of an entry are written to, <output_direc>/<entry>, by a single rsync
+              and by the shard workers alike
+    '''
+    return os.path.join(output_direc, str(entry))
+
+
+@contextlib.contextmanager
+def exclude_file(skip, relative=""):
+    '''
+        description:
+            Writes the paths of skip below relative as rsync patterns anchored at relative, the root of the
+            transfer, to a temporary file for --exclude-from. The file is removed on exit.
+
+        input:
+            - skip: paths relative to the entry directory, None for none
+            - relative: directory of the entry the transfer starts at (default="")
+
+        output:
+            - path of the file, None if none of skip is below relative
+    '''
+    prefix = relative.strip("/") + "/" if relative.strip("/") else ""
+    patterns = ["/" + path.replace(os.sep, "/")[len(prefix):] for path in (skip or []) if path.replace(os.sep, "/").startswith(prefix)]
+    if not patterns:
+        yield None
+        return
+    descriptor, path = tempfile.mkstemp(prefix="empiar-exclude-", suffix=".txt")
+    try:
+        with os.fdopen(descriptor, 'w') as exclude:
+            exclude.write("\n".join(patterns) + "\n")
+        yield path
+    finally:
+        os.remove(path)
+
+
+def download(entry,output_direc,bwlimit=None,source=EMPIAR_SOURCE,on_file=None,recorder=None,skip=None):
     '''
         description:
             Function for downloading the empiar file
     
         input:
             - entry: EMPIAR entry or accession number
+            - bwlimit: bandwidth cap in KiB/s (default=None, unlimited)
+            - source: rsync source the entries live under (default=EMPIAR_SOURCE)
+            - on_file: called with the path of every file once it is complete (default=None)
+            - recorder: common.instrumentation.RunRecorder the transfer is recorded to (default=None)
+            - skip: paths relative to the entry directory that are not transferred (default=None)
             
             
         output:
@@ -32,53 +127,285 @@ def download(entry,output_direc):
     '''
     #Create URL Link
     print("Starting Download")
-    url = "empiar.pdbj.org::empiar/archive/"+str(entry) 
-    output_ = output_direc +"/"+ str(entry)+"/"
+    # trailing slash: the contents of the entry go into its directory, like the shards of transfer_entry
+    url = source+str(entry)+"/"
+    output_ = entry_directory(entry, output_direc)+"/"
 
     #P flag added, now it will support interrupted download
-    for path in execute(["rsync", "-avz", "-P",url,output_]):
-        print(path, end="")
+    cmd = ["rsync", "-avz", "-P"]
+    if bwlimit:
+        cmd.append("--bwlimit={}".format(bwlimit))
+    if on_file is not None:
+        cmd.append(FILE_DONE_FORMAT)
+    if recorder is not None:
+        cmd.append("--stats")
+    with exclude_file(skip) as exclude, timed(recorder, 'transfer', name=str(entry), mirror=source_host(source)) as event:
+        if exclude is not None:
+            cmd.append("--exclude-from={}".format(exclude))
+        for path in execute(cmd + [url,output_]):
+            name = parse_file_done(path) if on_file is not None else None
+            if name is not None:
+                print(name)
+                on_file(output_ + name)
+            else:
+                print(path, end="")
+            received = parse_bytes_received(path) if recorder is not None else None
+            if received is not None:
+                event['bytes'] = received
+
+
+# "          1,234,567  12%   10.50MB/s    0:01:02 (xfr#3, to-chk=10/20)" as printed by --info=progress2
+PROGRESS_LINE = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+)/s')
+
+
+def list_directory(source_path):
+    '''
+        description:
+            Function for listing one directory of an rsync source (daemon module or local path) without
+            transferring anything.
+
+        input:
+            - source_path: rsync source directory, e.g. 'empiar.pdbj.org::empiar/archive/10533/'
+
+        output:
+            - (directories, files): names of the sub-directories and of the other entries
+    '''
+    directories, files = [], []
+    for line in execute(["rsync", "--list-only", source_path.rstrip("/") + "/"]):
+        fields = line.rstrip("\n").split(None, 4)
+        if len(fields) < 5 or fields[4] == ".":
+            continue
+        # symlinks are listed as 'name -> target' and transferred as files
+        name = fields[4].split(" -> ")[0]
+        if fields[0].startswith("d"):
+            directories.append(name)
+        else:
+            files.append(name)
+    return directories, files
+
+
+def plan_shards(entry, source=EMPIAR_SOURCE, depth=2):
+    '''
+        description:
+            Function for splitting an EMPIAR entry into independently transferable shards. Directories
+            are listed down to depth levels; every directory at that depth is one shard, and the plain
+            files of each directory above it form one more shard.
+
+        input:
+            - entry: EMPIAR entry or accession number
+            - source: rsync source the entries live under (default=EMPIAR_SOURCE)
+            - depth: directory levels split into shards (default=2)
+
+        output:
+            - shards: list of (relative directory, recursive); recursive=False shards hold only the files
+              directly in that directory
+    '''
+    shards = []
+    pending = [("", 0)]
+    while pending:
+        relative, level = pending.pop(0)
+        if level == depth:
+            shards.append((relative, True))
+            continue
+        directories, files = list_directory(source + str(entry) + "/" + relative)
+        if files:
+            shards.append((relative, False))
+        pending += [(relative + directory + "/", level + 1) for directory in directories]
+    return shards
+
+
+class TransferProgress:
+    '''
+        description:
+            Aggregates the progress of concurrent rsync workers of one entry and prints a summary line at
+            most every interval seconds.
+
+        input:
+            - entry: EMPIAR entry being transferred
+            - shards: number of shards of the entry
+            - interval: seconds between progress lines (default=5)
+    '''
+
+    def __init__(self, entry, shards, interval=5):
+        self.entry = entry
+        self.shards = shards
+        self.interval = interval
+        self.done = 0
+        self.failed = []
+        self._finished_bytes = 0
+        self._current = {}
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._last_print = 0.0
+
+    def transferred(self):
+        return self._finished_bytes + sum(self._current.values())
+
+    def update(self, shard, transferred):
+        with self._lock:
+            self._current[shard] = transferred
+            if time.time() - self._last_print >= self.interval:
+                self._print()
+
+    def finish(self, shard, error=None):
+        with self._lock:
+            self._finished_bytes += self._current.pop(shard, 0)
+            self.done += 1
+            if error is not None:
+                self.failed.append((shard, error))
+            self._print()
+
+    def _print(self):
+        self._last_print = time.time()
+        elapsed = max(time.time() - self._start, 1e-6)
+        print("EMPIAR {}: {}/{} shards, {:.1f} MB transferred, {:.1f} MB/s".format(
+            self.entry, self.done, self.shards, self.transferred() / 1e6, self.transferred() / 1e6 / elapsed))
+
+
+def transfer_shard(entry, shard, output_direc, progress, source=EMPIAR_SOURCE, bwlimit=None, retries=2, on_file=None, recorder=None, skip=None):
+    '''
+        description:
+            Function for transferring one shard with rsync. A failed transfer is run again up to retries
+            times; --partial keeps what was already received, so a retry resumes it.
+
+        input:
+            - entry: EMPIAR entry or accession number
+            - shard: (relative directory, recursive) from plan_shards
+            - output_direc: directory the entries are written to
+            - progress: TransferProgress of the entry
+            - source: rsync source the entries live under (default=EMPIAR_SOURCE)
+            - bwlimit: bandwidth cap of this worker in KiB/s (default=None, unlimited)
+            - retries: extra attempts after a failed transfer (default=2)
+            - on_file: called with the path of every file once it is complete (default=None)
+            - recorder: common.instrumentation.RunRecorder the shard is recorded to (default=None)
+            - skip: paths relative to the entry directory that are not transferred (default=None)
+    '''
+    relative, recursive = shard
+    destination = os.path.join(entry_directory(entry, output_direc), relative)
+    os.makedirs(destination, exist_ok=True)
+    cmd = ["rsync", "-az", "--partial", "--info=progress2"]
+    if bwlimit:
+        cmd.append("--bwlimit={}".format(bwlimit))
+    if not recursive:
+        cmd.append("--exclude=*/")
+    if on_file is not None:
+        cmd.append(FILE_DONE_FORMAT)
+    if recorder is not None:
+        cmd.append("--stats")
+
+    error = None
+    with exclude_file(skip, relative) as exclude, timed(recorder, 'transfer', name="{}/{}".format(entry, relative), mirror=source_host(source), bytes=0) as event:
+        if exclude is not None:
+            cmd.append("--exclude-from={}".format(exclude))
+        cmd += [source + str(entry) + "/" + relative, destination.rstrip("/") + "/"]
+        for attempt in range(retries + 1):
+            event['retries'] = attempt
+            try:
+                for line in execute(cmd):
+                    match = PROGRESS_LINE.match(line)
+                    if match:
+                        progress.update(relative, int(match.group(1).replace(",", "")))
+                    name = parse_file_done(line) if on_file is not None else None
+                    if name is not None:
+                        on_file(os.path.join(destination, name))
+                    received = parse_bytes_received(line) if recorder is not None else None
+                    if received is not None:
+                        event['bytes'] += received
+                error = None
+                break
+            except (subprocess.CalledProcessError, OSError) as exception:
+                error = exception
+        event['error'] = str(error) if error is not None else None
+    progress.finish(relative, error)
+
 
-def converttif2mrc(direc):
+def transfer_entry(entry, output_direc, workers=4, bwlimit=None, source=EMPIAR_SOURCE, depth=2, on_file=None, recorder=None, skip=None):
+    '''
+        description:
+            Function for downloading an EMPIAR entry with several rsync workers in parallel. The entry is
+            split into sub-directory shards, at most workers of them are transferred at once, and the
+            global bandwidth cap is divided evenly between the workers. Progress of all workers is
+            aggregated into one line per entry.
+
+        input:
+            - entry: EMPIAR entry or accession number
+            - output_direc: directory the entry is written to
+            - workers: parallel rsync processes (default=4)
+            - bwlimit: total bandwidth cap in KiB/s (default=None, unlimited)
+            - source: rsync source the entries live under, a daemon module ('host::module/path/') or a
+              local directory ending in '/' (default=EMPIAR_SOURCE)
+            - depth: directory levels split into shards (default=2)
+            - on_file: called with the path of every file once it is complete (default=None)
+            - recorder: common.instrumentation.RunRecorder every shard is recorded to (default=None)
+            - skip: paths relative to the entry directory that are not transferred (default=None)
+
+        output:
+            - failed: list of (shard, error) of the shards that could not be transferred
+    '''
+    print("Starting Download")
+    shards = plan_shards(entry, source, depth)
+    workers = max(1, min(workers, len(shards)))
+    worker_bwlimit = max(1, bwlimit // workers) if bwlimit else None
+    progress = TransferProgress(entry, len(shards))
+    print("EMPIAR {}: {} shards, {} rsync workers{}".format(entry, len(shards), workers,
+          ", {} KiB/s each".format(worker_bwlimit) if worker_bwlimit else ""))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(transfer_shard, entry, shard, output_direc, progress, source, worker_bwlimit, on_file=on_file, recorder=recorder, skip=skip) for shard in shards]
+        for future in futures:
+            future.result()
+
+    for relative, error in progress.failed:
+        print("EMPIAR {}: shard '{}' failed: {}".format(entry, relative or ".", error))
+    return progress.failed
+
+def converttif2mrc(direc, workers=None, force=False, engine='imod', recorder=None):
     '''
         description:
             Function for converting tif file to mrc file.
     
         input:
             - direc: directory containing the tif file
+            - workers: conversions run in parallel (default=None, the number of cores)
+            - force: converts files even if their mrc is up to date (default=False)
+            - engine: 'imod' runs IMOD's tif2mrc, 'native' converts in-process with NumPy (default='imod')
+            - recorder: common.instrumentation.RunRecorder every conversion is recorded to (default=None)
             
             
         output:
             - conversion flag: True for Success, False for Not
 
     '''
-    # lst = 
-    # for filename in glob.iglob(direc+"**/*.tif",recursive=True):
-    #     print(filename)
-
-    print("Starting to convert tif2mrc using IMOD")
-    for folder, subs, files in os.walk(direc):
-        
-        for file in files:
-            mrc_fl_name = file.split(".tif")[0] + ".mrc"
-            in_file = folder +"/"+file 
-            out_file = folder + "/" + mrc_fl_name
-            try:
-                subprocess.call(['tif2mrc',in_file,out_file]) 
-            except:
-                return False
-    
-    return True
+    print("Starting to convert tif2mrc using {}".format("IMOD" if engine == 'imod' else "the native converter"))
+    results = convert_directory(direc, workers, force, engine, recorder)
+    return all(error is None for in_file, error, seconds in results)
             
             
 
 
-def empiar_stub(accession_list,output_direc):
+def empiar_stub(accession_list,output_direc,tif2mrc=False,convert_workers=None,convert_engine='imod',rsync_workers=1,bwlimit=None,source=EMPIAR_SOURCE,shard_depth=2,stream_convert=False,delete_tif=False,recorder=None):
     '''
-        Stub for downloading the EMPIAR files
+        Stub for downloading the EMPIAR files, optionally converting their tif files to mrc.
+        With rsync_workers > 1 every entry is split into shards transferred by parallel rsync workers.
+        With stream_convert, tif files are converted as soon as they arrive instead of after the whole
+        entry (and removed once converted with delete_tif; the tifs removed by an earlier run are then not
+        downloaded again).
+        With a common.instrumentation.RunRecorder, every rsync transfer and conversion is recorded.
     '''
     for entry in accession_list:
-        download(entry,output_direc)
+        pipeline = ConversionPipeline(convert_workers, convert_engine, delete_tif=delete_tif, recorder=recorder) if (tif2mrc and stream_convert) else None
+        on_file = pipeline.submit if pipeline is not None else None
+        skip = converted_tiffs(entry_directory(entry, output_direc)) if (pipeline is not None and delete_tif) else None
+        if skip:
+            print("EMPIAR {}: skipping the tif files of {} mrc files already converted".format(entry, len(skip) // len(TIFF_EXTENSIONS)))
+        if rsync_workers > 1:
+            transfer_entry(entry,output_direc,rsync_workers,bwlimit,source,shard_depth,on_file,recorder,skip)
+        else:
+            download(entry,output_direc,bwlimit,source,on_file,recorder,skip)
+        if pipeline is not None:
+            pipeline.finish(entry_directory(entry, output_direc))
+        elif tif2mrc:
+            converttif2mrc(entry_directory(entry, output_direc), convert_workers, engine=convert_engine, recorder=recorder)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,215 @@
+import os
+import struct
+import time
+
+import numpy as np
+
+from volume.mrc import HEADER_SIZE, build_header, mode_for_dtype
+
+# TIFF field type -> (struct format, size in bytes)
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1),
+    8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8),
+}
+
+# SampleFormat tag value -> numpy kind
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TiffReader:
+    '''
+        description:
+            Minimal reader of (Big)TIFF stacks as written by cameras and SerialEM: one grayscale,
+            uncompressed, strip-organised image per page. Pages are read one at a time, so memory
+            stays at a single frame. Compressed or tiled files are handed to the tifffile package
+            when it is installed.
+
+        input:
+            - path: tif file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        order = self._file.read(2)
+        if order not in (b'II', b'MM'):
+            raise ValueError("{} is not a TIFF file".format(path))
+        self._endian = '<' if order == b'II' else '>'
+        version, = self._unpack('H', self._file.read(2))
+        if version == 42:
+            self._offset_format, self._count_format, self._entry_size = 'I', 'H', 12
+            first_ifd, = self._unpack('I', self._file.read(4))
+        elif version == 43:
+            self._offset_format, self._count_format, self._entry_size = 'Q', 'Q', 20
+            self._file.read(4)
+            first_ifd, = self._unpack('Q', self._file.read(8))
+        else:
+            raise ValueError("{} is not a TIFF file".format(path))
+        self.pages = self._read_pages(first_ifd)
+
+        if any(page['samples'] != 1 for page in self.pages):
+            raise ValueError("{} is not a grayscale image stack".format(path))
+        first = self.pages[0]
+        self.shape = (len(self.pages), first['height'], first['width'])
+        self.dtype = first['dtype']
+
+    def _unpack(self, fmt, data):
+        return struct.unpack(self._endian + fmt, data)
+
+    def _read_pages(self, offset):
+        pages = []
+        while offset:
+            self._file.seek(offset)
+            size = struct.calcsize(self._count_format)
+            count, = self._unpack(self._count_format, self._file.read(size))
+            entries = self._file.read(count * self._entry_size)
+            tags = {}
+            for index in range(count):
+                entry = entries[index * self._entry_size: (index + 1) * self._entry_size]
+                tag, field_type = self._unpack('HH', entry[:4])
+                tags[tag] = self._read_values(field_type, entry[4:])
+            pages.append(self._page(tags))
+            size = struct.calcsize(self._offset_format)
+            offset, = self._unpack(self._offset_format, self._file.read(size))
+        return pages
+
+    def _read_values(self, field_type, entry):
+        if field_type not in TIFF_TYPES:
+            return None
+        fmt, size = TIFF_TYPES[field_type]
+        count_size = struct.calcsize(self._offset_format)
+        count, = self._unpack(self._offset_format, entry[:count_size])
+        value = entry[count_size:]
+        if count * size > len(value):
+            position = self._file.tell()
+            self._file.seek(self._unpack(self._offset_format, value)[0])
+            value = self._file.read(count * size)
+            self._file.seek(position)
+        if field_type == 2:
+            return value[:count]
+        return self._unpack(fmt * count, value[:count * size])
+
+    def _page(self, tags):
+        bits = tags.get(258, (1,))[0]
+        kind = SAMPLE_KINDS.get(tags.get(339, (1,))[0], 'u')
+        return {
+            'width': tags[256][0],
+            'height': tags[257][0],
+            'dtype': np.dtype(self._endian + kind + str(bits // 8)) if bits >= 8 else None,
+            'compression': tags.get(259, (1,))[0],
+            'samples': tags.get(277, (1,))[0],
+            'tiled': 322 in tags,
+            'strip_offsets': tags.get(273, ()),
+            'strip_byte_counts': tags.get(279, ()),
+        }
+
+    def native(self):
+        '''
+            output:
+                - True if every page can be read without tifffile
+        '''
+        return all(page['compression'] == 1 and not page['tiled'] and page['dtype'] is not None
+                   and page['dtype'] == self.dtype and (page['height'], page['width']) == self.shape[1:] for page in self.pages)
+
+    def iter_frames(self):
+        '''
+            description:
+                Yields the pages as 2D numpy arrays (height, width), one at a time.
+        '''
+        if not self.native():
+            yield from self._iter_frames_tifffile()
+            return
+        for page in self.pages:
+            frame = bytearray(page['height'] * page['width'] * self.dtype.itemsize)
+            view = memoryview(frame)
+            position = 0
+            for offset, byte_count in zip(page['strip_offsets'], page['strip_byte_counts']):
+                byte_count = min(byte_count, len(frame) - position)
+                self._file.seek(offset)
+                self._file.readinto(view[position: position + byte_count])
+                position += byte_count
+            yield np.frombuffer(frame, dtype=self.dtype).reshape(page['height'], page['width'])
+
+    def _iter_frames_tifffile(self):
+        try:
+            import tifffile
+        except ImportError:
+            raise ValueError("{} is compressed or tiled; install tifffile or use the IMOD engine".format(self.path))
+        with tifffile.TiffFile(self.path) as tif:
+            for page in tif.pages:
+                yield page.asarray()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def tif_to_mrc(in_file, out_file, voxel_size=1.0, flip=True):
+    '''
+        description:
+            Function for converting a tif stack to an MRC2014 file without IMOD. The output is
+            preallocated and memory-mapped, frames are copied in one at a time and the header
+            statistics accumulated on the way, so memory is bounded by one frame. The data is
+            written to out_file + '.part' and renamed into place once complete.
+
+        input:
+            - in_file: tif file
+            - out_file: mrc file to write
+            - voxel_size: pixel size in Angstrom written to the header (default=1.0)
+            - flip: flips every frame in Y, since TIFF rows start at the top and MRC rows at the bottom (default=True)
+
+        output:
+            - header: the 1024-byte header written
+    '''
+    part_file = out_file + ".part"
+    with TiffReader(in_file) as reader:
+        mode, dtype = mode_for_dtype(reader.dtype)
+        shape = reader.shape
+        with open(part_file, 'wb') as output_file:
+            output_file.write(bytes(HEADER_SIZE))
+            output_file.truncate(HEADER_SIZE + int(np.prod(shape)) * dtype.itemsize)
+        data = np.memmap(part_file, dtype=dtype, mode='r+', offset=HEADER_SIZE, shape=shape)
+
+        dmin, dmax, total, total_squares = np.inf, -np.inf, 0.0, 0.0
+        for index, frame in enumerate(reader.iter_frames()):
+            data[index] = frame[::-1] if flip else frame
+            section = data[index].astype(np.float64)
+            dmin = min(dmin, section.min())
+            dmax = max(dmax, section.max())
+            total += section.sum()
+            total_squares += np.square(section).sum()
+        data.flush()
+        del data
+
+    count = float(np.prod(shape))
+    mean = total / count
+    rms = float(np.sqrt(max(total_squares / count - mean * mean, 0.0)))
+    header = build_header(shape, mode, voxel_size, dmin, dmax, mean, rms, ispg=0,
+                          labels=["tif2mrc (native): converted from {}".format(os.path.basename(in_file))], dtype=dtype)
+    with open(part_file, 'r+b') as output_file:
+        output_file.write(header)
+    os.replace(part_file, out_file)
+    return header
+
+
+def convert_file_native(in_file, out_file):
+    '''
+        description:
+            Native counterpart of empiar.conversion.convert_file.
+
+        output:
+            - (in_file, error message or None, seconds taken)
+    '''
+    start_time = time.time()
+    try:
+        tif_to_mrc(in_file, out_file)
+    except (OSError, ValueError, KeyError, IndexError, struct.error) as error:
+        if os.path.exists(out_file + ".part"):
+            os.remove(out_file + ".part")
+        return in_file, "{}: {}".format(type(error).__name__, error), time.time() - start_time
+    return in_file, None, time.time() - start_time
@@ -3,70 +3,91 @@ import pandas as pd
 
 # source & reference: 'https://github.com/pythonLoader/PDB-Scrapper/blob/main/scrapper.py'
 from bs4 import BeautifulSoup
+import os
 import time
 
+from common.concurrency import HostLimiter, ordered_map
+from common.endpoints import rebase
+from common.fetch import stream_to_file
+from common.gunzip import gunzip_file, unzipped_path
+from common.instrumentation import recorder_of, timed
+from common.journal import run_job
+from common.mirrors import MirrorScheduler, open_first
+from common.probe import ProbeCache, probe_site
+from common.session import get_session
+from pdb.structure import load_structure
+
+"""
+    sites checked for the links spreadsheet: (site, urls probed for the entry, profile link written to the sheet).
+
+    problem: requests.get(url) responds with status code 404 even for valid PDBj protein profiles.
+    solution: https://stackoverflow.com/questions/48125006/404-status-code-while-making-http-request-via-pythons-requests-library-howev
+
+    But now, requests.get(url) responds with status code 200 even for invalid PDBj protein profiles.
+    So for PDBj the pdb and mmCIF download endpoints are probed instead of the profile page.
+
+    every archive url of this module is requested through common.endpoints.rebase, so the base urls can be
+    pointed at a local mirror (e.g. benchmark.mirror_emulator) or proxy; the links written to the sheet stay public.
+"""
+LINK_SITES = [
+    ("RCSB", ["https://www.rcsb.org/structure/{}"], "https://www.rcsb.org/structure/{}"),
+    ("PDBe", ["https://www.ebi.ac.uk/pdbe/entry/pdb/{}"], "https://www.ebi.ac.uk/pdbe/entry/pdb/{}"),
+    ("PDBj", ["https://pdbj.org/rest/downloadPDBfile?format=pdb&id={}", "https://pdbj.org/rest/downloadPDBfile?format=mmcif&id={}"], "https://pdbj.org/mine/summary/{}"),
+]
+
+
 """
     function download_rcsb_pdbe_pdbj_links():
         description:
             Function for downloading protein profile links from RCSB, PDBe, PDBj sites.
+            Existence is checked with HEAD (or one-byte ranged GET) probes, run concurrently for
+            several proteins, and memoized per (site, accession) in probe_cache.
     
         input:
             - accession_list: list of proteins' accession IDs (default=None)
             - debug_on: prints debugging message if True (default=False)
+            - session: requests.Session shared by all requests (default=common.session.get_session())
+            - workers: number of proteins probed concurrently (default=8)
+            - probe_cache: common.probe.ProbeCache remembering earlier results (default=None)
             
         output:
             - data_frame: data frame containing all the profile links for given proteins
 """
-def download_rcsb_pdbe_pdbj_links(accession_list=None, debug_on=False):
+def download_rcsb_pdbe_pdbj_links(accession_list=None, debug_on=False, session=None, workers=8, probe_cache=None):
     if accession_list is None:
         accession_list = []
+    session = get_session(session)
 
-    rcsb_links = []
-    pdbe_links = []
-    pdbj_links = []
+    def probe_entry(accession):
+        return [probe_site(site, accession, [rebase(url.format(accession)) for url in urls], session, probe_cache) for site, urls, link in LINK_SITES]
 
-    for index, accession in enumerate(accession_list):
+    links = {site: [] for site, urls, link in LINK_SITES}
+    for index, (accession, found) in enumerate(zip(accession_list, ordered_map(probe_entry, accession_list, workers))):
         print("\nCurrently collecting PDB sites' links for protein no.{}: {}".format(index + 1, accession))
 
-        # collecting link from RCSB site
-        response = requests.get("https://www.rcsb.org/structure/{}".format(accession))
-        if response.status_code == 200:
-            rcsb_links.append("https://www.rcsb.org/structure/{}".format(accession))
-        else:
-            rcsb_links.append("no RCSB link available")
-            if debug_on:
-                print("<debug> No RCSB entry for {}.".format(accession))
-
-        # collecting link from PDBe site
-        response = requests.get("https://www.ebi.ac.uk/pdbe/entry/pdb/{}".format(accession))
-        if response.status_code == 200:
-            pdbe_links.append("https://www.ebi.ac.uk/pdbe/entry/pdb/{}".format(accession))
-        else:
-            pdbe_links.append("no PDBe link available")
-            if debug_on:
-                print("<debug> No PDBe entry for {}.".format(accession))
-
-        # collecting link from PDBj site
-        """
-            problem: requests.get(url) responds with status code 404 even for valid PDBj protein profiles.
-            solution: https://stackoverflow.com/questions/48125006/404-status-code-while-making-http-request-via-pythons-requests-library-howev
-
-            But now, requests.get(url) responds with status code 200 even for invalid PDBj protein profiles.
-        """
-        if requests.get("https://pdbj.org/rest/downloadPDBfile?format=pdb&id={}".format(accession), allow_redirects=True).status_code == 200 or requests.get("https://pdbj.org/rest/downloadPDBfile?format=mmcif&id={}".format(accession), allow_redirects=True) == 200:
-            pdbj_links.append("https://pdbj.org/mine/summary/{}".format(accession))
-        else:
-            pdbj_links.append("no PDBj link available")
-            if debug_on:
-                print("<debug> No PDBj entry for {}.".format(accession))
+        for (site, urls, link), exists in zip(LINK_SITES, found):
+            if exists is None:
+                # the site could not be probed: the link is kept, it may well exist
+                links[site].append(link.format(accession))
+                if debug_on:
+                    print("<debug> Could not check the {} entry for {}.".format(site, accession))
+            elif exists:
+                links[site].append(link.format(accession))
+            else:
+                links[site].append("no {} link available".format(site))
+                if debug_on:
+                    print("<debug> No {} entry for {}.".format(site, accession))
 
         print("Completed, {}/{} proteins remaining.".format(len(accession_list) - (index + 1), len(accession_list)))
 
+    if probe_cache is not None:
+        probe_cache.save()
+
     data_frame = pd.DataFrame(columns=['PDB Entry', 'RCSB Links', 'PDBe Links', 'PDBj Links'])
     data_frame['PDB Entry'] = accession_list
-    data_frame['RCSB Links'] = rcsb_links
-    data_frame['PDBe Links'] = pdbe_links
-    data_frame['PDBj Links'] = pdbj_links
+    data_frame['RCSB Links'] = links['RCSB']
+    data_frame['PDBe Links'] = links['PDBe']
+    data_frame['PDBj Links'] = links['PDBj']
 
     return data_frame
 
@@ -80,6 +101,7 @@ def download_rcsb_pdbe_pdbj_links(accession_list=None, debug_on=False):
 
         input:
             - accession: corresponding protein's accession ID
+            - session: requests.Session to use (default=common.session.get_session())
 
         output:
             - structure_title: protein's structure title
@@ -91,18 +113,20 @@ def download_rcsb_pdbe_pdbj_links(accession_list=None, debug_on=False):
             - paper_link: corresponding paper's DOI (if any)
             - abstract_text: abstract from corresponding paper (if any)
 """
-def get_metadata(accession):
-    url = 'https://www.rcsb.org/structure/' + accession
+def get_metadata(accession, session=None):
+    url = rebase('https://www.rcsb.org/structure/' + accession)
+    session = get_session(session)
     start_time = time.time()
 
-    response = requests.get(url)
+    response = session.get(url)
     print("Page Fetching Time: {}".format(time.time() - start_time))
 
     if not response.status_code == 200:
         return 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'NA', 'No abstract available'
 
     intermediate_time = time.time()
-    soup = BeautifulSoup(response.content, 'html.parser')
+    with timed(recorder_of(session), 'parse', name=accession, format='html'):
+        soup = BeautifulSoup(response.content, 'html.parser')
     print("Beautiful Soup Parsing Time: {}".format(time.time() - intermediate_time))
 
     if soup.find(id='structureTitle') is None:
@@ -145,6 +169,126 @@ def get_metadata(accession):
     return structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, abstract_text
 
 
+"""
+    RCSB Data API (GraphQL) endpoint and query used for bulk metadata; one request covers METADATA_BATCH_SIZE entries.
+"""
+RCSB_GRAPHQL_URL = "https://data.rcsb.org/graphql"
+METADATA_BATCH_SIZE = 200
+RCSB_METADATA_QUERY = """
+query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    struct { title }
+    rcsb_accession_info { deposit_date initial_release_date }
+    rcsb_entry_container_identifiers { emdb_ids }
+    rcsb_primary_citation { title pdbx_database_id_DOI }
+  }
+}
+"""
+
+
+"""
+    function get_metadata_bulk():
+        description:
+            Function for fetching metadata of many proteins at once from the RCSB Data API, in the same
+            shape as get_metadata(). The API has no abstracts, so abstract_text is always 'No abstract available'.
+
+        input:
+            - accession_list: list of proteins' accession IDs
+            - session: requests.Session to use (default=common.session.get_session())
+            - batch_size: entries per GraphQL request (default=METADATA_BATCH_SIZE)
+
+        output:
+            - metadata: dict mapping upper-cased accession to the get_metadata() tuple; entries the API
+              did not return (or batches that failed) are missing
+"""
+def get_metadata_bulk(accession_list, session=None, batch_size=METADATA_BATCH_SIZE):
+    session = get_session(session)
+    metadata = {}
+
+    for start in range(0, len(accession_list), batch_size):
+        batch = [accession.upper() for accession in accession_list[start: start + batch_size]]
+        start_time = time.time()
+        entries = []
+        try:
+            response = session.post(rebase(RCSB_GRAPHQL_URL), json={'query': RCSB_METADATA_QUERY, 'variables': {'ids': batch}})
+            if response.status_code == 200:
+                entries = (response.json().get('data') or {}).get('entries') or []
+        except (requests.RequestException, ValueError):
+            entries = []
+        print("Bulk Metadata Fetching Time ({} entries): {}".format(len(batch), time.time() - start_time))
+
+        for entry in entries:
+            if not entry:
+                continue
+            structure_title = (entry.get('struct') or {}).get('title') or 'NA'
+
+            accession_info = entry.get('rcsb_accession_info') or {}
+            deposited_date = (accession_info.get('deposit_date') or 'NA')[:10]
+            released_date = (accession_info.get('initial_release_date') or 'NA')[:10]
+
+            emdb_ids = (entry.get('rcsb_entry_container_identifiers') or {}).get('emdb_ids') or []
+            em_data_id = emdb_ids[0] if emdb_ids else 'NA'
+            em_data_link = "https://www.ebi.ac.uk/emdb/{}".format(em_data_id) if emdb_ids else 'NA'
+
+            citation = entry.get('rcsb_primary_citation')
+            if citation is None:
+                paper_name = 'NA'
+                paper_link = 'NA'
+            else:
+                paper_name = citation.get('title') or 'NA'
+                paper_link = "https://doi.org/{}".format(citation['pdbx_database_id_DOI']) if citation.get('pdbx_database_id_DOI') else "Not published yet"
+
+            metadata[entry['rcsb_id'].upper()] = (structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, 'No abstract available')
+
+    return metadata
+
+
+RCSB_LINKS_QUERY = """
+query($ids: [String!]!) {
+  entries(entry_ids: $ids) {
+    rcsb_id
+    rcsb_entry_container_identifiers { emdb_ids }
+  }
+}
+"""
+
+
+"""
+    function get_emdb_links_bulk():
+        description:
+            Function for looking up the EMDB maps linked to many proteins at once from the RCSB Data API.
+
+        input:
+            - accession_list: list of proteins' accession IDs
+            - session: requests.Session to use (default=common.session.get_session())
+            - batch_size: entries per GraphQL request (default=METADATA_BATCH_SIZE)
+
+        output:
+            - links: dict mapping upper-cased accession to its list of EMDB IDs ('EMD-1234'); entries the API
+              did not return (or batches that failed) are missing
+"""
+def get_emdb_links_bulk(accession_list, session=None, batch_size=METADATA_BATCH_SIZE):
+    session = get_session(session)
+    links = {}
+
+    for start in range(0, len(accession_list), batch_size):
+        batch = [accession.upper() for accession in accession_list[start: start + batch_size]]
+        entries = []
+        try:
+            response = session.post(rebase(RCSB_GRAPHQL_URL), json={'query': RCSB_LINKS_QUERY, 'variables': {'ids': batch}})
+            if response.status_code == 200:
+                entries = (response.json().get('data') or {}).get('entries') or []
+        except (requests.RequestException, ValueError):
+            entries = []
+
+        for entry in entries:
+            if entry:
+                links[entry['rcsb_id'].upper()] = (entry.get('rcsb_entry_container_identifiers') or {}).get('emdb_ids') or []
+
+    return links
+
+
 """
     source & reference: 'https://github.com/pythonLoader/PDB-Scrapper/blob/main/scrapper.py'
     
@@ -154,13 +298,27 @@ def get_metadata(accession):
 
         input:
             - accession_list: list of proteins' accession IDs (default=None)
+            - session: requests.Session shared by all requests (default=common.session.get_session())
+            - bulk: asks the RCSB Data API for many entries per request and only scrapes the structure
+              page of entries it did not return; False scrapes every entry (default=True)
+            - metadata_index: common.metadata_index.MetadataIndex; entries indexed recently are not fetched again
+              and fetched ones are added to it (default=None)
 
         output:
             - data_frame: data frame containing all the metadata for given proteins
 """
-def download_rcsb_metadata(accession_list=None):
+def download_rcsb_metadata(accession_list=None, session=None, bulk=True, metadata_index=None):
     if accession_list is None:
         accession_list = []
+    indexed_metadata = {}
+    if metadata_index is not None:
+        for accession in accession_list:
+            metadata = metadata_index.get_pdb(accession)
+            if metadata is not None:
+                indexed_metadata[accession.upper()] = metadata
+        print("{}/{} proteins found in the metadata index.".format(len(indexed_metadata), len(accession_list)))
+    pending_list = [accession for accession in accession_list if accession.upper() not in indexed_metadata]
+    bulk_metadata = get_metadata_bulk(pending_list, session) if (bulk and pending_list) else {}
 
     structure_titles = []
     deposited_dates = []
@@ -173,7 +331,17 @@ def download_rcsb_metadata(accession_list=None):
     for index, accession in enumerate(accession_list):
         print("\nCurrently working with protein no.{}: {}".format(index + 1, accession))
 
-        (structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, abstract_text) = get_metadata(accession)
+        if accession.upper() in indexed_metadata:
+            (structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, abstract_text) = indexed_metadata[accession.upper()]
+        else:
+            if accession.upper() in bulk_metadata:
+                metadata = bulk_metadata[accession.upper()]
+            else:
+                metadata = get_metadata(accession, session)
+            (structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, abstract_text) = metadata
+            # entries that could not be fetched ('NA' title) are left out so the next run tries again
+            if metadata_index is not None and structure_title != 'NA':
+                metadata_index.put_pdb(accession, metadata)
         print("\nStructure Title: {}\nDeposited Date: {}\nReleased Date: {}\nEM Data ID: {}\nEM Data Link: {}\nPaper Name: {}\nPaper Link: {}\n\nAbstract: {}\n".format(structure_title, deposited_date, released_date, em_data_id, em_data_link, paper_name, paper_link, abstract_text))
         print("-----------------------")
 
@@ -195,9 +363,142 @@ def download_rcsb_metadata(accession_list=None):
     data_frame['Deposited Date'] = deposited_dates
     data_frame['Released Date'] = released_dates
 
+    if metadata_index is not None:
+        metadata_index.save()
+
     return data_frame
 
 
+"""
+    mirrors tried, in order, for each file type; a 404 from one mirror falls through to the next.
+    each url template is formatted with the accession and its two middle characters ('divided' layout).
+"""
+PDB_MIRRORS = [
+    ("RCSB", "https://files.rcsb.org/download/{accession}.pdb.gz"),
+    ("PDBe", "http://ftp.ebi.ac.uk/pub/databases/rcsb/pdb-remediated/data/structures/divided/pdb/{middle}/pdb{accession}.ent.gz"),
+    ("PDBj", "https://pdbj.org/rest/downloadPDBfile?format=pdb&id={accession}"),
+    ("wwPDB", "https://ftp.wwpdb.org/pub/pdb/data/structures/all/pdb/pdb{accession}.ent.gz"),
+]
+
+CIF_MIRRORS = [
+    ("RCSB", "https://files.rcsb.org/download/{accession}.cif.gz"),
+    ("PDBe", "https://www.ebi.ac.uk/pdbe/entry-files/{accession}.cif"),  # archive mmCIF file
+    # ("PDBe", "https://www.ebi.ac.uk/pdbe/static/entry/{accession}_updated.cif"),  # updated mmCIF file
+    ("PDBj", "https://pdbj.org/rest/downloadPDBfile?format=mmcif&id={accession}"),
+    ("wwPDB", "https://ftp.wwpdb.org/pub/pdb/data/structures/all/mmCIF/{accession}.cif.gz"),
+]
+
+FILE_TYPES = {
+    'pdb': (PDB_MIRRORS, "pdb{}.ent.gz"),
+    'cif': (CIF_MIRRORS, "{}.cif.gz"),
+}
+
+
+"""
+    function download_pdb_file():
+        description:
+            Function for downloading one pdb/cif file, falling back through the mirrors on 404.
+
+        input:
+            - accession: corresponding protein's accession ID
+            - file_type: 'pdb' or 'cif'
+            - output_dir='.'
+            - debug_on: prints debugging message if True (default=False)
+            - limiter: common.concurrency.HostLimiter bounding requests per mirror host (default=None)
+            - log: callable receiving each progress message (default=print)
+            - session: requests.Session to use (default=common.session.get_session())
+            - scheduler: common.mirrors.MirrorScheduler; mirrors are tried fastest first instead of in the fixed order (default=None)
+            - hedge: races the two best remaining mirrors and keeps the first to answer with the file (default=False)
+            - cache: common.cache.ContentCache consulted before, and filled after, the download (default=None)
+            - unzip: also writes the file gunzipped, decompressed while it downloads (default=False)
+            - keep_gz: with unzip, keeps the .gz file as well (default=True)
+            - parse: parses the atoms into the .npy sidecar read by pdb.structure.load_structure (default=False)
+
+        output:
+            - True if the file was downloaded, False otherwise
+"""
+def download_pdb_file(accession, file_type, output_dir='.', debug_on=False, limiter=None, log=print, session=None, scheduler=None, hedge=False, cache=None, unzip=False, keep_gz=True, parse=False):
+    mirrors, file_name = FILE_TYPES[file_type]
+    session = get_session(session)
+    log("\tDownloading {} file for {}.".format(file_type, accession))
+
+    output_path = "{}/{}".format(output_dir, file_name.format(accession))
+    unzip_path = unzipped_path(output_path) if unzip else None
+    if cache is not None and cache.restore(file_name.format(accession), output_path, session):
+        if debug_on:
+            log("<debug> {} file for {} served from cache.".format(file_type, accession))
+        if unzip:
+            gunzip_file(output_path, unzip_path, keep_gz)
+        if parse:
+            parse_structure_file(output_path if os.path.exists(output_path) else unzip_path, log, recorder_of(session))
+        return True
+
+    candidates = [(mirror, rebase(url_template.format(accession=accession, middle=accession[1: 3]))) for mirror, url_template in mirrors]
+    if scheduler is not None:
+        candidates = scheduler.order(candidates)
+
+    status_code = None
+    tried = []
+    while candidates:
+        batch_size = 2 if hedge else 1
+        batch, candidates = candidates[:batch_size], candidates[batch_size:]
+        if debug_on:
+            for mirror, url in batch:
+                if tried:
+                    log("<debug> Downloading {} file from {} for {}, failed in {}.".format(file_type, mirror, accession, ", ".join(tried)))
+                else:
+                    log("<debug> Downloading {} file from {} for {}.".format(file_type, mirror, accession))
+        tried.extend(mirror for mirror, url in batch)
+
+        # an unreachable mirror (status None, after the session's retries) is treated like a miss
+        mirror, status_code, response, release = open_first(session, batch, scheduler, limiter)
+        if status_code == 200:
+            # streaming corresponding file to local machine in chunks
+            # the cache stores the .gz, so it is kept until stored even when only the unzipped file is wanted
+            with release:
+                stream_to_file(response, output_path, unzip_path=unzip_path, keep_compressed=keep_gz or cache is not None)
+            if cache is not None:
+                cache.store(file_name.format(accession), output_path, dict(batch)[mirror], response.headers)
+                if unzip and not keep_gz:
+                    os.remove(output_path)
+            if debug_on and hedge:
+                log("<debug> {} file for {} served by {}.".format(file_type, accession, mirror))
+            if parse:
+                parse_structure_file(output_path if os.path.exists(output_path) else unzip_path, log, recorder_of(session))
+            return True
+
+        if status_code is not None and status_code != 404:
+            break
+
+    if status_code == 404:
+        log("\t\t{}{}: Not found in {}.".format(file_type, accession, ", ".join(tried)))
+    elif status_code is None:
+        log("\t\t{}{}: Could not reach {}.".format(file_type, accession, ", ".join(tried)))
+    else:
+        log("\t\t{}{}: {} responded with HTTP {}.".format(file_type, accession, tried[-1], status_code))
+    return False
+
+
+"""
+    function parse_structure_file():
+        description:
+            Function for parsing a downloaded pdb/cif file into its .npy sidecar (see pdb.structure),
+            so later loads memory-map the atoms instead of parsing the text.
+
+        input:
+            - path: downloaded pdb/cif file
+            - log: callable receiving the messages (default=print)
+            - recorder: common.instrumentation.RunRecorder the parse time is recorded to (default=None)
+"""
+def parse_structure_file(path, log=print, recorder=None):
+    try:
+        with timed(recorder, 'parse', name=os.path.basename(path)) as event:
+            event['atoms'] = len(load_structure(path))
+        log("\t\tParsed {} atoms from {}.".format(event['atoms'], os.path.basename(path)))
+    except ValueError as error:
+        log("\t\tCould not parse {}: {}".format(os.path.basename(path), error))
+
+
 """
     function main():
         description:
@@ -211,92 +512,100 @@ def download_rcsb_metadata(accession_list=None):
             - debug_on: prints debugging message if True (default=False)
             - download_links: downloads protein profile links from RCSB, PDBe, PDBj sites if True (default=False)
             - download_metadata: downloads protein metadata from RCSB site if True (default=False)
+            - workers: number of files downloaded concurrently; 1 keeps the sequential behaviour (default=1)
+            - host_limit: maximum concurrent requests to a single mirror host when workers > 1 (default=4)
+            - session: requests.Session shared by all requests (default=common.session.get_session())
+            - fastest_mirror: tries the mirror with the best measured latency and hit rate first (default=False)
+            - hedge: races two mirrors per request and keeps the first to answer, implies fastest_mirror (default=False)
+            - cache: common.cache.ContentCache serving files already downloaded by earlier runs (default=None)
+            - bulk_metadata: fetches metadata from the RCSB Data API instead of scraping every structure page (default=True)
+            - metadata_index: common.metadata_index.MetadataIndex the metadata is looked up in and added to (default=None)
+            - unzip: also writes every pdb/cif file gunzipped, decompressed while it downloads (default=False)
+            - keep_gz: with unzip, keeps the .gz files as well (default=True)
+            - parse_structures: parses every downloaded file into the .npy sidecar of pdb.structure.load_structure (default=False)
+            - recorder: common.instrumentation.RunRecorder recording every request, download and parse of the run (default=None)
+            - journal: common.journal.JobJournal every pdb/cif file is a job of; failed files are retried at the end
+              instead of stopping the batch, and with journal.resume files finished by an earlier run are skipped (default=None)
 """
-def pdb_stub(accession_list=None, output_dir='.', download_pdb=True, download_cif=True, debug_on=False, download_links=False, download_metadata=False):
+def pdb_stub(accession_list=None, output_dir='.', download_pdb=True, download_cif=True, debug_on=False, download_links=False, download_metadata=False, workers=1, host_limit=4, session=None, fastest_mirror=False, hedge=False, cache=None, bulk_metadata=True, metadata_index=None, unzip=False, keep_gz=True, parse_structures=False, recorder=None, journal=None):
     if accession_list is None:
         accession_list = []
+    session = get_session(session)
+    if recorder is not None:
+        recorder.attach(session)
+    scheduler = MirrorScheduler() if (fastest_mirror or hedge) else None
 
-    for index, accession in enumerate(accession_list):
-        print("Currently downloading protein no.{}: {}".format(index + 1, accession))
+    file_types = [file_type for file_type, wanted in (('pdb', download_pdb), ('cif', download_cif)) if wanted]
+    limiter = HostLimiter(host_limit) if workers > 1 else None
 
-        if download_pdb:
-            print("\tDownloading pdb file for {}.".format(accession))
+    def fetch(accession, file_type, log):
+        output_path = "{}/{}".format(output_dir, FILE_TYPES[file_type][1].format(accession))
+        messages = []
 
-            # at first, trying to download corresponding pdb file from 'https://www.rcsb.org/'
-            if debug_on:
-                print("<debug> Downloading pdb file from RCSB for {}.".format(accession))
-            response = requests.get("https://files.rcsb.org/download/{}.pdb.gz".format(accession), allow_redirects=True)
+        def log_message(message):
+            messages.append(message)
+            log(message)
 
-            # trying to download corresponding pdb file from 'https://www.ebi.ac.uk/pdbe/' if not available in RCSB
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading pdb file from PDBe for {}, failed in RCSB.".format(accession))
-                response = requests.get("http://ftp.ebi.ac.uk/pub/databases/rcsb/pdb-remediated/data/structures/divided/pdb/{}/pdb{}.ent.gz".format(accession[1: 3], accession), allow_redirects=True)
+        def download():
+            # the last message of a failed download says why it failed
+            return download_pdb_file(accession, file_type, output_dir, debug_on, limiter, log_message, session, scheduler, hedge, cache, unzip, keep_gz, parse_structures) or messages[-1].strip()
 
-            # trying to download corresponding pdb file from 'https://pdbj.org/' if not available in RCSB, PDBe
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading pdb file from PDBj for {}, failed in RCSB, PDBe.".format(accession))
-                response = requests.get("https://pdbj.org/rest/downloadPDBfile?format=pdb&id={}".format(accession), allow_redirects=True)
+        run_job(journal, accession, file_type, [output_path, unzipped_path(output_path)], download)
 
-            # trying to download corresponding pdb file from 'http://www.wwpdb.org/ftp/pdb-ftp-sites' if not available in RCSB, PDBe, PDBj
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading pdb file from wwPDB for {}, failed in RCSB, PDBe, PDBj.".format(accession))
-                response = requests.get("https://ftp.wwpdb.org/pub/pdb/data/structures/all/pdb/pdb{}.ent.gz".format(accession), allow_redirects=True)
+    def run_task(task):
+        messages = []
+        fetch(task[0], task[1], messages.append)
+        return messages
 
-            # downloading corresponding pdb file to local machine
-            if response.status_code == 200:
-                with open("{}/pdb{}.ent.gz".format(output_dir, accession), 'wb') as output_file:
-                    output_file.write(response.content)
-            elif response.status_code == 404:
-                print("\t\tpdb{}: Not found in RCSB, PDBe, PDBj, wwPDB.".format(accession))
+    jobs = [(accession, file_type) for accession in accession_list for file_type in file_types]
+    todo = set(journal.plan(jobs)) if journal is not None else None
 
-        if download_cif:
-            print("\tDownloading cif file for {}.".format(accession))
+    if workers > 1:
+        # every (accession, file type) pair is an independent task; messages are buffered per task
+        # and printed in input order, so the report matches the sequential one line for line
+        results = ordered_map(run_task, [job for job in jobs if todo is None or job in todo], workers)
+    else:
+        results = None
 
-            # at first, trying to download corresponding cif file from 'https://www.rcsb.org/'
-            if debug_on:
-                print("<debug> Downloading cif file from RCSB for {}.".format(accession))
-            response = requests.get("https://files.rcsb.org/download/{}.cif.gz".format(accession), allow_redirects=True)
+    for index, accession in enumerate(accession_list):
+        print("Currently downloading protein no.{}: {}".format(index + 1, accession))
 
-            # trying to download corresponding cif file from 'https://www.ebi.ac.uk/pdbe/' if not available in RCSB
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading cif file from PDBe for {}, failed in RCSB.".format(accession))
-                response = requests.get("https://www.ebi.ac.uk/pdbe/entry-files/{}.cif".format(accession), allow_redirects=True)  # archive mmCIF file
-                # response = requests.get("https://www.ebi.ac.uk/pdbe/static/entry/{}_updated.cif".format(accession), allow_redirects=True)  # updated mmCIF file
+        for file_type in file_types:
+            if todo is not None and (accession, file_type) not in todo:
+                print("\t{} file for {} already downloaded.".format(file_type, accession))
+            elif results is None:
+                fetch(accession, file_type, print)
+            else:
+                for message in next(results):
+                    print(message)
 
-            # trying to download corresponding cif file from 'https://pdbj.org/' if not available in RCSB, PDBe
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading cif file from PDBj for {}, failed in RCSB, PDBe.".format(accession))
-                response = requests.get("https://pdbj.org/rest/downloadPDBfile?format=mmcif&id={}".format(accession), allow_redirects=True)
+        print("Completed, {}/{} proteins remaining.{}".format(len(accession_list) - (index + 1), len(accession_list), '\n' if index < len(accession_list) - 1 else ''))
 
-            # trying to download corresponding cif file from 'http://www.wwpdb.org/ftp/pdb-ftp-sites' if not available in RCSB, PDBe, PDBj
-            if response.status_code == 404:
-                if debug_on:
-                    print("<debug> Downloading cif file from wwPDB for {}, failed in RCSB, PDBe, PDBj.".format(accession))
-                response = requests.get("https://ftp.wwpdb.org/pub/pdb/data/structures/all/mmCIF/{}.cif.gz".format(accession), allow_redirects=True)
+    if journal is not None:
+        # failed files were queued instead of stopping the batch; they get another chance now
+        for queue in journal.retry_queue(jobs):
+            for messages in ordered_map(run_task, queue, workers):
+                for message in messages:
+                    print(message)
+        journal.report(jobs)
 
-            # downloading corresponding cif file to local machine
-            if response.status_code == 200:
-                with open("{}/{}.cif.gz".format(output_dir, accession), 'wb') as output_file:
-                    output_file.write(response.content)
-            elif response.status_code == 404:
-                print("\t\tcif{}: Not found in RCSB, PDBe, PDBj, wwPDB.".format(accession))
+    if cache is not None:
+        cache.report()
 
-        print("Completed, {}/{} proteins remaining.{}".format(len(accession_list) - (index + 1), len(accession_list), '\n' if index < len(accession_list) - 1 else ''))
+    if debug_on and scheduler is not None:
+        for mirror, stats in scheduler.summary().items():
+            print("<debug> {}: {} requests, {:.3f}s to first byte, {:.0%} hits, {:.0%} errors.".format(mirror, stats['requests'], stats['latency'], stats['hit_rate'], stats['error_rate']))
 
     # preparing and downloading corresponding .xlsx file containing PDB sites' links to local machine
     if download_links:
         print("\n======================================")
-        download_rcsb_pdbe_pdbj_links(accession_list, debug_on).to_excel("{}/proteins-links.xlsx".format(output_dir), index=False)
+        probe_cache = ProbeCache(os.path.join(output_dir, ".link-probes.json"))
+        download_rcsb_pdbe_pdbj_links(accession_list, debug_on, session, probe_cache=probe_cache).to_excel("{}/proteins-links.xlsx".format(output_dir), index=False)
 
     # preparing and downloading corresponding .xlsx file containing metadata from 'https://www.rcsb.org/' to local machine
     if download_metadata:
         print("\n======================================")
-        download_rcsb_metadata(accession_list).to_excel("{}/proteins-metadata.xlsx".format(output_dir), index=False)
+        download_rcsb_metadata(accession_list, session, bulk_metadata, metadata_index).to_excel("{}/proteins-metadata.xlsx".format(output_dir), index=False)
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,286 @@
+import os
+import re
+import time
+
+import numpy as np
+
+from common.gunzip import gunzip_bytes, unzipped_path
+
+# one record per atom; fixed-size fields so the array can be saved as .npy and memory-mapped back
+ATOM_DTYPE = np.dtype([
+    ('coords', '<f4', (3,)),
+    ('element', 'S2'),
+    ('atom_name', 'S4'),
+    ('residue_name', 'S3'),
+    ('residue_id', '<i4'),
+    ('insertion', 'S1'),
+    ('chain', 'S4'),
+    ('b_factor', '<f4'),
+    ('occupancy', '<f4'),
+    ('hetero', '?'),
+])
+
+CACHE_SUFFIX = ".atoms.npy"
+
+# ATOM/HETATM records of a PDB file
+PDB_ATOM_RECORD = re.compile(rb'^(?:ATOM  |HETATM).*$', re.MULTILINE)
+PDB_END_OF_MODEL = b'\nENDMDL'
+
+# PDB columns (0-based, end exclusive) of the fields of ATOM_DTYPE
+PDB_COLUMNS = {
+    'atom_name': (12, 16),
+    'residue_name': (17, 20),
+    'chain': (21, 22),
+    'residue_id': (22, 26),
+    'insertion': (26, 27),
+    'x': (30, 38), 'y': (38, 46), 'z': (46, 54),
+    'occupancy': (54, 60),
+    'b_factor': (60, 66),
+    'element': (76, 78),
+}
+
+# mmCIF _atom_site items of the fields of ATOM_DTYPE, the first one present is used
+CIF_ITEMS = {
+    'atom_name': ('auth_atom_id', 'label_atom_id'),
+    'residue_name': ('auth_comp_id', 'label_comp_id'),
+    'chain': ('auth_asym_id', 'label_asym_id'),
+    'residue_id': ('auth_seq_id', 'label_seq_id'),
+    'insertion': ('pdbx_PDB_ins_code',),
+    'x': ('Cartn_x',), 'y': ('Cartn_y',), 'z': ('Cartn_z',),
+    'occupancy': ('occupancy',),
+    'b_factor': ('B_iso_or_equiv',),
+    'element': ('type_symbol',),
+    'group': ('group_PDB',),
+    'model': ('pdbx_PDB_model_num',),
+}
+CIF_ITEM_PREFIX = b'_atom_site.'
+# a loop ends at the next comment line ('#'), loop_ or data item
+CIF_LOOP_ENDS = (b'\n#', b'\nloop_', b'\n_')
+# tokens of a loop when some are quoted because they contain blanks
+CIF_TOKEN = re.compile(rb"'[^']*'(?=\s)|\"[^\"]*\"(?=\s)|\S+")
+
+# lookup table indexed by byte value: True for the digits
+DIGIT = np.zeros(256, dtype=bool)
+DIGIT[ord('0'):ord('9') + 1] = True
+
+
+def to_strings(chars):
+    '''
+        output:
+            - byte strings of a (values, width) uint8 matrix, blanks stripped
+    '''
+    chars = np.ascontiguousarray(chars)
+    return np.char.strip(chars.view('S{}'.format(max(chars.shape[1], 1))).ravel())
+
+
+def to_numbers(chars, default=0):
+    '''
+        description:
+            Function for converting a (values, width) uint8 matrix of numbers to float64 in one call;
+            values without any digit (blank, '?', '.') become default.
+    '''
+    strings = np.ascontiguousarray(chars).view('S{}'.format(max(chars.shape[1], 1))).ravel()
+    present = DIGIT[chars].any(axis=1)
+    values = np.full(len(strings), default, dtype=np.float64)
+    values[present] = strings[present].astype(np.float64)
+    return values
+
+
+def element_from_name(atom_names):
+    # old files leave the element columns blank; the element is then the first letter of the atom name
+    return np.char.lstrip(atom_names, b'0123456789').astype('S1')
+
+
+def build_atoms(columns):
+    '''
+        output:
+            - ATOM_DTYPE array from a dict of (atoms, width) uint8 matrices named like PDB_COLUMNS
+    '''
+    atoms = np.zeros(len(columns['x']), dtype=ATOM_DTYPE)
+    for axis, name in enumerate(('x', 'y', 'z')):
+        atoms['coords'][:, axis] = to_numbers(columns[name])
+    for name in ('atom_name', 'residue_name', 'chain', 'insertion'):
+        strings = to_strings(columns[name])
+        atoms[name] = np.where((strings == b'?') | (strings == b'.'), b'', strings)
+    atoms['residue_id'] = to_numbers(columns['residue_id'])
+    atoms['occupancy'] = to_numbers(columns['occupancy'], 1)
+    atoms['b_factor'] = to_numbers(columns['b_factor'])
+    elements = np.char.upper(to_strings(columns['element']))
+    blank = (elements == b'') | (elements == b'?') | (elements == b'.')
+    if blank.any():
+        elements[blank] = element_from_name(atoms['atom_name'][blank])
+    atoms['element'] = elements
+    atoms['hetero'] = columns['hetero']
+    return atoms
+
+
+def parse_pdb(data):
+    '''
+        description:
+            Function for reading the atoms of a PDB file (first model only). The ATOM/HETATM records
+            are found with one regex pass over the file and laid out as an (atoms, 80) byte matrix;
+            every field is then a column slice of that matrix, converted for all atoms at once.
+
+        input:
+            - data: content of the PDB file (bytes)
+
+        output:
+            - ATOM_DTYPE array
+    '''
+    end_of_model = data.find(PDB_END_OF_MODEL)
+    if end_of_model >= 0:
+        data = data[:end_of_model]
+    records = np.array(PDB_ATOM_RECORD.findall(data), dtype='S80')
+    # a short record is padded with NUL bytes, which read as blanks
+    table = records.view(np.uint8).reshape(len(records), 80)
+    columns = {name: table[:, start:end] for name, (start, end) in PDB_COLUMNS.items()}
+    columns['hetero'] = table[:, 0] == ord('H')
+    return build_atoms(columns)
+
+
+def atom_site_loop(data):
+    '''
+        output:
+            - (item names, whitespace-separated rows) of the _atom_site loop of an mmCIF file
+    '''
+    offset = data.find(b'\n' + CIF_ITEM_PREFIX) + 1
+    if offset == 0:
+        return [], b''
+    items = []
+    while data.startswith(CIF_ITEM_PREFIX, offset):
+        line_end = data.find(b'\n', offset)
+        items.append(data[offset + len(CIF_ITEM_PREFIX):line_end].strip().decode())
+        offset = line_end + 1
+    ends = [end for end in (data.find(marker, offset - 1) for marker in CIF_LOOP_ENDS) if end >= 0]
+    return items, data[offset:min(ends) + 1 if ends else len(data)]
+
+
+def token_columns(rows, items):
+    '''
+        description:
+            Function for splitting the rows of a loop into one (rows, width) uint8 matrix per item.
+            Token boundaries are the edges of the runs of blank bytes, found over the whole buffer
+            at once; every column is then gathered from the buffer with one fancy-indexing step.
+            Loops with quoted values containing blanks are tokenized with a regex instead: their first
+            piece starts with a quote it does not end with, whether or not the count of pieces still
+            happens to split into the items.
+
+        output:
+            - list of uint8 matrices, one per item
+    '''
+    buffer = np.frombuffer(rows, dtype=np.uint8)
+    blank = np.concatenate(([True], buffer <= 32, [True]))
+    edges = np.diff(blank.view(np.int8))
+    starts, ends = np.flatnonzero(edges == -1), np.flatnonzero(edges == 1)
+    first, last = buffer[starts], buffer[np.maximum(ends - 1, 0)]
+    quoted = (first == ord("'")) | (first == ord('"'))
+    # quoted tokens without blanks ("O5'") stay on the fast path, unquote() strips their quotes
+    split = (quoted & ((last != first) | (ends - starts < 2))).any()
+    if split or len(starts) % len(items):
+        tokens = np.array(CIF_TOKEN.findall(rows))
+        if len(tokens) % len(items):
+            raise ValueError("_atom_site loop of {} tokens does not split into {} items".format(len(tokens), len(items)))
+        table = tokens.reshape(-1, len(items))
+        columns = [table[:, index].reshape(-1, 1).view(np.uint8) for index in range(len(items))]
+    else:
+        starts, ends = starts.reshape(-1, len(items)), ends.reshape(-1, len(items))
+        columns = []
+        for index in range(len(items)):
+            width = int((ends[:, index] - starts[:, index]).max()) if len(starts) else 1
+            positions = starts[:, index, None] + np.arange(width)
+            inside = positions < ends[:, index, None]
+            columns.append(np.where(inside, buffer[np.minimum(positions, len(buffer) - 1)], 0).astype(np.uint8))
+    return [unquote(column) for column in columns]
+
+
+def unquote(chars):
+    # atom names with a prime are quoted ("O5'"); a value is quoted with the quote character it doesn't contain
+    quoted = (chars[:, 0] == ord('"')) | (chars[:, 0] == ord("'"))
+    if not quoted.any():
+        return chars
+    strings = to_strings(chars)
+    for quote in (b'"', b"'"):
+        starting = np.char.startswith(strings, quote)
+        strings[starting] = np.char.strip(strings[starting], quote)
+    return strings.reshape(-1, 1).view(np.uint8)
+
+
+def parse_cif(data):
+    '''
+        description:
+            Function for reading the atoms of an mmCIF file (first model only). The rows of the
+            _atom_site loop are split into one byte matrix per item (token_columns), so every
+            item is a column converted for all atoms at once.
+
+        input:
+            - data: content of the mmCIF file (bytes)
+
+        output:
+            - ATOM_DTYPE array
+    '''
+    items, rows = atom_site_loop(data)
+    if not items:
+        return np.zeros(0, dtype=ATOM_DTYPE)
+    table = token_columns(rows, items)
+    count = len(table[0])
+    columns = {}
+    for name, candidates in CIF_ITEMS.items():
+        present = [item for item in candidates if item in items]
+        columns[name] = table[items.index(present[0])] if present else np.zeros((count, 1), dtype=np.uint8)
+    if 'pdbx_PDB_model_num' in items and count:
+        models = to_strings(columns['model'])
+        first_model = models == models[0]
+        columns = {name: values[first_model] for name, values in columns.items()}
+    columns['hetero'] = to_strings(columns['group']) == b'HETATM'
+    return build_atoms(columns)
+
+
+def cache_path(path):
+    '''
+        output:
+            - binary sidecar of a structure file ('pdb6vxx.ent.gz' -> 'pdb6vxx.ent.atoms.npy')
+    '''
+    return unzipped_path(path) + CACHE_SUFFIX
+
+
+def load_cached(path):
+    # the sidecar carries the mtime of the file it was parsed from; any other mtime means the file was replaced
+    try:
+        if os.stat(cache_path(path)).st_mtime_ns != os.stat(path).st_mtime_ns:
+            return None
+        atoms = np.load(cache_path(path), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    return atoms if atoms.dtype == ATOM_DTYPE else None
+
+
+def load_structure(path, cache=True):
+    '''
+        description:
+            Function for reading the atoms of a downloaded PDB or mmCIF file, gzipped or not, into
+            columnar NumPy arrays. The first load parses the file and saves the atoms next to it as a
+            .npy sidecar; later loads memory-map the sidecar instead of parsing the text again.
+
+        input:
+            - path: pdb<id>.ent(.gz) or <id>.cif(.gz) file
+            - cache: reads and writes the .npy sidecar (default=True)
+
+        output:
+            - atoms: ATOM_DTYPE structured array (memory-mapped when loaded from the sidecar); fields are
+              columns, e.g. atoms['coords'] is (atoms, 3) float32 and atoms['element'] bytes like b'C'
+    '''
+    if cache:
+        atoms = load_cached(path)
+        if atoms is not None:
+            return atoms
+    with open(path, 'rb') as structure_file:
+        data = gunzip_bytes(structure_file.read())
+    atoms = parse_cif(data) if unzipped_path(path).endswith(".cif") else parse_pdb(data)
+    if cache:
+        # written under a temporary name so a concurrent reader never maps a partial file
+        part_path = cache_path(path) + ".part"
+        with open(part_path, 'wb') as cache_file:
+            np.save(cache_file, atoms)
+        os.utime(part_path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        os.replace(part_path, cache_path(path))
+    return atoms
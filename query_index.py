@@ -0,0 +1,49 @@
+import argparse
+
+from common.metadata_index import MetadataIndex
+
+def print_rows(rows):
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+    print("{} rows".format(len(rows)))
+
+
+def parseArguments():
+    parser = argparse.ArgumentParser(prog='query_index', description='Queries the local EMDB/PDB metadata index built by dataloader.py --index')
+    required = parser.add_argument_group('Required Arguments')
+    required.add_argument('-db','--index',
+    	help="SQLite metadata index file",
+    	required=True,
+    	metavar='FILE')
+    parser.add_argument('--fitted_after',
+    	help="List EMDB maps with fitted PDBs whose map was released after DATE (YYYY-MM-DD); use '' for all",
+    	metavar='DATE')
+    parser.add_argument('--emdb',
+    	help="List the PDB entries cross-referenced with an EMDB entry",
+    	metavar='ID')
+    parser.add_argument('--pdb',
+    	help="List the EMDB entries cross-referenced with a PDB entry",
+    	metavar='ID')
+    parser.add_argument('--sql',
+    	help="Run an SQL query (tables emdb_entries, pdb_entries, cross_references)",
+    	metavar='QUERY')
+
+    args = parser.parse_args()
+    index = MetadataIndex(args.index)
+
+    if args.fitted_after is not None:
+        print_rows(index.maps_with_fitted_pdbs(args.fitted_after))
+    if args.emdb:
+        print_rows([(pdb,) for pdb in index.fitted_pdbs(args.emdb)])
+    if args.pdb:
+        print_rows([(emdb,) for emdb in index.emdb_maps(args.pdb)])
+    if args.sql:
+        print_rows(index.query(args.sql))
+    index.close()
+
+def main():
+	arguments = parseArguments()
+
+if __name__ == "__main__":
+
+	main()
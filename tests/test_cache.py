@@ -0,0 +1,79 @@
+import os
+
+from common.cache import ContentCache, file_checksum
+from common.checksums import pop_checksum, remember_checksum
+
+CONTENT = b"cached map" * 1000
+
+
+def write(path, content):
+    with open(path, 'wb') as output_file:
+        output_file.write(content)
+
+
+def read(path):
+    with open(path, 'rb') as input_file:
+        return input_file.read()
+
+
+def stored_cache(tmp_path):
+    cache = ContentCache(str(tmp_path / "cache"))
+    download = str(tmp_path / "download.gz")
+    write(download, CONTENT)
+    cache.store("emd_1.map.gz", download, "http://example.org/emd_1.map.gz")
+    return cache
+
+
+def test_restore_replaces_same_size_file(tmp_path):
+    cache = stored_cache(tmp_path)
+    output_path = str(tmp_path / "emd_1.map.gz")
+    # an interrupted or foreign file of the right size is not the cached content
+    write(output_path, b"x" * len(CONTENT))
+
+    assert cache.restore("emd_1.map.gz", output_path)
+
+    assert read(output_path) == CONTENT
+    assert pop_checksum(output_path) == file_checksum(output_path)
+
+
+def test_restore_keeps_linked_file(tmp_path):
+    cache = stored_cache(tmp_path)
+    output_path = str(tmp_path / "emd_1.map.gz")
+    assert cache.restore("emd_1.map.gz", output_path)
+    inode = os.stat(output_path).st_ino
+
+    assert cache.restore("emd_1.map.gz", output_path)
+
+    assert os.stat(output_path).st_ino == inode
+    assert cache.hits == 2
+
+
+def test_restore_of_evicted_blob_is_miss(tmp_path):
+    cache = stored_cache(tmp_path)
+    output_path = str(tmp_path / "emd_1.map.gz")
+    lookup = cache.lookup
+
+    def evicting_lookup(key):
+        # a concurrent store() evicts the entry right after this lookup
+        entry = lookup(key)
+        os.remove(cache._blob_path(entry['sha256']))
+        del cache._entries[key]
+        return entry
+    cache.lookup = evicting_lookup
+
+    assert not cache.restore("emd_1.map.gz", output_path)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+
+def test_store_uses_streamed_checksum(tmp_path):
+    cache = ContentCache(str(tmp_path / "cache"))
+    download = str(tmp_path / "download.gz")
+    write(download, CONTENT)
+    # stands in for the checksum stream_to_file records; a file_checksum() would give the real one
+    remember_checksum(download, "ab" * 32)
+
+    cache.store("emd_1.map.gz", download, "http://example.org/emd_1.map.gz")
+
+    assert cache.lookup("emd_1.map.gz")['sha256'] == "ab" * 32
+    # left for the journal
+    assert pop_checksum(download) == "ab" * 32
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+
+from empiar.conversion import ConversionPipeline, converted_tiffs
+from tests.test_native_tif2mrc import write_tiff
+
+
+def test_converted_tiffs(tmp_path):
+    folder = tmp_path / "data" / "Control"
+    folder.mkdir(parents=True)
+    # converted and removed
+    (folder / "frames_001.mrc").write_bytes(b"mrc")
+    # converted, tif still there
+    (folder / "frames_002.tif").write_bytes(b"tif")
+    (folder / "frames_002.mrc").write_bytes(b"mrc")
+    # left empty by a conversion that failed
+    (folder / "frames_003.mrc").write_bytes(b"")
+
+    assert converted_tiffs(str(tmp_path)) == [os.path.join("data", "Control", "frames_001.tif"), os.path.join("data", "Control", "frames_001.tiff")]
+
+
+def test_pipeline_deletes_converted_tif(tmp_path):
+    tif_path = str(tmp_path / "frames.tif")
+    write_tiff(tif_path, np.arange(2 * 4 * 6, dtype=np.uint16).reshape(2, 4, 6))
+    pipeline = ConversionPipeline(workers=1, engine='native', delete_tif=True)
+
+    pipeline.submit(tif_path)
+    results = pipeline.finish()
+
+    assert [(in_file, error) for in_file, error, seconds in results] == [(tif_path, None)]
+    assert not os.path.exists(tif_path)
+    assert os.path.getsize(str(tmp_path / "frames.mrc")) > 0
+    assert pipeline._sizes == {}
+    assert converted_tiffs(str(tmp_path)) == ["frames.tif", "frames.tiff"]
@@ -0,0 +1,44 @@
+import csv
+import os
+
+import pytest
+
+import cross_archive
+from benchmark.mirror_emulator import MirrorEmulator
+from common.endpoints import set_mirror_root
+from common.session import make_session
+
+
+@pytest.fixture
+def mirror():
+    with MirrorEmulator(map_size=64 * 1024, atoms=20) as emulator:
+        set_mirror_root(emulator.url)
+        yield emulator
+    set_mirror_root(None)
+
+
+def test_failed_files_are_reported(mirror, tmp_path, monkeypatch, capsys):
+    download_pdb_file = cross_archive.download_pdb_file
+
+    def broken_map(*args):
+        raise OSError("disk full")
+
+    def missing_cif(accession, file_type, *args):
+        if file_type == 'cif':
+            return False
+        return download_pdb_file(accession, file_type, *args)
+    monkeypatch.setattr(cross_archive, "download_emdb_map", broken_map)
+    monkeypatch.setattr(cross_archive, "download_pdb_file", missing_cif)
+    output_dir = str(tmp_path / "out")
+
+    pairs = cross_archive.cross_archive_stub(["11082"], output_dir, image=False, session=make_session(retries=0), workers=2)
+
+    output = capsys.readouterr().out
+    assert pairs == [("11082", "1abc")]
+    assert "EMD-11082: map OSError: disk full" in output
+    assert "1abc: cif file failed" in output
+    assert "2 files failed: EMD-11082 map, 1abc cif" in output
+    assert os.path.exists(os.path.join(output_dir, "pdb1abc.ent.gz"))
+    assert os.path.exists(os.path.join(output_dir, "header_emd_11082.txt"))
+    with open(os.path.join(output_dir, "pairs.csv"), newline='') as pairs_file:
+        assert list(csv.reader(pairs_file)) == [['EMDB ID', 'PDB ID', 'Failed files'], ['EMD-11082', '1abc', 'EMD-11082 map; 1abc cif']]
@@ -0,0 +1,85 @@
+from benchmark.mirror_emulator import synthetic_header
+from emdb.emdb_header import EMDBHeader, parse_emdb_header
+
+# abridged v3 header (emd-<id>.xml of the archive today): <deposition> also names the deposition site and date
+V3_HEADER = b"""<?xml version="1.0" encoding="UTF-8"?>
+<emd emdb_id="EMD-11082" version="3.0.2.7">
+  <admin>
+    <current_status><code>REL</code></current_status>
+    <sites>
+      <deposition>PDBe</deposition>
+      <last_processing>PDBe</last_processing>
+    </sites>
+    <key_dates>
+      <deposition>2020-01-10</deposition>
+      <header_release>2020-02-12</header_release>
+      <map_release>2020-02-12</map_release>
+    </key_dates>
+    <title>Spike glycoprotein in the closed state</title>
+  </admin>
+  <crossreferences>
+    <citation_list>
+      <primary_citation>
+        <journal_citation published="true">
+          <title>Structure of the spike glycoprotein</title>
+          <external_references type="PUBMED">32075877</external_references>
+        </journal_citation>
+      </primary_citation>
+    </citation_list>
+  </crossreferences>
+</emd>
+"""
+
+
+def chunked(content, size=64):
+    for start in range(0, len(content), size):
+        yield content[start:start + size]
+
+
+def consumed(chunks, log):
+    for chunk in chunks:
+        log.append(chunk)
+        yield chunk
+
+
+def test_v1_9_header():
+    header = parse_emdb_header(chunked(synthetic_header("11082", "6vxx")))
+
+    assert header == EMDBHeader(structure_title="Synthetic entry 11082", fitted_pdbs=["6vxx"], deposition_date="2020-01-01",
+                                header_release_date="2020-02-01", map_release_date="2020-02-01",
+                                article_title="Synthetic article 11082", pubmed="1", doi="doi:10.0/11082", issn="0000-0000")
+
+
+def test_v1_9_header_stops_after_deposition():
+    content = synthetic_header("11082", "6vxx").replace(b"</deposition>", b"</deposition>\n  <map>" + b" " * 4096)
+    chunks = list(chunked(content))
+    log = []
+
+    header = parse_emdb_header(consumed(chunks, log))
+
+    assert header.structure_title == "Synthetic entry 11082"
+    assert header.issn == "0000-0000"
+    assert len(log) < len(chunks)
+
+
+def test_v3_header_reads_past_nested_deposition():
+    chunks = list(chunked(V3_HEADER))
+    log = []
+
+    header = parse_emdb_header(consumed(chunks, log))
+
+    # the v1.9 field names are not in a v3 header, only the title is; the nested <deposition>s do not end the parse
+    assert header.structure_title == "Spike glycoprotein in the closed state"
+    assert header.fitted_pdbs == []
+    assert header.deposition_date == ""
+    assert len(log) == len(chunks)
+
+
+def test_truncated_header_keeps_what_was_read():
+    content = synthetic_header("11082", "6vxx")
+
+    header = parse_emdb_header([content[:content.index(b"<primaryReference")]])
+
+    assert header.structure_title == "Synthetic entry 11082"
+    assert header.fitted_pdbs == ["6vxx"]
+    assert header.article_title == ""
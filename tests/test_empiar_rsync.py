@@ -0,0 +1,116 @@
+import os
+import shutil
+
+import pytest
+
+from empiar.conversion import converted_tiffs
+from empiar.empiar_downloader import download, entry_directory, exclude_file, transfer_entry
+
+requires_rsync = pytest.mark.skipif(shutil.which("rsync") is None, reason="rsync is not installed")
+
+ENTRY = "10533"
+
+FILES = {
+    "10533.xml": b"<entry/>",
+    "data/Control/frames_001.tif": b"tif 1" * 100,
+    "data/Control/frames_002.tif": b"tif 2" * 100,
+    "data/Treated/run1/frames_003.tif": b"tif 3" * 100,
+    "data/gain.mrc": b"gain",
+    "metadata/notes.txt": b"notes",
+}
+
+
+def make_source(root):
+    for relative, content in FILES.items():
+        path = os.path.join(root, ENTRY, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as source_file:
+            source_file.write(content)
+    return root.rstrip("/") + "/"
+
+
+def tree(root):
+    found = {}
+    for directory, directories, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            with open(path, 'rb') as tree_file:
+                found[os.path.relpath(path, root)] = tree_file.read()
+    return found
+
+
+def test_entry_directory():
+    assert entry_directory(ENTRY, "/data/out") == os.path.join("/data/out", ENTRY)
+    assert entry_directory(int(ENTRY), "/data/out") == os.path.join("/data/out", ENTRY)
+
+
+def test_exclude_file():
+    skip = ["data/Control/frames_001.tif", "data/Treated/run1/frames_003.tif"]
+
+    with exclude_file(skip) as path:
+        with open(path) as exclude:
+            assert exclude.read().split() == ["/data/Control/frames_001.tif", "/data/Treated/run1/frames_003.tif"]
+    assert not os.path.exists(path)
+    # anchored at the shard a transfer starts at
+    with exclude_file(skip, "data/Treated/") as path:
+        with open(path) as exclude:
+            assert exclude.read().split() == ["/run1/frames_003.tif"]
+    with exclude_file(skip, "metadata/") as path:
+        assert path is None
+    with exclude_file(None) as path:
+        assert path is None
+
+
+@requires_rsync
+def test_single_and_sharded_transfers_write_the_same_tree(tmp_path):
+    source = make_source(str(tmp_path / "archive"))
+    single, sharded = str(tmp_path / "single"), str(tmp_path / "sharded")
+    single_files, sharded_files = [], []
+
+    download(ENTRY, single, source=source, on_file=single_files.append)
+    failed = transfer_entry(ENTRY, sharded, workers=3, source=source, depth=2, on_file=sharded_files.append)
+
+    assert failed == []
+    expected = {os.path.normpath(relative): content for relative, content in FILES.items()}
+    assert tree(entry_directory(ENTRY, single)) == expected
+    assert tree(entry_directory(ENTRY, sharded)) == expected
+    # every reported file is where the conversion pipeline looks for it
+    assert sorted(os.path.relpath(path, entry_directory(ENTRY, single)) for path in single_files) == sorted(expected)
+    assert sorted(os.path.relpath(path, entry_directory(ENTRY, sharded)) for path in sharded_files) == sorted(expected)
+
+
+@requires_rsync
+def test_switching_modes_reuses_the_downloaded_tree(tmp_path):
+    source = make_source(str(tmp_path / "archive"))
+    output = str(tmp_path / "out")
+    download(ENTRY, output, source=source)
+    transferred = []
+    transfer_entry(ENTRY, output, workers=2, source=source, on_file=transferred.append)
+
+    assert transferred == []
+    assert sorted(os.listdir(entry_directory(ENTRY, output))) == ["10533.xml", "data", "metadata"]
+
+
+@requires_rsync
+def test_converted_tiffs_are_not_downloaded_again(tmp_path):
+    source = make_source(str(tmp_path / "archive"))
+    for sharded in (False, True):
+        output = str(tmp_path / ("sharded" if sharded else "single"))
+        download(ENTRY, output, source=source)
+        entry_direc = entry_directory(ENTRY, output)
+        # what ConversionPipeline leaves behind with delete_tif
+        for relative in FILES:
+            if relative.endswith(".tif"):
+                with open(os.path.join(entry_direc, relative[:-len(".tif")] + ".mrc"), 'wb') as mrc_file:
+                    mrc_file.write(b"mrc")
+                os.remove(os.path.join(entry_direc, relative))
+        transferred = []
+
+        skip = converted_tiffs(entry_direc)
+        if sharded:
+            transfer_entry(ENTRY, output, workers=2, source=source, on_file=transferred.append, skip=skip)
+        else:
+            download(ENTRY, output, source=source, on_file=transferred.append, skip=skip)
+
+        assert transferred == []
+        assert not [relative for relative in tree(entry_direc) if relative.endswith(".tif")]
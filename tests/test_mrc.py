@@ -0,0 +1,53 @@
+import struct
+
+import numpy as np
+
+from volume.mrc import HEADER_SIZE, IMOD_STAMP, build_header, mode_for_dtype, parse_header
+from volume.reader import MapVolume
+
+
+def write_map(path, data, **header_fields):
+    mode, dtype = mode_for_dtype(data.dtype)
+    with open(path, 'wb') as map_file:
+        map_file.write(build_header(data.shape, mode, dtype=dtype, **header_fields))
+        map_file.write(data.astype(dtype).tobytes())
+
+
+def test_uint8_header_is_stamped_unsigned():
+    mode, dtype = mode_for_dtype(np.uint8)
+    header = build_header((2, 3, 4), mode, dmin=0, dmax=255, dtype=dtype)
+    assert mode == 0
+    assert struct.unpack_from('<2i', header, 152) == (IMOD_STAMP, 0)
+    assert parse_header(header)['dtype'] == np.dtype('u1')
+
+
+def test_int8_header_stays_signed():
+    mode, dtype = mode_for_dtype(np.int8)
+    header = build_header((2, 3, 4), mode, dtype=dtype)
+    assert struct.unpack_from('<2i', header, 152) == (0, 0)
+    assert parse_header(header)['dtype'] == np.dtype('i1')
+
+
+def test_uint8_round_trip(tmp_path):
+    data = np.arange(2 * 8 * 16, dtype=np.uint8).reshape(2, 8, 16)
+    path = str(tmp_path / "bytes.mrc")
+    write_map(path, data, dmin=0, dmax=255, dmean=float(data.mean()), ispg=1)
+
+    volume = MapVolume(path)
+    assert volume.header['mode'] == 0
+    assert volume.header['dmax'] == 255
+    assert volume.header['data_offset'] == HEADER_SIZE
+    assert volume.dtype == np.dtype('u1')
+    assert volume.shape == data.shape
+    assert np.array_equal(np.asarray(volume.data), data)
+
+
+def test_round_trip_other_modes(tmp_path):
+    for dtype, mode in (('i2', 1), ('u2', 6), ('f2', 12), ('f4', 2)):
+        data = np.arange(3 * 4 * 5).reshape(3, 4, 5).astype(dtype)
+        path = str(tmp_path / "{}.mrc".format(dtype))
+        write_map(path, data)
+        volume = MapVolume(path)
+        assert volume.header['mode'] == mode
+        assert volume.dtype == np.dtype(dtype)
+        assert np.array_equal(np.asarray(volume.data), data)
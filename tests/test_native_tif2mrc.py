@@ -0,0 +1,111 @@
+import struct
+
+import numpy as np
+
+from empiar.native_tif2mrc import TiffReader, tif_to_mrc
+from volume.mrc import IMOD_STAMP
+from volume.reader import MapVolume
+
+# SampleFormat of the numpy kinds
+SAMPLE_FORMATS = {'u': 1, 'i': 2, 'f': 3}
+
+
+def write_tiff(path, frames):
+    '''
+        description:
+            Writes frames (n, height, width) as an uncompressed little-endian TIFF, one page and one strip per frame.
+    '''
+    count, height, width = frames.shape
+    frame_size = height * width * frames.dtype.itemsize
+    tags_size = 2 + 10 * 12 + 4
+    with open(path, 'wb') as tiff_file:
+        tiff_file.write(b'II' + struct.pack('<HI', 42, 8))
+        for index in range(count):
+            ifd_offset = 8 + index * (tags_size + frame_size)
+            data_offset = ifd_offset + tags_size
+            next_offset = data_offset + frame_size if index < count - 1 else 0
+            tags = [
+                (256, 4, width), (257, 4, height), (258, 3, frames.dtype.itemsize * 8), (259, 3, 1), (262, 3, 1),
+                (273, 4, data_offset), (277, 3, 1), (278, 4, height), (279, 4, frame_size), (339, 3, SAMPLE_FORMATS[frames.dtype.kind]),
+            ]
+            tiff_file.write(struct.pack('<H', len(tags)))
+            for tag, field_type, value in tags:
+                tiff_file.write(struct.pack('<HHI', tag, field_type, 1) + struct.pack('<H2x' if field_type == 3 else '<I', value))
+            tiff_file.write(struct.pack('<I', next_offset))
+            tiff_file.write(frames[index].astype(frames.dtype.newbyteorder('<')).tobytes())
+
+
+def reference_header(shape, mode, data, label, imod_stamp=0):
+    '''
+        description:
+            MRC2014 header expected for an image stack converted with voxel size 1, spelled out field by field.
+    '''
+    nz, ny, nx = shape
+    values = data.astype(np.float64)
+    mean = values.sum() / values.size
+    rms = np.sqrt(max(np.square(values).sum() / values.size - mean * mean, 0.0))
+    header = struct.pack('<10i', nx, ny, nz, mode, 0, 0, 0, nx, ny, 1)
+    header += struct.pack('<6f', nx, ny, 1, 90, 90, 90)
+    header += struct.pack('<3i', 1, 2, 3)
+    header += struct.pack('<3f', values.min(), values.max(), mean)
+    header += struct.pack('<2i', 0, 0)
+    header += bytes(8)
+    header += b'MRCO' + struct.pack('<i', 20140)
+    header += bytes(40)
+    header += struct.pack('<2i', imod_stamp, 0)
+    header += bytes(36)
+    header += struct.pack('<3f', 0, 0, 0)
+    header += b'MAP ' + b'\x44\x44\x00\x00' + struct.pack('<fi', rms, 1)
+    header += label.encode('ascii').ljust(80, b' ')
+    header += bytes(1024 - len(header))
+    return header
+
+
+def convert(tmp_path, frames):
+    tif_path = str(tmp_path / "stack.tif")
+    mrc_path = str(tmp_path / "stack.mrc")
+    write_tiff(tif_path, frames)
+    header = tif_to_mrc(tif_path, mrc_path)
+    with open(mrc_path, 'rb') as mrc_file:
+        return header, mrc_file.read()
+
+
+def check_conversion(tmp_path, frames, mode, imod_stamp=0):
+    header, written = convert(tmp_path, frames)
+    flipped = frames[:, ::-1]
+    expected = reference_header(frames.shape, mode, flipped, "tif2mrc (native): converted from stack.tif", imod_stamp)
+    assert len(header) == 1024
+    assert header == expected
+    assert written[:1024] == expected
+    assert written[1024:] == flipped.astype(flipped.dtype.newbyteorder('<')).tobytes()
+
+    volume = MapVolume(str(tmp_path / "stack.mrc"))
+    assert volume.dtype == frames.dtype
+    assert np.array_equal(np.asarray(volume.data), flipped)
+
+
+def test_tiff_reader(tmp_path):
+    frames = np.arange(3 * 5 * 7, dtype=np.int16).reshape(3, 5, 7)
+    write_tiff(str(tmp_path / "stack.tif"), frames)
+    with TiffReader(str(tmp_path / "stack.tif")) as reader:
+        assert reader.native()
+        assert reader.shape == (3, 5, 7)
+        assert reader.dtype == np.dtype('<i2')
+        assert np.array_equal(np.stack(list(reader.iter_frames())), frames)
+
+
+def test_uint8(tmp_path):
+    frames = (np.arange(3 * 6 * 10) * 7 % 256).astype(np.uint8).reshape(3, 6, 10)
+    frames[0, 0, 0], frames[1, 2, 3] = 0, 255
+    check_conversion(tmp_path, frames, 0, IMOD_STAMP)
+
+
+def test_int16(tmp_path):
+    frames = (np.arange(3 * 6 * 10) * 37 - 900).astype(np.int16).reshape(3, 6, 10)
+    check_conversion(tmp_path, frames, 1)
+
+
+def test_float32(tmp_path):
+    # quarters are exact in float32, so the statistics match to the last bit
+    frames = ((np.arange(3 * 6 * 10) - 90) / 4).astype(np.float32).reshape(3, 6, 10)
+    check_conversion(tmp_path, frames, 2)
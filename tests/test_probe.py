@@ -0,0 +1,83 @@
+import http.server
+import os
+import threading
+
+import pytest
+
+from common.probe import ProbeCache, probe_site, probe_url
+from common.session import make_session
+
+# path -> status answered to HEAD; HEAD_ONLY_GET paths answer 405 to HEAD and this status to a ranged GET
+STATUSES = {"/found": 200, "/gone": 410, "/missing": 404, "/busy": 503, "/limited": 429}
+HEAD_ONLY_GET = {"/ranged": 206}
+
+
+class ProbeHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status):
+        self.server.requests.append((self.command, self.path))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.answer(405 if self.path in HEAD_ONLY_GET else STATUSES.get(self.path, 404))
+
+    def do_GET(self):
+        self.answer(HEAD_ONLY_GET.get(self.path, 404))
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ProbeHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path):
+    return "http://127.0.0.1:{}{}".format(server.server_address[1], path)
+
+
+@pytest.fixture
+def session():
+    # no retries: the 5xx/429 answers are returned as they are
+    return make_session(retries=0)
+
+
+def test_probe_url_answers(server, session):
+    assert probe_url(url(server, "/found"), session) is True
+    assert probe_url(url(server, "/ranged"), session) is True
+    assert probe_url(url(server, "/missing"), session) is False
+    assert probe_url(url(server, "/gone"), session) is False
+    assert probe_url(url(server, "/busy"), session) is None
+    assert probe_url(url(server, "/limited"), session) is None
+
+
+def test_probe_url_transport_error(session):
+    # nothing listens on port 9 of localhost
+    assert probe_url("http://127.0.0.1:9/found", session) is None
+
+
+def test_probe_site_caches_definitive_answers_only(server, session, tmp_path):
+    cache = ProbeCache(os.path.join(str(tmp_path), "probes.json"))
+
+    assert probe_site("rcsb", "1abc", [url(server, "/busy"), url(server, "/missing")], session, cache) is None
+    assert cache.get("rcsb", "1abc") is None
+
+    assert probe_site("rcsb", "1abc", [url(server, "/missing"), url(server, "/found")], session, cache) is True
+    assert probe_site("pdbe", "1abc", [url(server, "/missing"), url(server, "/gone")], session, cache) is False
+    assert cache.get("rcsb", "1abc") is True
+    assert cache.get("pdbe", "1abc") is False
+
+    # served from the cache, the server is not asked again
+    count = len(server.requests)
+    assert probe_site("rcsb", "1abc", [url(server, "/busy")], session, cache) is True
+    assert probe_site("pdbe", "1abc", [url(server, "/busy")], session, cache) is False
+    assert len(server.requests) == count
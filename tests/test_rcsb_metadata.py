@@ -0,0 +1,106 @@
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+from common.endpoints import set_mirror_root
+from common.session import make_session
+from pdb.pdb_cif_dataloader import download_rcsb_metadata, get_metadata_bulk
+
+# answer of the RCSB Data API to RCSB_METADATA_QUERY, in the shape the API returns it
+FIXTURE = os.path.join(os.path.dirname(__file__), "fixtures", "rcsb_graphql_entries.json")
+
+# structure page of the entry 4HHB, reduced to the elements get_metadata() reads
+STRUCTURE_PAGE = """<html><body>
+<h1 id="structureTitle">THE CRYSTAL STRUCTURE OF HUMAN DEOXYHAEMOGLOBIN AT 1.74 ANGSTROMS RESOLUTION</h1>
+<div id="header_deposited-released-dates">Deposited:\xa01984-03-07\xa0Released:\xa01984-07-17\xa0</div>
+<div id="primarycitation"><h4>The crystal structure of human deoxyhaemoglobin at 1.74 A resolution</h4>
+<li id="pubmedDOI"><a href="https://doi.org/10.1016/0022-2836(84)90472-8">DOI</a></li></div>
+</body></html>"""
+
+
+class RCSBHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        ids = json.loads(self.rfile.read(int(self.headers["Content-Length"])))['variables']['ids']
+        self.server.batches.append(ids)
+        if self.path != "/data.rcsb.org/graphql" or self.server.graphql_status != 200:
+            return self.answer(self.server.graphql_status, "text/plain", b"unavailable")
+        with open(FIXTURE) as fixture_file:
+            response = json.load(fixture_file)
+        # like the API, only the requested entries it knows are returned
+        response['data']['entries'] = [entry for entry in response['data']['entries'] if entry['rcsb_id'] in ids]
+        self.answer(200, "application/json", json.dumps(response).encode())
+
+    def do_GET(self):
+        self.server.pages.append(self.path)
+        # structure pages are case-insensitive, as on www.rcsb.org
+        if self.path.upper() == "/WWW.RCSB.ORG/STRUCTURE/4HHB":
+            return self.answer(200, "text/html", STRUCTURE_PAGE.encode())
+        self.answer(404, "text/html", b"")
+
+
+@pytest.fixture
+def rcsb():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RCSBHandler)
+    server.batches = []
+    server.pages = []
+    server.graphql_status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    set_mirror_root("http://127.0.0.1:{}".format(server.server_address[1]))
+    yield server
+    set_mirror_root(None)
+    server.shutdown()
+    server.server_close()
+
+
+def test_field_mapping(rcsb):
+    metadata = get_metadata_bulk(["4hhb", "6vxx", "7zzz", "1xxx"], make_session(retries=0))
+
+    assert metadata["4HHB"] == ("THE CRYSTAL STRUCTURE OF HUMAN DEOXYHAEMOGLOBIN AT 1.74 ANGSTROMS RESOLUTION", "1984-03-07", "1984-07-17",
+                                'NA', 'NA', "The crystal structure of human deoxyhaemoglobin at 1.74 A resolution",
+                                "https://doi.org/10.1016/0022-2836(84)90472-8", 'No abstract available')
+    assert metadata["6VXX"] == ("Structure of the SARS-CoV-2 spike glycoprotein (closed state)", "2020-02-25", "2020-03-11",
+                                "EMD-21452", "https://www.ebi.ac.uk/emdb/EMD-21452",
+                                "Structure, Function, and Antigenicity of the SARS-CoV-2 Spike Glycoprotein",
+                                "https://doi.org/10.1016/j.cell.2020.02.058", 'No abstract available')
+    assert metadata["7ZZZ"][3:7] == ('NA', 'NA', "To be published", "Not published yet")
+    # not returned by the API
+    assert "1XXX" not in metadata
+    assert rcsb.batches == [["4HHB", "6VXX", "7ZZZ", "1XXX"]]
+
+
+def test_batch_size(rcsb):
+    accessions = ["6vxx", "4hhb"] + ["{}abc".format(index) for index in range(1, 10)] * 50
+
+    metadata = get_metadata_bulk(accessions, make_session(retries=0))
+
+    assert [len(batch) for batch in rcsb.batches] == [200, 200, 52]
+    assert [accession for batch in rcsb.batches for accession in batch] == [accession.upper() for accession in accessions]
+    assert sorted(metadata) == ["4HHB", "6VXX"]
+
+
+def test_failed_graphql_falls_back_to_scraper(rcsb):
+    rcsb.graphql_status = 503
+
+    assert get_metadata_bulk(["4hhb"], make_session(retries=0)) == {}
+
+    data_frame = download_rcsb_metadata(["4hhb"], make_session(retries=0))
+
+    assert rcsb.pages == ["/www.rcsb.org/structure/4hhb"]
+    assert list(data_frame['Structure Title']) == ["THE CRYSTAL STRUCTURE OF HUMAN DEOXYHAEMOGLOBIN AT 1.74 ANGSTROMS RESOLUTION"]
+    assert list(data_frame['Deposited Date']) == ["1984-03-07"]
+    assert list(data_frame['Paper DOI']) == ["https://doi.org/10.1016/0022-2836(84)90472-8"]
@@ -0,0 +1,120 @@
+import gzip
+import os
+
+import numpy as np
+
+from pdb.structure import cache_path, load_structure, parse_cif, parse_pdb, token_columns
+
+
+def pdb_atom(serial, name, residue, chain, residue_id, coords, element, record="ATOM"):
+    # fixed columns of an ATOM/HETATM record
+    return "{:<6}{:>5} {:<4} {:>3} {:1}{:>4}    {:8.3f}{:8.3f}{:8.3f}{:6.2f}{:6.2f}          {:>2}".format(
+        record, serial, name, residue, chain, residue_id, *coords, 1.0, 20.0, element)
+
+
+PDB_MODELS = "\n".join([
+    "HEADER    TEST ENTRY",
+    "MODEL        1",
+    pdb_atom(1, " N  ", "ALA", "A", 1, (1.0, 2.0, 3.0), "N"),
+    pdb_atom(2, " CA ", "ALA", "A", 1, (4.0, 5.0, 6.0), "C"),
+    pdb_atom(3, " O  ", "HOH", "B", 101, (7.0, 8.0, 9.0), "O", record="HETATM"),
+    "ENDMDL",
+    "MODEL        2",
+    pdb_atom(1, " N  ", "ALA", "A", 1, (1.5, 2.5, 3.5), "N"),
+    "ENDMDL",
+    "END",
+    "",
+]).encode()
+
+CIF = b"""data_TEST
+#
+loop_
+_atom_site.group_PDB
+_atom_site.id
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_comp_id
+_atom_site.label_asym_id
+_atom_site.label_seq_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+_atom_site.occupancy
+_atom_site.B_iso_or_equiv
+_atom_site.pdbx_PDB_model_num
+ATOM   1 P P     DG  A 1 1.000 2.000 3.000 1.00 10.00 1
+ATOM   2 O "O5'" DG  A 1 4.000 5.000 6.000 1.00 11.00 1
+ATOM   3 C "C5'" DG  A 1 7.000 8.000 9.000 0.50 12.00 1
+HETATM 4 O O     HOH B . 1.500 2.500 3.500 1.00 30.00 1
+ATOM   5 P P     DG  A 1 1.100 2.100 3.100 1.00 10.00 2
+#
+"""
+
+
+def test_pdb_first_model_only():
+    atoms = parse_pdb(PDB_MODELS)
+
+    assert list(atoms['atom_name']) == [b'N', b'CA', b'O']
+    assert list(atoms['residue_name']) == [b'ALA', b'ALA', b'HOH']
+    assert list(atoms['residue_id']) == [1, 1, 101]
+    assert list(atoms['hetero']) == [False, False, True]
+    assert np.allclose(atoms['coords'], [[1, 2, 3], [4, 5, 6], [7, 8, 9]])
+
+
+def test_pdb_blank_element_columns():
+    data = "\n".join([
+        pdb_atom(1, " CA ", "ALA", "A", 1, (0.0, 0.0, 0.0), ""),
+        pdb_atom(2, "1HB ", "ALA", "A", 1, (0.0, 0.0, 0.0), ""),
+        pdb_atom(3, "FE  ", "HEM", "A", 2, (0.0, 0.0, 0.0), "FE", record="HETATM"),
+        # a record cut short before the element columns
+        pdb_atom(4, " OG ", "SER", "A", 3, (0.0, 0.0, 0.0), "")[:66],
+    ]).encode()
+
+    atoms = parse_pdb(data)
+
+    # taken from the first letter of the atom name, digits skipped
+    assert list(atoms['element']) == [b'C', b'H', b'FE', b'O']
+
+
+def test_cif_quoted_atom_names_and_first_model_only():
+    atoms = parse_cif(CIF)
+
+    assert list(atoms['atom_name']) == [b'P', b"O5'", b"C5'", b'O']
+    assert list(atoms['element']) == [b'P', b'O', b'C', b'O']
+    assert list(atoms['hetero']) == [False, False, False, True]
+    assert list(atoms['residue_id']) == [1, 1, 1, 0]
+    assert np.allclose(atoms['occupancy'], [1.0, 1.0, 0.5, 1.0])
+    assert np.allclose(atoms['coords'][3], [1.5, 2.5, 3.5])
+
+
+def test_quoted_value_with_blanks():
+    # split at its blanks, 'x y z' adds two tokens, and 6 tokens still split into the 2 items
+    columns = token_columns(b"1 'x y z'\n2 w\n", ['id', 'name'])
+
+    assert [bytes(row).rstrip(b'\0') for row in columns[1]] == [b'x y z', b'w']
+    assert [bytes(row).rstrip(b'\0') for row in columns[0]] == [b'1', b'2']
+
+
+def test_sidecar_reuse_and_invalidation(tmp_path):
+    path = str(tmp_path / "pdb1abc.ent.gz")
+    with open(path, 'wb') as structure_file:
+        structure_file.write(gzip.compress(PDB_MODELS))
+
+    parsed = load_structure(path)
+    assert os.path.exists(cache_path(path))
+    assert cache_path(path) == str(tmp_path / "pdb1abc.ent.atoms.npy")
+
+    cached = load_structure(path)
+    assert isinstance(cached, np.memmap)
+    assert np.array_equal(cached, parsed)
+
+    # replaced by a new download: another mtime, the sidecar is parsed again
+    with open(path, 'wb') as structure_file:
+        structure_file.write(gzip.compress(PDB_MODELS.replace(b"ALA", b"GLY")))
+    mtime = os.stat(path).st_mtime_ns
+    os.utime(path, ns=(mtime, mtime + 10 ** 9))
+
+    reparsed = load_structure(path)
+    assert not isinstance(reparsed, np.memmap)
+    assert list(reparsed['residue_name'][:2]) == [b'GLY', b'GLY']
+    assert list(load_structure(path)['residue_name'][:2]) == [b'GLY', b'GLY']
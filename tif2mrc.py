@@ -2,36 +2,29 @@ import sys,os
 import subprocess
 import argparse
 
-def converttif2mrc(direc):
+from common.instrumentation import RunRecorder
+from empiar.conversion import convert_directory
+
+def converttif2mrc(direc, workers=None, force=False, engine='imod', recorder=None):
     '''
         description:
             Function for converting tif file to mrc file.
     
         input:
             - direc: directory containing the tif file
+            - workers: conversions run in parallel (default=None, the number of cores)
+            - force: converts files even if their mrc is up to date (default=False)
+            - engine: 'imod' runs IMOD's tif2mrc, 'native' converts in-process with NumPy (default='imod')
+            - recorder: common.instrumentation.RunRecorder every conversion is recorded to (default=None)
             
             
         output:
             - conversion flag: True for Success, False for Not
 
     '''
-    # lst = 
-    # for filename in glob.iglob(direc+"**/*.tif",recursive=True):
-    #     print(filename)
-
-    print("Starting to convert tif2mrc using IMOD")
-    for folder, subs, files in os.walk(direc):
-        
-        for file in files:
-            mrc_fl_name = file.split(".tif")[0] + ".mrc"
-            in_file = folder +"/"+file 
-            out_file = folder + "/" + mrc_fl_name
-            try:
-                subprocess.call(['tif2mrc',in_file,out_file]) 
-            except:
-                return False
-    
-    return True
+    print("Starting to convert tif2mrc using {}".format("IMOD" if engine == 'imod' else "the native converter"))
+    results = convert_directory(direc, workers, force, engine, recorder)
+    return all(error is None for in_file, error, seconds in results)
 
 
 def parseArguments():
@@ -41,12 +34,30 @@ def parseArguments():
     	help="Input directory of the folder containing tif files",
     	required=True,
     	metavar='direc')
+    parser.add_argument('-w','--workers',
+    	help="Number of files converted in parallel [default: number of cores]",
+    	type=int,
+    	metavar='N')
+    parser.add_argument('--engine',
+    	help="Conversion engine: IMOD's tif2mrc or the in-process NumPy converter [default: %(default)s]",
+    	choices=['imod', 'native'],
+    	default='imod')
+    parser.add_argument('--force',
+    	help="Convert files even if their mrc is newer than the tif",
+    	action='store_true')
+    parser.add_argument('--report',
+    	help="Write a JSON run report (time per conversion with p50/p95/p99, MB/s) to FILE",
+    	metavar='FILE')
 
     args = parser.parse_args()
     print(args)
     # args = validate_arguments(parser,args)
     
-    converttif2mrc(args.input_directory)
+    recorder = RunRecorder() if args.report else None
+    converttif2mrc(args.input_directory, args.workers, args.force, args.engine, recorder)
+    if recorder is not None:
+        recorder.print_summary()
+        recorder.write_report(args.report)
 
 def main():
 	arguments = parseArguments()
@@ -0,0 +1,161 @@
+import csv
+import os
+import re
+
+import numpy as np
+
+from common.concurrency import ordered_map
+from volume.store import STORE_EXTENSION, open_volume
+
+try:
+    # with PyTorch installed the dataset plugs into torch.utils.data.DataLoader (workers are sharded)
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+    get_worker_info = None
+
+MAP_FILE = re.compile(r'^emd_(\d+)\.(?:map|map\.gz|vol)$')
+MODEL_FILES = ("pdb{}.ent.gz", "pdb{}.ent", "{}.cif.gz", "{}.cif")
+
+
+def find_entries(directory):
+    '''
+        description:
+            Function for listing the maps downloaded to a directory (by emdb_stub or cross_archive_stub)
+            with the models fitted to them. Pairs come from the pairs.csv written by cross_archive_stub;
+            a map without a pairs.csv entry has no models. Models are only listed if they were downloaded.
+            A map converted by volume.store is listed by its chunked store.
+
+        input:
+            - directory: download directory
+
+        output:
+            - list of dicts {'emdb_id', 'map', 'models'}, sorted by EMDB number
+    '''
+    maps = {}
+    for name in sorted(os.listdir(directory)):
+        match = MAP_FILE.match(name)
+        if match:
+            maps.setdefault(match.group(1), []).append(name)
+    # chunked store first, then the uncompressed map, then the .gz
+    preference = (STORE_EXTENSION, ".map", ".map.gz")
+    for emdb_id, names in maps.items():
+        maps[emdb_id] = os.path.join(directory, min(names, key=lambda name: [name.endswith(suffix) for suffix in preference].index(True)))
+
+    fitted = {}
+    pairs_path = os.path.join(directory, "pairs.csv")
+    if os.path.exists(pairs_path):
+        with open(pairs_path, newline='') as pairs_file:
+            for emdb_id, pdb_id in list(csv.reader(pairs_file))[1:]:
+                fitted.setdefault(emdb_id.split("-")[-1], []).append(pdb_id)
+
+    entries = []
+    for emdb_id in sorted(maps, key=int):
+        models = []
+        for pdb_id in fitted.get(emdb_id, []):
+            paths = [os.path.join(directory, name.format(pdb_id)) for name in MODEL_FILES]
+            models += [path for path in paths if os.path.exists(path)][:1]
+        entries.append({'emdb_id': emdb_id, 'map': maps[emdb_id], 'models': models})
+    return entries
+
+
+def shard(items, index, count):
+    '''
+        output:
+            - every count-th item of items, starting at index
+    '''
+    return items[index::count]
+
+
+class MapPatchDataset(IterableDataset):
+    '''
+        description:
+            Iterable dataset of fixed-size patches cut from downloaded maps. Entries are shuffled per epoch
+            (deterministically from seed and epoch) and split into disjoint shards, one per (rank, worker):
+            rank/world_size for distributed jobs, and the DataLoader worker of this process when running
+            under torch.utils.data.DataLoader. Every process can work out its shard on its own, so no
+            coordination is needed and together the shards cover every entry exactly once per epoch.
+
+            Upcoming maps are opened and their patches read on prefetch threads (common.concurrency.ordered_map)
+            while earlier samples are consumed; at most 2 * prefetch maps are buffered. Maps are memory-mapped
+            (volume.reader.MapVolume) or read from their chunked store (volume.store.ChunkedVolume), so only the
+            voxels of the patches are read from disk. Works with plain NumPy; PyTorch is only used, if installed,
+            to find the DataLoader worker.
+
+        input:
+            - entries: download directory or list of entries from find_entries
+            - patch_size: (z, y, x) size of the patches
+            - patches_per_map: patches drawn from every map per epoch (default=8)
+            - seed: base seed of the shuffling and of the patch positions (default=0)
+            - rank, world_size: this process and the number of processes sharing the epoch (default=0, 1)
+            - prefetch: maps read ahead in parallel (default=4)
+            - dtype: dtype of the returned patches (default=np.float32)
+            - shuffle: shuffles the entries every epoch (default=True)
+            - transform: callable applied to every sample dict before it is yielded (default=None)
+
+        output (per sample):
+            - dict {'emdb_id', 'map', 'models', 'start', 'patch'}; 'start' is the (z, y, x) of the patch in the map
+    '''
+
+    def __init__(self, entries, patch_size, patches_per_map=8, seed=0, rank=0, world_size=1, prefetch=4, dtype=np.float32,
+                 shuffle=True, transform=None):
+        self.entries = find_entries(entries) if isinstance(entries, str) else list(entries)
+        self.patch_size = tuple(patch_size)
+        self.patches_per_map = patches_per_map
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.prefetch = prefetch
+        self.dtype = dtype
+        self.shuffle = shuffle
+        self.transform = transform
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        '''
+            description:
+                Selects the shuffle of the next iteration; call with the same epoch on every rank.
+        '''
+        self.epoch = epoch
+
+    def shard_entries(self):
+        '''
+            output:
+                - entries of this rank and DataLoader worker for the current epoch
+        '''
+        order = list(range(len(self.entries)))
+        if self.shuffle:
+            np.random.default_rng((self.seed, self.epoch)).shuffle(order)
+        worker_id, workers = 0, 1
+        worker_info = get_worker_info() if get_worker_info is not None else None
+        if worker_info is not None:
+            worker_id, workers = worker_info.id, worker_info.num_workers
+        mine = shard(order, self.rank * workers + worker_id, self.world_size * workers)
+        return [(index, self.entries[index]) for index in mine]
+
+    def load(self, item):
+        '''
+            description:
+                Function for reading the patches of one entry (runs on a prefetch thread).
+
+            output:
+                - list of sample dicts; empty if the map is smaller than a patch or can't be read
+        '''
+        index, entry = item
+        # patch positions depend on the entry and epoch only, not on the shard it landed in
+        rng = np.random.default_rng((self.seed, self.epoch, index))
+        try:
+            with open_volume(entry['map']) as volume:
+                samples = []
+                for count in range(self.patches_per_map):
+                    start = volume.random_start(self.patch_size, rng)
+                    samples.append(dict(entry, start=start, patch=volume.read(start, self.patch_size, self.dtype)))
+        except (OSError, ValueError) as error:
+            print("Skipping EMD-{}: {}".format(entry['emdb_id'], error))
+            return []
+        return samples
+
+    def __iter__(self):
+        for samples in ordered_map(self.load, self.shard_entries(), self.prefetch):
+            for sample in samples:
+                yield self.transform(sample) if self.transform is not None else sample
@@ -0,0 +1,137 @@
+import struct
+
+import numpy as np
+
+HEADER_SIZE = 1024
+
+# imodStamp of files written by IMOD; their imodFlags bit 0 tells whether mode 0 bytes are signed
+IMOD_STAMP = 1146047817
+
+# MRC2014 mode -> numpy dtype of the voxel data (little endian)
+MRC_MODES = {
+    0: np.dtype('i1'),
+    1: np.dtype('<i2'),
+    2: np.dtype('<f4'),
+    6: np.dtype('<u2'),
+    12: np.dtype('<f2'),
+}
+
+# numpy dtype -> MRC2014 mode; uint8 is written as mode 0 with the IMOD stamp marking the bytes unsigned,
+# like IMOD does; types without an MRC mode are converted to float32 (mode 2)
+DTYPE_MODES = {
+    np.dtype('u1'): 0,
+    np.dtype('i1'): 0,
+    np.dtype('i2'): 1,
+    np.dtype('u2'): 6,
+    np.dtype('f2'): 12,
+    np.dtype('f4'): 2,
+}
+
+
+def mode_for_dtype(dtype):
+    '''
+        description:
+            Function for choosing the MRC mode data of the given numpy dtype is stored with.
+
+        output:
+            - (mode, numpy dtype written to the file)
+    '''
+    dtype = np.dtype(dtype).newbyteorder('=')
+    mode = DTYPE_MODES.get(dtype)
+    if mode is None:
+        return 2, MRC_MODES[2]
+    if dtype == np.dtype('u1'):
+        return 0, dtype
+    return mode, MRC_MODES[mode]
+
+
+def build_header(shape, mode, voxel_size=1.0, dmin=0.0, dmax=0.0, dmean=0.0, rms=0.0, origin=(0.0, 0.0, 0.0), ispg=0, labels=(), dtype=None):
+    '''
+        description:
+            Function for building a little-endian MRC2014 header.
+
+        input:
+            - shape: (nz, ny, nx) of the data
+            - mode: MRC mode of the data
+            - voxel_size: pixel size in Angstrom, used for the cell dimensions (default=1.0)
+            - dmin, dmax, dmean, rms: data statistics (default=0.0)
+            - origin: origin in Angstrom (default=(0, 0, 0))
+            - ispg: space group, 0 for an image stack, 1 for a volume (default=0)
+            - labels: up to 10 text labels of at most 80 characters (default=())
+            - dtype: numpy dtype of the data as returned by mode_for_dtype; uint8 data (mode 0) gets the
+              IMOD stamp with imodFlags bit 0 clear, as MRC2014 readers otherwise take mode 0 as signed (default=None)
+
+        output:
+            - header: 1024 bytes
+    '''
+    nz, ny, nx = shape
+    # an image stack has one section per image (mz = 1), a volume spans all its sections
+    mz = 1 if ispg == 0 else nz
+    labels = [label[:80] for label in labels][:10]
+
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into('<10i', header, 0, nx, ny, nz, mode, 0, 0, 0, nx, ny, mz)
+    struct.pack_into('<6f', header, 40, nx * voxel_size, ny * voxel_size, mz * voxel_size, 90.0, 90.0, 90.0)
+    struct.pack_into('<3i', header, 64, 1, 2, 3)
+    struct.pack_into('<3f', header, 76, dmin, dmax, dmean)
+    struct.pack_into('<2i', header, 88, ispg, 0)
+    struct.pack_into('<4si', header, 104, b'MRCO', 20140)
+    if mode == 0 and dtype is not None and np.dtype(dtype) == np.dtype('u1'):
+        struct.pack_into('<2i', header, 152, IMOD_STAMP, 0)
+    struct.pack_into('<3f', header, 196, *origin)
+    struct.pack_into('<4s4sfi', header, 208, b'MAP ', b'\x44\x44\x00\x00', rms, len(labels))
+    for index, label in enumerate(labels):
+        encoded = label.encode('ascii', 'replace')
+        header[224 + 80 * index: 224 + 80 * index + len(encoded)] = encoded
+        header[224 + 80 * index + len(encoded): 224 + 80 * (index + 1)] = b' ' * (80 - len(encoded))
+    return bytes(header)
+
+
+def parse_header(header):
+    '''
+        description:
+            Function for reading the fields of an MRC header (either byte order).
+
+        input:
+            - header: at least the first 1024 bytes of the file
+
+        output:
+            - dict of header fields; 'dtype' is the numpy dtype of the voxel data and
+              'data_offset' where the data starts (after the extended header)
+    '''
+    endian = '>' if header[212] == 0x11 else '<'
+    nx, ny, nz, mode, nxstart, nystart, nzstart, mx, my, mz = struct.unpack_from(endian + '10i', header, 0)
+    if mode not in MRC_MODES:
+        raise ValueError("unsupported MRC mode {}".format(mode))
+    cella = struct.unpack_from(endian + '3f', header, 40)
+    cellb = struct.unpack_from(endian + '3f', header, 52)
+    mapc, mapr, maps = struct.unpack_from(endian + '3i', header, 64)
+    dmin, dmax, dmean = struct.unpack_from(endian + '3f', header, 76)
+    ispg, nsymbt = struct.unpack_from(endian + '2i', header, 88)
+    exttyp, nversion = struct.unpack_from(endian + '4si', header, 104)
+    origin = struct.unpack_from(endian + '3f', header, 196)
+    rms, nlabl = struct.unpack_from(endian + 'fi', header, 216)
+    imod_stamp, imod_flags = struct.unpack_from(endian + '2i', header, 152)
+    dtype = MRC_MODES[mode]
+    if mode == 0 and imod_stamp == IMOD_STAMP and not imod_flags & 1:
+        dtype = np.dtype('u1')
+    labels = [header[224 + 80 * index: 224 + 80 * (index + 1)].decode('ascii', 'replace').rstrip() for index in range(min(max(nlabl, 0), 10))]
+
+    return {
+        'shape': (nz, ny, nx),
+        'mode': mode,
+        'dtype': dtype.newbyteorder(endian),
+        'start': (nzstart, nystart, nxstart),
+        'sampling': (mz, my, mx),
+        'cell_lengths': cella,
+        'cell_angles': cellb,
+        'axis_order': (mapc, mapr, maps),
+        'dmin': dmin, 'dmax': dmax, 'dmean': dmean, 'rms': rms,
+        'ispg': ispg,
+        'exttyp': exttyp,
+        'nversion': nversion,
+        'origin': origin,
+        'labels': labels,
+        'voxel_size': tuple(length / count if count else 0.0 for length, count in zip(cella, (mx, my, mz))),
+        'data_offset': HEADER_SIZE + nsymbt,
+    }
@@ -0,0 +1,215 @@
+import os
+
+import numpy as np
+
+from common.gunzip import gunzip_file, unzipped_path
+from volume.mrc import HEADER_SIZE, parse_header
+
+# MRC axis numbers (mapc, mapr, maps; 1=x, 2=y, 3=z) -> index of that axis in (z, y, x)
+AXIS_INDEX = {1: 2, 2: 1, 3: 0}
+
+
+def read_header(path):
+    '''
+        description:
+            Function for reading the header of an (uncompressed) MRC/map file.
+
+        output:
+            - dict of header fields, see volume.mrc.parse_header
+    '''
+    with open(path, 'rb') as map_file:
+        header = map_file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError("{} is too short to be an MRC file".format(path))
+    return parse_header(header)
+
+
+def random_start(shape, size, rng=None, name="the volume"):
+    '''
+        output:
+            - (z, y, x) start of a box of the given size lying entirely inside a volume of the given shape
+    '''
+    rng = rng if rng is not None else np.random.default_rng()
+    if any(length > extent for length, extent in zip(size, shape)):
+        raise ValueError("patch {} does not fit in {} of shape {}".format(tuple(size), name, tuple(shape)))
+    return tuple(int(rng.integers(0, extent - length + 1)) for length, extent in zip(size, shape))
+
+
+class MapVolume:
+    '''
+        description:
+            Read-only view of the voxels of an MRC/map file without loading it. The data is memory-mapped,
+            so opening a map costs one header read, and slicing (subvolume, section, patch) returns NumPy
+            views whose pages are only read from disk when the values are used: a random crop of a map
+            touches the pages of the crop, not the whole file. Use read() or np.array() to copy a region
+            into memory.
+
+            data is indexed (z, y, x) whatever axis order (mapc, mapr, maps) the file stores; for files that
+            are not stored x-fastest this is a transposed view, still without copying.
+
+        input:
+            - path: uncompressed MRC/map file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        stored_shape = self.header['shape']
+        size = self.header['data_offset'] + int(np.prod(stored_shape)) * self.header['dtype'].itemsize
+        if os.path.getsize(path) < size:
+            raise ValueError("{} is truncated: {} bytes, the header describes {}".format(path, os.path.getsize(path), size))
+        self._memmap = np.memmap(path, dtype=self.header['dtype'], mode='r', offset=self.header['data_offset'], shape=stored_shape)
+        # the file's axes, slowest first, are (sections, rows, columns) = (maps, mapr, mapc)
+        mapc, mapr, maps = self.header['axis_order']
+        if sorted((mapc, mapr, maps)) != [1, 2, 3]:
+            raise ValueError("{}: invalid axis order {}".format(path, self.header['axis_order']))
+        stored_axes = [AXIS_INDEX[maps], AXIS_INDEX[mapr], AXIS_INDEX[mapc]]
+        self.data = self._memmap.transpose([stored_axes.index(axis) for axis in range(3)])
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def voxel_size(self):
+        '''
+            output:
+                - (z, y, x) voxel size in Angstrom
+        '''
+        return tuple(reversed(self.header['voxel_size']))
+
+    @property
+    def origin(self):
+        '''
+            output:
+                - (z, y, x) origin in Angstrom
+        '''
+        return tuple(reversed(self.header['origin']))
+
+    @property
+    def corner(self):
+        '''
+            description:
+                Position of voxel (0, 0, 0) in Angstrom: the origin plus the start index (nxstart, nystart,
+                nzstart, given for the columns, rows and sections of the file) times the voxel size.
+                Model coordinates map to voxel (position - corner) / voxel_size.
+
+            output:
+                - (z, y, x) position in Angstrom
+        '''
+        mapc, mapr, maps = self.header['axis_order']
+        sections, rows, columns = self.header['start']
+        start = [0, 0, 0]
+        for axis, value in zip((mapc, mapr, maps), (columns, rows, sections)):
+            start[AXIS_INDEX[axis]] = value
+        return tuple(origin + index * size for origin, index, size in zip(self.origin, start, self.voxel_size))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self.data, dtype=dtype)
+
+    def section(self, index):
+        '''
+            output:
+                - view of the z section index
+        '''
+        return self.data[index]
+
+    def subvolume(self, start, size):
+        '''
+            description:
+                Function for cutting a box out of the volume. The box is clipped to the volume,
+                so near the edges the view is smaller than size.
+
+            input:
+                - start: (z, y, x) first voxel of the box
+                - size: (z, y, x) size of the box
+
+            output:
+                - view of the box
+        '''
+        return self.data[tuple(slice(max(begin, 0), max(begin + length, 0)) for begin, length in zip(start, size))]
+
+    def random_start(self, size, rng=None):
+        '''
+            output:
+                - (z, y, x) start of a box of the given size lying entirely inside the volume
+        '''
+        return random_start(self.shape, size, rng, self.path)
+
+    def patch(self, size, rng=None):
+        '''
+            description:
+                Function for cutting a box of the given size at a random position inside the volume.
+
+            input:
+                - size: (z, y, x) size of the patch
+                - rng: numpy.random.Generator (default=None, a new unseeded one)
+
+            output:
+                - (start, view of the patch)
+        '''
+        start = self.random_start(size, rng)
+        return start, self.subvolume(start, size)
+
+    def read(self, start=(0, 0, 0), size=None, dtype=None):
+        '''
+            description:
+                Function for copying a box of the volume into memory, e.g. to hand it to code that
+                modifies it or that needs a contiguous native-endian array.
+
+            input:
+                - start: (z, y, x) first voxel of the box (default=(0, 0, 0))
+                - size: (z, y, x) size of the box (default=None, up to the end of the volume)
+                - dtype: dtype of the copy (default=None, the native-endian dtype of the file)
+
+            output:
+                - numpy array
+        '''
+        size = size or tuple(extent - begin for begin, extent in zip(start, self.shape))
+        box = self.subvolume(start, size)
+        return np.ascontiguousarray(box, dtype=dtype or box.dtype.newbyteorder('='))
+
+    def close(self):
+        # the file stays mapped until the views handed out are released as well
+        self.data = None
+        self._memmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_map(path, unzip=True, keep_compressed=True):
+    '''
+        description:
+            Function for opening a downloaded map as a MapVolume. Compressed maps ('emd_1234.map.gz',
+            as written by download_emdb) can't be memory-mapped: the uncompressed file next to them is
+            used, and created first if it doesn't exist yet (see --unzip_emdb to do that while downloading).
+
+        input:
+            - path: MRC/map file, gzipped or not
+            - unzip: decompresses a .gz whose uncompressed file is missing (default=True)
+            - keep_compressed: keeps the .gz after decompressing it (default=True)
+
+        output:
+            - MapVolume
+    '''
+    if path.endswith(".gz"):
+        if not os.path.exists(unzipped_path(path)):
+            if not unzip:
+                raise ValueError("{} is compressed; decompress it first or pass unzip=True".format(path))
+            gunzip_file(path, keep_compressed=keep_compressed)
+        path = unzipped_path(path)
+    return MapVolume(path)
@@ -0,0 +1,353 @@
+import json
+import os
+import re
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from common.gunzip import unzipped_path, zlib_backend
+from volume.reader import open_map, random_start
+
+STORE_EXTENSION = ".vol"
+META_FILE = "meta.json"
+STORE_VERSION = 1
+
+# maps downloaded by emdb_stub and mrc files converted from EMPIAR tifs
+VOLUME_FILE = re.compile(r'^(.*)\.(?:map|mrc)(?:\.gz)?$')
+
+# decompressed chunks kept in memory per opened store; neighbouring patches mostly share chunks
+CACHED_CHUNKS = 64
+
+
+def store_path(path):
+    '''
+        output:
+            - store of a map or mrc file ('emd_1234.map.gz' -> 'emd_1234.vol')
+    '''
+    directory, name = os.path.split(path)
+    match = VOLUME_FILE.match(name)
+    return os.path.join(directory, (match.group(1) if match else name) + STORE_EXTENSION)
+
+
+def chunk_name(level, index):
+    return os.path.join(str(level), ".".join(str(value) for value in index))
+
+
+def chunk_grid(shape, chunk):
+    '''
+        output:
+            - (z, y, x) index of every chunk of a volume of the given shape
+    '''
+    counts = [-(-extent // size) for extent, size in zip(shape, chunk)]
+    return [tuple(index) for index in np.ndindex(*counts)]
+
+
+def downsample(data):
+    '''
+        description:
+            Function for halving a volume along every axis by averaging 2x2x2 blocks; an odd edge
+            is padded by repeating its last voxel.
+    '''
+    pad = [(0, extent % 2) for extent in data.shape]
+    if any(after for before, after in pad):
+        data = np.pad(data, pad, mode='edge')
+    nz, ny, nx = data.shape
+    blocks = data.reshape(nz // 2, 2, ny // 2, 2, nx // 2, 2).astype(np.float64)
+    return blocks.mean(axis=(1, 3, 5)).astype(data.dtype)
+
+
+class ChunkedVolume:
+    '''
+        description:
+            Reader of a chunked volume store written by write_store. The volume is split into cubic chunks,
+            each compressed on its own (zlib, or ISA-L when installed), so a patch read decompresses only
+            the chunks it overlaps instead of the whole map. Level 0 is the full-resolution volume and
+            every further level halves the previous one (a multi-resolution pyramid for coarse sampling).
+
+            The interface matches volume.reader.MapVolume (shape, read, random_start, patch), so the two can
+            be used interchangeably, e.g. by volume.dataset.MapPatchDataset.
+
+            Layout: <name>.vol/meta.json, and <name>.vol/<level>/<z>.<y>.<x> for every chunk.
+
+        input:
+            - path: store directory
+            - cached_chunks: decompressed chunks kept in memory (default=CACHED_CHUNKS)
+    '''
+
+    def __init__(self, path, cached_chunks=CACHED_CHUNKS):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta.get('version') != STORE_VERSION:
+            raise ValueError("{}: unsupported store version {}".format(path, self.meta.get('version')))
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.chunk = tuple(self.meta['chunk'])
+        self.levels = len(self.meta['shapes'])
+        self.header = self.meta['header']
+        self._cached_chunks = cached_chunks
+        self._cache = OrderedDict()
+
+    @property
+    def shape(self):
+        return self.level_shape(0)
+
+    def level_shape(self, level):
+        return tuple(self.meta['shapes'][level])
+
+    @property
+    def voxel_size(self):
+        '''
+            output:
+                - (z, y, x) voxel size in Angstrom at level 0
+        '''
+        return tuple(self.meta['voxel_size'])
+
+    @property
+    def origin(self):
+        '''
+            output:
+                - (z, y, x) origin in Angstrom
+        '''
+        return tuple(self.meta['origin'])
+
+    @property
+    def corner(self):
+        '''
+            output:
+                - (z, y, x) position in Angstrom of voxel (0, 0, 0), see MapVolume.corner
+        '''
+        return tuple(self.meta.get('corner', self.meta['origin']))
+
+    def read_chunk(self, level, index):
+        '''
+            output:
+                - decompressed chunk index of the level (clipped to the volume at the edges)
+        '''
+        key = (level, index)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        shape = self.level_shape(level)
+        chunk_shape = tuple(min(size, extent - position * size) for position, size, extent in zip(index, self.chunk, shape))
+        with open(os.path.join(self.path, chunk_name(level, index)), 'rb') as chunk_file:
+            data = np.frombuffer(zlib_backend.decompress(chunk_file.read()), dtype=self.dtype).reshape(chunk_shape)
+        self._cache[key] = data
+        if len(self._cache) > self._cached_chunks:
+            self._cache.popitem(last=False)
+        return data
+
+    def read(self, start=(0, 0, 0), size=None, dtype=None, level=0):
+        '''
+            description:
+                Function for reading a box of the volume; only the chunks the box overlaps are read.
+                The box is clipped to the volume, like MapVolume.subvolume.
+
+            input:
+                - start: (z, y, x) first voxel of the box, in voxels of the level (default=(0, 0, 0))
+                - size: (z, y, x) size of the box (default=None, up to the end of the volume)
+                - dtype: dtype of the result (default=None, the dtype of the store)
+                - level: pyramid level, 0 for full resolution (default=0)
+
+            output:
+                - numpy array
+        '''
+        shape = self.level_shape(level)
+        size = size or tuple(extent - begin for begin, extent in zip(start, shape))
+        begin = [min(max(value, 0), extent) for value, extent in zip(start, shape)]
+        end = [min(max(value + length, 0), extent) for value, length, extent in zip(start, size, shape)]
+        box = np.empty([max(stop - first, 0) for first, stop in zip(begin, end)], dtype=dtype or self.dtype)
+        if box.size == 0:
+            return box
+        first_chunk = [first // size for first, size in zip(begin, self.chunk)]
+        last_chunk = [(stop - 1) // size for stop, size in zip(end, self.chunk)]
+        for offset in np.ndindex(*[last - first + 1 for first, last in zip(first_chunk, last_chunk)]):
+            index = tuple(first + step for first, step in zip(first_chunk, offset))
+            chunk_start = [position * size for position, size in zip(index, self.chunk)]
+            data = self.read_chunk(level, index)
+            # overlap of the chunk and the box, in volume coordinates
+            low = [max(first, position) for first, position in zip(begin, chunk_start)]
+            high = [min(stop, position + extent) for stop, position, extent in zip(end, chunk_start, data.shape)]
+            box[tuple(slice(a - b, c - b) for a, b, c in zip(low, begin, high))] = \
+                data[tuple(slice(a - b, c - b) for a, b, c in zip(low, chunk_start, high))]
+        return box
+
+    def subvolume(self, start, size, level=0):
+        return self.read(start, size, level=level)
+
+    def random_start(self, size, rng=None, level=0):
+        return random_start(self.level_shape(level), size, rng, self.path)
+
+    def patch(self, size, rng=None, level=0):
+        '''
+            output:
+                - (start, patch) of the given size at a random position inside the level
+        '''
+        start = self.random_start(size, rng, level)
+        return start, self.read(start, size, level=level)
+
+    def close(self):
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_level(output_path, level, data_reader, shape, chunk, compression_level):
+    for index in chunk_grid(shape, chunk):
+        start = [position * size for position, size in zip(index, chunk)]
+        data = np.ascontiguousarray(data_reader(start, chunk))
+        with open(os.path.join(output_path, chunk_name(level, index)), 'wb') as chunk_file:
+            chunk_file.write(zlib_backend.compress(data.tobytes(), compression_level))
+
+
+def write_store(path, output_path=None, chunk=64, levels=3, compression_level=1):
+    '''
+        description:
+            Function for converting an MRC/map file (gzipped or not) into a chunked volume store
+            (see ChunkedVolume). Level 0 is copied chunk by chunk from the memory-mapped file, and every
+            further level is built from the chunks of the level before, so memory stays at a few chunks
+            whatever the size of the map. The store is written under a temporary name and renamed into
+            place once complete.
+
+        input:
+            - path: MRC/map file
+            - output_path: store directory (default=store_path(path))
+            - chunk: edge of the cubic chunks in voxels (default=64)
+            - levels: number of pyramid levels including full resolution (default=3)
+            - compression_level: zlib level; 1 favours speed, ISA-L accepts 0-3 (default=1)
+
+        output:
+            - output_path
+    '''
+    output_path = output_path or store_path(path)
+    part_path = output_path + ".part"
+    if os.path.exists(part_path):
+        shutil.rmtree(part_path)
+    chunk = (chunk,) * 3
+    # a map only available gzipped is decompressed for memory-mapping and the copy removed afterwards
+    unzipped = path.endswith(".gz") and not os.path.exists(unzipped_path(path))
+    try:
+        with open_map(path) as volume:
+            shapes = [volume.shape]
+            for level in range(1, levels):
+                shapes.append(tuple(-(-extent // 2) for extent in shapes[-1]))
+            dtype = volume.dtype.newbyteorder('=')
+            for level in range(levels):
+                os.makedirs(os.path.join(part_path, str(level)))
+            write_level(part_path, 0, lambda start, size: volume.read(start, size, dtype), shapes[0], chunk, compression_level)
+            meta = {
+                'version': STORE_VERSION,
+                'source': os.path.basename(path),
+                'dtype': dtype.str,
+                'chunk': chunk,
+                'shapes': shapes,
+                'voxel_size': volume.voxel_size,
+                'voxel_sizes': [[value * 2 ** level for value in volume.voxel_size] for level in range(levels)],
+                'origin': volume.origin,
+                'corner': volume.corner,
+                'header': {key: value for key, value in volume.header.items() if key in ('mode', 'dmin', 'dmax', 'dmean', 'rms', 'ispg', 'labels')},
+                'compression': zlib_backend.__name__,
+            }
+    finally:
+        if unzipped and os.path.exists(unzipped_path(path)):
+            os.remove(unzipped_path(path))
+    with open(os.path.join(part_path, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    previous = ChunkedVolume(part_path)
+    for level in range(1, levels):
+        def halved(start, size, level=level):
+            return downsample(previous.read([2 * value for value in start], [2 * value for value in size], level=level - 1))
+        write_level(part_path, level, halved, shapes[level], chunk, compression_level)
+
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    os.replace(part_path, output_path)
+    return output_path
+
+
+def open_volume(path):
+    '''
+        output:
+            - ChunkedVolume for a store directory, MapVolume (volume.reader.open_map) for an MRC/map file
+    '''
+    if os.path.isdir(path):
+        return ChunkedVolume(path)
+    return open_map(path)
+
+
+def find_volumes(direc):
+    '''
+        output:
+            - MRC/map files below direc; a file kept both gzipped and uncompressed is listed once
+    '''
+    volumes = {}
+    for folder, subs, files in os.walk(direc):
+        subs[:] = [sub for sub in subs if not sub.endswith((STORE_EXTENSION, STORE_EXTENSION + ".part"))]
+        for file in sorted(files):
+            if VOLUME_FILE.match(file):
+                path = os.path.join(folder, file)
+                if unzipped_path(path) not in volumes or not file.endswith(".gz"):
+                    volumes[unzipped_path(path)] = path
+    return sorted(volumes.values())
+
+
+def is_up_to_date(path):
+    try:
+        return os.stat(os.path.join(store_path(path), META_FILE)).st_mtime >= os.stat(path).st_mtime
+    except OSError:
+        return False
+
+
+def store_file(path, chunk, levels, compression_level):
+    start_time = time.time()
+    try:
+        write_store(path, chunk=chunk, levels=levels, compression_level=compression_level)
+    except (OSError, ValueError) as error:
+        return path, str(error), time.time() - start_time
+    return path, None, time.time() - start_time
+
+
+def build_stores(direc, workers=None, chunk=64, levels=3, compression_level=1, force=False):
+    '''
+        description:
+            Function for converting every MRC/map file below a directory into a chunked volume store,
+            several files at a time. Files whose store is up to date are skipped unless force is set,
+            and a failed file is reported without stopping the others.
+
+        input:
+            - direc: directory containing the downloaded maps or converted mrc files
+            - workers: files converted in parallel (default=None, the number of cores)
+            - chunk: edge of the cubic chunks in voxels (default=64)
+            - levels: number of pyramid levels including full resolution (default=3)
+            - compression_level: zlib level (default=1)
+            - force: rebuilds stores that are up to date (default=False)
+
+        output:
+            - results: list of (file, error message or None, seconds taken) for the converted files
+    '''
+    paths = find_volumes(direc)
+    todo = [path for path in paths if force or not is_up_to_date(path)]
+    print("Building {} volume stores ({} up to date)".format(len(todo), len(paths) - len(todo)))
+
+    results = []
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [executor.submit(store_file, path, chunk, levels, compression_level) for path in todo]
+        for future in as_completed(futures):
+            path, error, seconds = future.result()
+            results.append((path, error, seconds))
+            if error is None:
+                print("\tStored {} in {:.2f}s".format(path, seconds))
+            else:
+                print("\tFailed {} after {:.2f}s: {}".format(path, seconds, error))
+
+    failures = [result for result in results if result[1] is not None]
+    print("Built {} stores in {:.2f}s, {} failed.".format(len(results) - len(failures), time.time() - start_time, len(failures)))
+    return results
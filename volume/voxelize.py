@@ -0,0 +1,175 @@
+import numpy as np
+
+# atomic numbers, the weight of an atom in a density volume; unknown elements count as carbon
+ATOMIC_NUMBERS = {
+    b'H': 1, b'C': 6, b'N': 7, b'O': 8, b'NA': 11, b'MG': 12, b'P': 15, b'S': 16, b'CL': 17, b'K': 19,
+    b'CA': 20, b'MN': 25, b'FE': 26, b'CO': 27, b'NI': 28, b'CU': 29, b'ZN': 30, b'SE': 34,
+}
+
+# sigma of the Gaussian of an atom for a map of a given resolution (as in Chimera's molmap)
+SIGMA_PER_RESOLUTION = 1 / (np.pi * np.sqrt(2))
+
+# atoms farther than CUTOFF_SIGMAS sigma from a voxel add nothing to it
+CUTOFF_SIGMAS = 3
+
+# edge in voxels of the spatial blocks the atoms are grouped into, and atoms splatted per NumPy batch;
+# memory is bounded by one block (plus its margin) and one batch, whatever the size of the complex
+BLOCK_SIZE = 64
+BATCH_ATOMS = 4096
+
+
+class Grid:
+    '''
+        description:
+            Voxel grid of a map: atoms at (x, y, z) Angstrom land on voxel ((z, y, x) - corner) / voxel_size.
+
+        input:
+            - shape: (z, y, x) number of voxels
+            - voxel_size: (z, y, x) voxel size in Angstrom
+            - corner: (z, y, x) position in Angstrom of voxel (0, 0, 0) (default=(0, 0, 0))
+    '''
+
+    def __init__(self, shape, voxel_size, corner=(0.0, 0.0, 0.0)):
+        self.shape = tuple(int(extent) for extent in shape)
+        self.voxel_size = np.broadcast_to(np.asarray(voxel_size, dtype=np.float64), (3,)).copy()
+        self.corner = np.asarray(corner, dtype=np.float64)
+
+    @classmethod
+    def of(cls, volume, level=0):
+        '''
+            output:
+                - Grid of a volume.reader.MapVolume or volume.store.ChunkedVolume (at a pyramid level)
+        '''
+        shape = volume.level_shape(level) if level else volume.shape
+        return cls(shape, np.asarray(volume.voxel_size) * 2 ** level, volume.corner)
+
+    def to_voxels(self, coords):
+        '''
+            input:
+                - coords: (atoms, 3) x, y, z positions in Angstrom, as read by pdb.structure
+
+            output:
+                - (atoms, 3) z, y, x positions in (fractional) voxels
+        '''
+        return (np.asarray(coords, dtype=np.float64)[:, ::-1] - self.corner) / self.voxel_size
+
+
+def atom_weights(elements):
+    '''
+        output:
+            - atomic number of every element (byte strings like b'C', as in pdb.structure atoms)
+    '''
+    unique, inverse = np.unique(np.char.upper(np.asarray(elements, dtype='S2')), return_inverse=True)
+    return np.array([ATOMIC_NUMBERS.get(element, 6) for element in unique.tolist()], dtype=np.float64)[inverse.ravel()]
+
+
+def neighbourhoods(points, grid, cutoff, block=BLOCK_SIZE, batch=BATCH_ATOMS):
+    '''
+        description:
+            Function for enumerating the voxels within cutoff of every atom, in bounded pieces. Atoms are
+            grouped by the spatial block of the grid they fall in; the voxels of a block plus a margin of
+            cutoff form a region, and the atoms of the block are expanded to their neighbouring voxels
+            batch atoms at a time, as one (atoms, neighbours) array instead of a loop over atoms.
+
+        input:
+            - points: (atoms, 3) z, y, x positions in voxels (Grid.to_voxels)
+            - grid: Grid
+            - cutoff: distance in Angstrom
+            - block: edge of the spatial blocks in voxels (default=BLOCK_SIZE)
+            - batch: atoms expanded at once (default=BATCH_ATOMS)
+
+        output:
+            - generator of (region, local, distances, atoms): region is the tuple of slices of the grid the
+              piece covers, local the flat indices of the voxels in the region, distances their squared
+              distance in Angstrom^2 to the atom and atoms the index of that atom
+    '''
+    shape = np.array(grid.shape)
+    reach = np.ceil(cutoff / grid.voxel_size).astype(np.int64)
+    offsets = np.stack(np.meshgrid(*[np.arange(-value, value + 1) for value in reach], indexing='ij'), axis=-1).reshape(-1, 3)
+    nearest = np.floor(points + 0.5).astype(np.int64)
+    # atoms whose neighbourhood misses the grid entirely are dropped
+    touching = np.flatnonzero(((nearest >= -reach) & (nearest < shape + reach)).all(axis=1))
+    blocks = np.clip(nearest[touching] // block, 0, (shape - 1) // block)
+    keys = np.ravel_multi_index(blocks.T, (shape - 1) // block + 1)
+    order = np.argsort(keys, kind='stable')
+    touching, keys, blocks = touching[order], keys[order], blocks[order]
+    boundaries = np.flatnonzero(np.diff(keys)) + 1
+
+    for group, block_index in zip(np.split(touching, boundaries), blocks[np.concatenate(([0], boundaries))] if len(keys) else []):
+        low = np.maximum(block_index * block - reach, 0)
+        high = np.minimum((block_index + 1) * block + reach, shape)
+        region = tuple(slice(first, last) for first, last in zip(low, high))
+        for start in range(0, len(group), batch):
+            atoms = group[start:start + batch]
+            voxels = nearest[atoms, None, :] + offsets[None, :, :]
+            distances = (((voxels - points[atoms, None, :]) * grid.voxel_size) ** 2).sum(axis=2)
+            inside = ((voxels >= low) & (voxels < high)).all(axis=2) & (distances <= cutoff ** 2)
+            local = np.ravel_multi_index((voxels[inside] - low).T, high - low)
+            yield region, local, distances[inside], np.broadcast_to(atoms[:, None], inside.shape)[inside]
+
+
+def density_volume(coords, grid, resolution=None, sigma=None, weights=None, dtype=np.float32, block=BLOCK_SIZE, batch=BATCH_ATOMS):
+    '''
+        description:
+            Function for simulating a density map of a model: every atom adds a Gaussian of its weight.
+            The contributions of a batch of atoms are summed into their region with one np.bincount
+            (a scatter-add), so the cost is in NumPy rather than in a loop over atoms and voxels.
+
+        input:
+            - coords: (atoms, 3) x, y, z positions in Angstrom
+            - grid: Grid of the output, e.g. Grid.of(map volume) to match a downloaded map
+            - resolution: map resolution in Angstrom, sets sigma = resolution * SIGMA_PER_RESOLUTION
+            - sigma: width of the Gaussians in Angstrom, instead of resolution
+            - weights: weight of every atom, e.g. atom_weights(atoms['element']) (default=None, 1 per atom)
+            - dtype: dtype of the volume (default=np.float32)
+            - block, batch: see neighbourhoods
+
+        output:
+            - density: numpy array of grid.shape
+    '''
+    if sigma is None:
+        if resolution is None:
+            raise ValueError("density_volume needs a resolution or a sigma")
+        sigma = resolution * SIGMA_PER_RESOLUTION
+    weights = np.ones(len(coords)) if weights is None else np.asarray(weights, dtype=np.float64)
+    density = np.zeros(grid.shape, dtype=dtype)
+    for region, local, distances, atoms in neighbourhoods(grid.to_voxels(coords), grid, CUTOFF_SIGMAS * sigma, block, batch):
+        values = weights[atoms] * np.exp(-distances / (2 * sigma ** 2))
+        region_shape = tuple(piece.stop - piece.start for piece in region)
+        density[region] += np.bincount(local, weights=values, minlength=int(np.prod(region_shape))).reshape(region_shape).astype(dtype)
+    return density
+
+
+def label_volume(coords, grid, labels=None, radius=2.0, background=0, dtype=np.int32, block=BLOCK_SIZE, batch=BATCH_ATOMS):
+    '''
+        description:
+            Function for rasterizing a model into a segmentation volume: every voxel within radius of an
+            atom gets the label of the nearest such atom, every other voxel the background.
+
+        input:
+            - coords: (atoms, 3) x, y, z positions in Angstrom
+            - grid: Grid of the output
+            - labels: label of every atom, e.g. chain or residue classes (default=None, 1 for every atom)
+            - radius: distance in Angstrom an atom labels around it (default=2.0)
+            - background: label of the voxels away from every atom (default=0)
+            - dtype: dtype of the volume (default=np.int32)
+            - block, batch: see neighbourhoods
+
+        output:
+            - labels: numpy array of grid.shape
+    '''
+    labels = np.ones(len(coords), dtype=dtype) if labels is None else np.asarray(labels)
+    volume = np.full(grid.shape, background, dtype=dtype)
+    nearest = np.full(grid.shape, np.inf, dtype=np.float32)
+    for region, local, distances, atoms in neighbourhoods(grid.to_voxels(coords), grid, radius, block, batch):
+        region_labels, region_distances = volume[region].ravel(), nearest[region].ravel()
+        closer = distances < region_distances[local]
+        # among atoms reaching the same voxel the nearest is written last, so it wins
+        order = np.argsort(-distances[closer], kind='stable')
+        voxels = local[closer][order]
+        region_labels[voxels] = labels[atoms[closer][order]]
+        region_distances[voxels] = distances[closer][order]
+        region_shape = volume[region].shape
+        volume[region] = region_labels.reshape(region_shape)
+        nearest[region] = region_distances.reshape(region_shape)
+    return volume